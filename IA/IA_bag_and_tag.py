@@ -1,55 +1,295 @@
 import re
 import os
 import bagit
+import shutil
+import logging
 import argparse
-from datacite import DataCiteMDSClient
+import tempfile
+import threading
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
 import settings
 import zipfile
+from IA.datacite_cache import get_datacite_client
+from IA.digests import DigestSidecar, MultiHash, get_sidecar
+from IA.IA_upload import MultipartUploadWriter, part_size_for
+from IA.zip_stream import ZipWriter
+
+logger = logging.getLogger(__name__)
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 
+# bagit changes the working directory while it makes a bag, so only one thread can bag at a time.
+bag_lock = threading.Lock()
+
 
 def build_doi(guid):
     return settings.DOI_FORMAT.format(prefix=settings.DATACITE_PREFIX, guid=guid)
 
 
 def get_datacite_metadata(doi):
-    client = DataCiteMDSClient(
-        url=settings.DATACITE_URL,
-        username=settings.DATACITE_USERNAME,
-        password=settings.DATACITE_PASSWORD,
-        prefix=settings.DATACITE_PREFIX,
+    return get_datacite_client().metadata_get(doi)
+
+
+def hash_file(location: str, algorithms: List[str]) -> MultiHash:
+    hasher = MultiHash(algorithms)
+    with open(location, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(settings.DOWNLOAD_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher
+
+
+# The bag's own files, and what's left of them if a rewrite was cut short.
+TAG_FILE = re.compile(r'^(bagit|bag-info|fetch|(tag)?manifest-\w+)\.txt$')
+TAG_FILE_TEMP = re.compile(r'^\.(bagit|bag-info|fetch|(tag)?manifest-\w+)\.txt\.tmp$')
+
+
+def write_tag_file(location: str, lines: List[str]):
+    """
+    Replaces the tag file atomically, so a crash never leaves a half written manifest behind.
+    """
+    directory, name = os.path.split(location)
+    temp = os.path.join(directory, f'.{name}.tmp')
+    with open(temp, 'w', encoding='utf-8') as fp:
+        fp.writelines(f'{line}\n' for line in lines)
+    os.replace(temp, location)
+
+
+def merge_into(source: str, target: str):
+    """
+    Moves `source` to `target`, and if both are directories moves what's in `source` over
+    one by one, so whatever only `target` has stays where it is.
+    """
+    is_dir = os.path.isdir(source) and not os.path.islink(source)
+    target_is_dir = os.path.isdir(target) and not os.path.islink(target)
+    if is_dir and target_is_dir:
+        for name in os.listdir(source):
+            merge_into(os.path.join(source, name), os.path.join(target, name))
+        os.rmdir(source)
+        return
+
+    if target_is_dir:
+        shutil.rmtree(target)
+    elif is_dir and os.path.lexists(target):
+        os.remove(target)
+    os.replace(source, target)
+
+
+def move_into_payload(path: str) -> str:
+    """
+    Moves everything in `path` into data/, as bagit does. If `path` is already a bag, whatever
+    has been fetched into it since is merged into data/ file by file: files at the same relative
+    paths are replaced and everything else in data/ is left as it is, so a partial re-fetch of a
+    directory doesn't lose the rest of it.
+    """
+    payload = os.path.join(path, 'data')
+
+    if not os.path.exists(os.path.join(path, 'bagit.txt')):
+        # By way of a temporary directory, in case there's something called data in there already.
+        temp_data = tempfile.mkdtemp(dir=path)
+        for name in os.listdir(path):
+            if os.path.join(path, name) != temp_data:
+                os.rename(os.path.join(path, name), os.path.join(temp_data, name))
+        os.rename(temp_data, payload)
+        os.chmod(payload, os.stat(path).st_mode)
+        return payload
+
+    for name in os.listdir(path):
+        source = os.path.join(path, name)
+        if TAG_FILE_TEMP.match(name):
+            os.remove(source)
+        elif name != 'data' and not TAG_FILE.match(name):
+            merge_into(source, os.path.join(payload, name))
+    return payload
+
+
+def make_bag_from_digests(
+        path: str,
+        digests: DigestSidecar,
+        checksums: List[str],
+        workers: int) -> bagit.Bag:
+    """
+    Does what bagit.make_bag does, except that a file is only read if `digests` has nothing for it
+    with the same size, mtime and inode, i.e. neither the fetchers nor an earlier bagging have
+    hashed it as it is now. What does get hashed, by a pool of `workers` threads, is added to
+    `digests` for next time.
+
+    If `path` is a bag already it's updated in place, so re-archiving a registration only hashes
+    what was fetched again and whatever else changed.
+    """
+    recorded = digests.load()
+    payload = move_into_payload(path)
+
+    files = sorted(
+        os.path.relpath(os.path.join(root, file), payload)
+        for root, dirs, names in os.walk(payload) for file in names
+    )
+
+    def file_digests(name: str) -> Dict:
+        location = os.path.join(payload, name)
+        entry = recorded.get(name)
+        if DigestSidecar.matches(entry, os.stat(location), checksums):
+            return entry
+        return digests.entry(location, hash_file(location, checksums), payload)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        entries = list(executor.map(file_digests, files))
+    hashed = sum(1 for name, entry in zip(files, entries) if entry is not recorded.get(name))
+    logger.info(f'Bagging {path}: {len(files) - hashed} files already hashed, {hashed} hashed now.')
+
+    for checksum in checksums:
+        write_tag_file(
+            os.path.join(path, f'manifest-{checksum}.txt'),
+            [
+                # Same escaping as bagit, for names with line breaks in them.
+                f'{entry[checksum]}  data/{name.replace(chr(13), "%0D").replace(chr(10), "%0A")}'
+                for name, entry in zip(files, entries)
+            ],
+        )
+    # Manifests for algorithms that are no longer used would make the bag invalid.
+    for name in os.listdir(path):
+        match = re.match(r'^(tag)?manifest-(\w+)\.txt$', name)
+        if match and match.group(2) not in checksums:
+            os.remove(os.path.join(path, name))
+
+    write_tag_file(
+        os.path.join(path, 'bagit.txt'),
+        ['BagIt-Version: 0.97', 'Tag-File-Character-Encoding: UTF-8'],
+    )
+    write_tag_file(
+        os.path.join(path, 'bag-info.txt'),
+        [
+            f'Bag-Software-Agent: osf-pigeon, bagit.py v{bagit.VERSION}',
+            f'Bagging-Date: {date.today():%Y-%m-%d}',
+            f'Payload-Oxum: {sum(entry["size"] for entry in entries)}.{len(files)}',
+        ],
     )
-    return client.metadata_get(doi)
 
+    tag_files = ['bagit.txt', 'bag-info.txt']
+    tag_files += [f'manifest-{checksum}.txt' for checksum in checksums]
+    for checksum in checksums:
+        write_tag_file(
+            os.path.join(path, f'tagmanifest-{checksum}.txt'),
+            [
+                f'{hash_file(os.path.join(path, name), [checksum]).hexdigests()[checksum]} {name}'
+                for name in tag_files
+            ],
+        )
+
+    digests.rewrite(
+        dict(entry, path=name) for name, entry in zip(files, entries)
+    )
+    return bagit.Bag(path)
+
+
+def bag_and_tag(xml_metadata, destination, processes=None, checksums=None, validation=None):
+    """
+    Writes the DataCite metadata into `destination` and bags it. The manifests come from the
+    digests the fetchers, and earlier baggings, recorded in the sidecar, so only files that are new
+    or changed are read, and a `destination` that's already a bag is updated in place. With the
+    sidecar turned off every payload file is read once, by a pool of `processes`, to compute all of
+    the `checksums` together.
+
+    As the manifests were just written from the files on disk, hashing everything a second time
+    rarely tells us anything, so `validation` is one of:
+        'none': no validation
+        'fast': the bag's structure, that every file is present and that the Payload-Oxum matches
+        'complete': every file is hashed again and checked against the manifests
+    """
+    processes = processes or settings.BAG_PROCESSES
+    checksums = checksums or settings.BAG_CHECKSUMS
+    validation = validation or settings.BAG_VALIDATION
+
+    path = os.path.join(HERE, destination)
+    digests = get_sidecar(path)
 
-def bag_and_tag(xml_metadata, destination):
     with open(os.path.join(HERE, destination, 'datacite.xml'), 'w') as fp:
         fp.write(xml_metadata)
 
+    if digests:
+        digests.record_bytes(os.path.join(path, 'datacite.xml'), xml_metadata.encode())
+        bag = make_bag_from_digests(path, digests, checksums, processes)
+    else:
+        with bag_lock:
+            bag = bagit.make_bag(path, processes=processes, checksums=checksums)
+
+    if validation == 'complete':
+        bag.validate(processes=processes)
+    elif validation == 'fast':
+        bag.validate(fast=True)
+    elif validation != 'none':
+        raise ValueError(f'Unknown validation {validation}, expected none, fast or complete.')
+
+
+ZIP_COMPRESSION = {'store': zipfile.ZIP_STORED, 'deflate': zipfile.ZIP_DEFLATED}
+
+
+def bag_files(path: str) -> List[Tuple[str, str]]:
+    """
+    Every file in the bag with its name in the archive, tag files first.
+    """
+    return sorted(
+        (
+            (os.path.join(root, file), os.path.relpath(os.path.join(root, file), path))
+            for root, dirs, files in os.walk(path) for file in files
+        ),
+        key=lambda item: (item[1].startswith('data' + os.sep), item[1]),
+    )
+
+
+def zip_bag(destination, target=None, compression=None, level=None, workers=None):
+    """
+    Zips the bag in `destination` into `target`, which is a path, `destination` with .zip on the end
+    by default, or a writable stream. Members are compressed in parallel by `workers` threads and
+    ZIP64 is used when the bag needs it.
+    """
     path = os.path.join(HERE, destination)
-    bagit.make_bag(path)
+    target = target or path.rstrip(os.sep) + '.zip'
+    compression = ZIP_COMPRESSION[compression or settings.ZIP_COMPRESSION]
+    level = settings.ZIP_COMPRESSION_LEVEL if level is None else level
+    workers = workers or settings.ZIP_WORKERS
+
+    def write(fp):
+        with ZipWriter(fp, compression, level, workers, settings.ZIP_BLOCK_SIZE) as zip_file:
+            zip_file.write_files(bag_files(path))
 
-    bag = bagit.Bag(path)
-    assert bag.is_valid()
+    if isinstance(target, str):
+        with open(target, 'wb') as fp:
+            write(fp)
+    else:
+        write(target)
+    return target
 
 
-def zip_bag(destination):
+def upload_zip_bag(destination, bucket_name, filename, compression=None, level=None, workers=None):
+    """
+    Zips the bag in `destination` straight into a multipart upload to Internet Archive, so the zip
+    is never written to disk.
+    """
     path = os.path.join(HERE, destination)
-    with zipfile.ZipFile('bag.zip', 'w') as zip_file:
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                file_name = re.sub(f"^{path}", "", file_path)
-                zip_file.write(file_path, arcname=file_name)
+    # Compressing never makes a bag much bigger, so its size is a safe bound for the part size.
+    size = sum(os.path.getsize(location) for location, arcname in bag_files(path))
+    part_size = part_size_for(int(size * 1.05) + 1024 * 1024)
+    with MultipartUploadWriter(bucket_name, filename, part_size) as writer:
+        zip_bag(destination, writer, compression, level, workers)
 
 
-def main(guid, destination, zip=False):
+def main(
+        guid,
+        destination,
+        zip=False,
+        processes=None,
+        checksums=None,
+        validation=None,
+        zip_bucket=None):
     doi = build_doi(guid)
     xml_metadata = get_datacite_metadata(doi)
-    bag_and_tag(xml_metadata, destination)
+    bag_and_tag(xml_metadata, destination, processes, checksums, validation)
 
-    if zip:
+    if zip_bucket:
+        upload_zip_bag(destination, zip_bucket, f'{guid}.zip')
+    elif zip:
         zip_bag(destination)
 
 
@@ -72,8 +312,39 @@ if __name__ == '__main__':
         '--zip',
         help='A boolean representing if the bag is zipped.',
     )
+    parser.add_argument(
+        '-p',
+        '--processes',
+        help='How many processes compute checksums.',
+        type=int,
+    )
+    parser.add_argument(
+        '-c',
+        '--checksums',
+        help='The checksum algorithms of the manifests, e.g. sha256 sha512.',
+        nargs='+',
+    )
+    parser.add_argument(
+        '-v',
+        '--validation',
+        help='How thoroughly the new bag is validated: none, fast or complete.',
+        choices=('none', 'fast', 'complete'),
+    )
+    parser.add_argument(
+        '-b',
+        '--zip-bucket',
+        help='Zip the bag straight into this Internet Archive bucket instead of a local file.',
+    )
     args = parser.parse_args()
     guid = args.guid
     destination = args.destination
     zip = args.zip
-    main(guid, destination, zip)
+    main(
+        guid,
+        destination,
+        zip,
+        args.processes,
+        args.checksums,
+        args.validation,
+        args.zip_bucket,
+    )
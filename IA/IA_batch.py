@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+import settings
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Sequence
+from IA import (
+    IA_bag_and_tag,
+    IA_consume_files,
+    IA_consume_logs,
+    IA_upload,
+    IA_wiki_dump,
+)
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+STEPS = ('files', 'logs', 'wiki', 'bag', 'upload')
+
+
+def read_guids(guids: Iterable[str] = (), guid_file: str = None) -> List[str]:
+    '''
+    GUIDs from the command line and/or a file with one per line, in order, without duplicates.
+    Blank lines and lines starting with # are skipped.
+    '''
+    guids = list(guids)
+    if guid_file:
+        with open(guid_file, 'r') as fp:
+            guids += [line.strip() for line in fp]
+
+    return list(dict.fromkeys(
+        guid for guid in guids if guid and not guid.startswith('#')
+    ))
+
+
+def run_step(step: str, guid: str, directory: str, token: str, pagesize: int):
+    path = os.path.abspath(os.path.join(directory, guid))
+    if step == 'files':
+        IA_consume_files.main(guid, token, directory)
+    elif step == 'logs':
+        IA_consume_logs.main(guid, directory, pagesize, token)
+    elif step == 'wiki':
+        asyncio.run(IA_wiki_dump.main(guid, directory))
+    elif step == 'bag':
+        IA_bag_and_tag.main(guid, path)
+    elif step == 'upload':
+        bucket = settings.IA_BUCKET_FORMAT.format(guid=guid)
+        # Keys are relative to the bag, so the item has bagit.txt, data/... at its top.
+        asyncio.run(IA_upload.gather_and_upload(bucket, path, relative_to=path))
+    else:
+        raise ValueError(f'Unknown step {step}, expected one of {", ".join(STEPS)}.')
+
+
+def archive(
+        guid: str,
+        directory: str,
+        token: str = None,
+        pagesize: int = 100,
+        steps: Sequence[str] = STEPS) -> Dict:
+    '''
+    Runs the pipeline for a single GUID in `{directory}/{guid}`. Nothing is shared with other
+    GUIDs but the HTTP session, so any failure is caught and reported here rather than raised, and
+    the rest of the batch carries on.
+    '''
+    result = {'guid': guid, 'status': 'ok', 'completed': [], 'failed_step': None, 'error': None}
+    start = time.monotonic()
+
+    os.makedirs(os.path.join(directory, guid), exist_ok=True)
+    for step in steps:
+        try:
+            run_step(step, guid, directory, token, pagesize)
+        except Exception as e:
+            logger.exception(f'{guid} failed at {step}.')
+            result.update(status='failed', failed_step=step, error=repr(e))
+            break
+        result['completed'].append(step)
+
+    result['duration'] = round(time.monotonic() - start, 3)
+    return result
+
+
+def run_batch(
+        guids: Sequence[str],
+        directory: str,
+        token: str = None,
+        pagesize: int = 100,
+        steps: Sequence[str] = STEPS,
+        workers: int = None,
+        processes: bool = False) -> List[Dict]:
+    '''
+    Archives every GUID with at most `workers` of them in flight at once. Threads share one
+    connection pool and the downloads and uploads release the GIL, so they're the default;
+    `processes` runs each GUID in a worker process instead, for CPU heavy steps like bagging.
+    Results come back in the order of `guids`.
+    '''
+    workers = workers or settings.BATCH_WORKERS
+    # Other threads' relative paths would move whenever bagit changes directory.
+    directory = os.path.abspath(directory)
+    pool: Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+
+    with pool(max_workers=workers) as executor:
+        futures = [
+            executor.submit(archive, guid, directory, token, pagesize, tuple(steps))
+            for guid in guids
+        ]
+        return [future.result() for future in futures]
+
+
+def summarize(results: List[Dict]) -> str:
+    failed = [result for result in results if result['status'] != 'ok']
+    lines = [
+        f'{len(results) - len(failed)} of {len(results)} registrations archived, '
+        f'{len(failed)} failed, in {sum(result["duration"] for result in results):.1f}s '
+        f'of work.',
+    ]
+    for result in failed:
+        lines.append(f'  {result["guid"]}: {result["failed_step"]} failed with {result["error"]}')
+    return '\n'.join(lines)
+
+
+def main(
+        guids: Sequence[str],
+        directory: str,
+        token: str = None,
+        pagesize: int = 100,
+        steps: Sequence[str] = STEPS,
+        workers: int = None,
+        processes: bool = False,
+        report: str = None) -> List[Dict]:
+    unknown = set(steps) - set(STEPS)
+    if unknown:
+        raise ValueError(f'Unknown steps {", ".join(sorted(unknown))}.')
+
+    results = run_batch(guids, directory, token, pagesize, steps, workers, processes)
+
+    if report:
+        with open(report, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    print(summarize(results))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-g',
+        '--guids',
+        help='The GUIDs of the registrations to archive.',
+        nargs='*',
+        default=[],
+    )
+    parser.add_argument(
+        '-f',
+        '--guid-file',
+        help='A file of GUIDs to archive, one per line.',
+    )
+    parser.add_argument(
+        '-d',
+        '--directory',
+        help='This is the target Directory for the registrations, each gets its own folder',
+        default='.',
+    )
+    parser.add_argument(
+        '-t',
+        '--token',
+        help='This is the bearer token for auth.',
+    )
+    parser.add_argument(
+        '-p',
+        '--pagesize',
+        help='How many logs should appear per file? Default is 100',
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        '-s',
+        '--steps',
+        help=f'Which steps to run, in order. Default is all of {", ".join(STEPS)}.',
+        nargs='+',
+        choices=STEPS,
+        default=STEPS,
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='How many registrations to archive at once.',
+        type=int,
+    )
+    parser.add_argument(
+        '--processes',
+        help='Archive each registration in a worker process rather than a thread.',
+        action='store_true',
+    )
+    parser.add_argument(
+        '-r',
+        '--report',
+        help='Where to write a JSON report of how every registration went.',
+    )
+    args = parser.parse_args()
+
+    guids = read_guids(args.guids, args.guid_file)
+    if not guids:
+        parser.error('No GUIDs given, pass some with --guids or --guid-file.')
+
+    results = main(
+        guids,
+        args.directory,
+        args.token,
+        args.pagesize,
+        args.steps,
+        args.workers,
+        args.processes,
+        args.report,
+    )
+    if any(result['status'] != 'ok' for result in results):
+        exit(1)
@@ -4,16 +4,25 @@ import argparse
 import logging
 import settings
 from zipfile import ZipFile
+from IA.digests import get_sidecar
 from IA.utils import (
-    get_with_retry
+    download_to_file,
+    iter_download,
+)
+from IA.zip_stream import (
+    extract_parallel,
+    extract_stream,
+    UnsupportedZipStream,
 )
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-def main(guid, token, directory):
+def main(guid, token, directory, workers=None, stream=None):
     path = os.path.join(directory, guid)
+    # Files are hashed for the bag's manifests as they're extracted.
+    digests = get_sidecar(path)
 
     zip_url = f'{settings.OSF_API_URL}v1/resources/{guid}/providers/osfstorage/?zip='
 
@@ -34,18 +43,35 @@ def main(guid, token, directory):
     else:
         auth_header = {}
 
+    if settings.STREAM_EXTRACT if stream is None else stream:
+        try:
+            extract_stream(
+                iter_download(zip_url.format(guid), headers=auth_header),
+                path,
+                digests,
+            )
+            print('File data successfully transferred!')
+            return
+        except requests.exceptions.RequestException as e:
+            logging.log(logging.ERROR, 'HTTP Request failed: {}'.format(e))
+            raise
+        except UnsupportedZipStream as e:
+            logging.log(logging.WARNING, f'Can\'t unpack zip as it streams ({e}), downloading it.')
+
+    zipfile_location = os.path.join(path, f'{guid}.zip')
     try:
-        response = get_with_retry(zip_url.format(guid), headers=auth_header)
+        download_to_file(
+            zip_url.format(guid),
+            zipfile_location,
+            headers=auth_header,
+            workers=workers,
+        )
     except requests.exceptions.RequestException as e:
         logging.log(logging.ERROR, 'HTTP Request failed: {}'.format(e))
         raise
 
-    zipfile_location = os.path.join(path, f'{guid}.zip')
-    with open(zipfile_location, 'wb') as file:
-        file.write(response.content)
-
     with ZipFile(zipfile_location, 'r') as zipObj:
-        zipObj.extractall(path)
+        extract_parallel(zipObj, path, settings.EXTRACT_WORKERS, digests)
 
     os.remove(zipfile_location)
     print('File data successfully transferred!')
@@ -69,13 +95,28 @@ if __name__ == '__main__':
         '--token',
         help='This is the bearer token for auth. This is required'
     )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='How many byte ranges to download in parallel, if the server supports it.',
+        type=int,
+    )
+    parser.add_argument(
+        '-s',
+        '--stream',
+        help='Unpack the zip as it downloads instead of saving it to disk first.',
+        action='store_true',
+        default=None,
+    )
     args = parser.parse_args()
     guid = args.guid
     directory = args.directory
     token = args.token
+    workers = args.workers
+    stream = args.stream
 
     if not directory:
         # Setting default to current directory
         directory = '.'
 
-    main(guid, token, directory)
+    main(guid, token, directory, workers, stream)
@@ -1,79 +1,202 @@
 import os
 import argparse
-import json
+import functools
 import logging
-import time
 import requests
 import settings
+from concurrent.futures import ThreadPoolExecutor
+from IA.digests import get_sidecar, payload_directory
+from IA.json_backend import dumps, loads, split_data
+from IA.log_export import LOG_EXPORT_FORMATS, LogExport
+from IA.sync_state import get_sync_state
+from IA.utils import bounded_map, get_with_retry, iter_pages, page_count, page_url
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-def json_with_pagination(path, guid, page, url, token):
+def json_with_pagination(path, guid, page, url, token, digests=None, raw=False):
     # Get JSON of registration logs
-    response = make_json_api_request(url, token)
+    response = make_json_api_request(url, token, raw)
+    write_page(path, guid, page, response, digests)
+    return response
+
 
+def write_page(path, guid, page, response, digests=None):
     # Craft filename based on page number
     json_filename = guid + '-' + str(page) + '.json'
     file_location = os.path.join(path, json_filename)
+    # Raw data is written as the API sent it, rather than being encoded again
     json_data = response['data']
-    with open(file_location, 'w') as file:
-        json.dump(json_data, file)
-    return response
+    if not isinstance(json_data, bytes):
+        json_data = dumps(json_data)
+    with open(file_location, 'wb') as file:
+        file.write(json_data)
+    if digests:
+        digests.record_bytes(file_location, json_data)
+
 
+def make_json_api_request(url, token, raw=False):
+    auth_header = {'Authorization': f'Bearer {token}'}
 
-def make_json_api_request(url, token):
-    auth_header = {'Authorizataion': f'Bearer {token}'}
-    keep_trying = True
-    response = None
-
-    while keep_trying:
-        keep_trying = False
-        try:
-            response = requests.get(url, headers=auth_header)
-            if response.status_code == 429:
-                keep_trying = True
-                response_headers = response.headers
-                wait_time = response_headers['Retry-After']
-                logging.log(logging.INFO, 'Throttled: retrying in {wait_time}s')
-                time.sleep(int(wait_time))
-            elif response.status_code >= 400:
-                status_code = response.status_code
-                content = getattr(response, 'content', None)
-                raise requests.exceptions.HTTPError(
-                    'Status code {}. {}'.format(status_code, content))
-        except requests.exceptions.RequestException as e:
-            logging.log(logging.ERROR, 'HTTP Request failed: {}'.format(e))
-            raise
     try:
-        return response.json()
-    except json.decoder.JSONDecodeError:
+        # Throttled requests wait out Retry-After, with every other request to OSF held too
+        response = get_with_retry(url, retry_on=(429,), headers=auth_header)
+        if response.status_code >= 400:
+            status_code = response.status_code
+            content = getattr(response, 'content', None)
+            raise requests.exceptions.HTTPError(
+                'Status code {}. {}'.format(status_code, content))
+    except requests.exceptions.RequestException as e:
+        logging.log(logging.ERROR, 'HTTP Request failed: {}'.format(e))
+        raise
+    try:
+        return split_data(response.content) if raw else loads(response.content)
+    except ValueError:
         return None
 
 
-def main(guid, directory, pagesize, bearer_token):
+def sync_logs(path, guid, url, token, state, digests=None, export=None):
+    """
+    Fetches only the logs made since the last sync and writes them after the pages already there,
+    so the export grows with the registration instead of being fetched again in full. The logs at
+    the last date seen are asked for again, and dropped, so none sharing that date are missed.
+    Pages are written as their own files, or appended to `export` if there is one.
+    """
+    write = export.write_page if export else functools.partial(
+        write_page,
+        path,
+        guid,
+        digests=digests,
+    )
+    since = state.logs_since
+    if since:
+        url = f'{url}&filter[date][gte]={since}'
+
+    # Logs come newest first, so the state only takes the newest of them once they're all written,
+    # or every page after the first would look older than what's been synced.
+    first_page = page_num = state.log_pages
+    newest = []
+    pages = iter_pages(url, fetch=lambda next_url: make_json_api_request(next_url, token))
+    for response in pages:
+        logs = [log for log in response['data'] if state.is_new_log(log)]
+        if logs:
+            page_num += 1
+            write(page_num, {'data': logs})
+            last_date = max(log['attributes']['date'] for log in newest + logs)
+            newest = [log for log in newest + logs if log['attributes']['date'] == last_date]
+    state.logs_written(newest, page_num)
+    if export:
+        # Its size only counts once it's closed, with everything flushed to disk.
+        export.close()
+        state.export_written(os.path.getsize(export.location))
+    state.save()
+    logger.info(f'{page_num - first_page} pages of new logs written for {guid}.')
+
+
+def main(
+        guid,
+        directory,
+        pagesize,
+        bearer_token,
+        workers=None,
+        incremental=False,
+        export_format=None,
+        raw=None):
 
     # Creating directories
     path = os.path.join(directory, guid)
     if not os.path.exists(path):
         os.mkdir(path)
+    if incremental:
+        # Once it's bagged, new logs go into the bag's data/ after the ones already there
+        path = payload_directory(path)
     path = os.path.join(path, 'logs')
     try:
         os.mkdir(path)
     except FileExistsError:
         pass
 
-    # Retrieving page 1
     url = settings.OSF_API_URL + settings.OSF_LOGS_URL.format(guid, pagesize)
-    response = json_with_pagination(path, guid, 1, url, bearer_token)
-    page_num = 2
+    digests = get_sidecar(os.path.join(directory, guid))
+
+    export_format = export_format or settings.LOG_EXPORT_FORMAT
+    if export_format not in LOG_EXPORT_FORMATS:
+        raise ValueError(
+            f'Unknown log export format {export_format}, '
+            f'expected one of {", ".join(LOG_EXPORT_FORMATS)}.',
+        )
+    raw = settings.LOG_RAW_DATA if raw is None else raw
+    state = get_sync_state(os.path.join(directory, guid)) if incremental else None
+    export = None
+    write = functools.partial(write_page, path, guid, digests=digests)
+    if export_format != 'pages':
+        # Every page goes into the one file, so they're written in order from this thread.
+        location = os.path.join(path, f'{guid}.{export_format}')
+        if incremental:
+            # Syncs add their logs to the export. Anything past what the last one that finished
+            # wrote is from a run that failed, and will be fetched again.
+            export = LogExport(location, digests, 'a', truncate_to=state.export_size)
+        else:
+            export = LogExport(location, digests)
+        write = export.write_page
 
-    # Retrieve the rest of the pages (if applicable)
-    while response['links']['next']:
-        next_link = response['links']['next']
-        response = json_with_pagination(path, guid, page_num, next_link, bearer_token)
-        page_num = page_num + 1
+    try:
+        if incremental:
+            sync_logs(path, guid, url, bearer_token, state, digests, export)
+        elif workers and workers > 1 and not export:
+            # Page 1 says how many pages there are, so the rest can be fetched side by side
+            response = json_with_pagination(path, guid, 1, url, bearer_token, digests, raw)
+            if response['links']['next']:
+                # Each page is written by the thread that fetched it, and dropped once it's done
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    pages = bounded_map(
+                        executor,
+                        lambda page: json_with_pagination(
+                            path,
+                            guid,
+                            page,
+                            page_url(url, page),
+                            bearer_token,
+                            digests,
+                            raw,
+                        ),
+                        range(2, page_count(response) + 1),
+                        workers * 2,
+                    )
+                    for _ in pages:
+                        pass
+        elif workers and workers > 1:
+            response = make_json_api_request(url, bearer_token)
+            write(1, response)
+            if response['links']['next']:
+                # Only a few pages are fetched ahead of the one being written, so the ones waiting
+                # on a slow page don't pile up
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    pages = bounded_map(
+                        executor,
+                        lambda page: make_json_api_request(page_url(url, page), bearer_token),
+                        range(2, page_count(response) + 1),
+                        workers * 2,
+                    )
+                    for page_num, response in enumerate(pages, 2):
+                        write(page_num, response)
+        else:
+            # Pages are fetched in the background while earlier ones are written. Only pages
+            # written to files of their own can keep their data raw.
+            pages = iter_pages(
+                url,
+                fetch=lambda next_url: make_json_api_request(
+                    next_url,
+                    bearer_token,
+                    raw and not export,
+                ),
+            )
+            for page_num, response in enumerate(pages, 1):
+                write(page_num, response)
+    finally:
+        if export:
+            export.close()
 
     print('Log data successfully transferred!')
 
@@ -104,11 +227,42 @@ if __name__ == '__main__':
         help='How many logs should appear per file? Default is 100'
     )
 
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='How many pages to fetch at once. Default is one at a time, following links.',
+        type=int,
+    )
+
+    parser.add_argument(
+        '-f',
+        '--format',
+        help='pages writes a JSON file per page, the ndjson formats put every log in one file.',
+        choices=LOG_EXPORT_FORMATS,
+    )
+
+    parser.add_argument(
+        '-r',
+        '--raw',
+        help='Write each page\'s data as the API sent it, rather than decoding and encoding it. '
+             'Only the json backend does, the others are faster without.',
+        action='store_true',
+        default=None,
+    )
+
+    parser.add_argument(
+        '-i',
+        '--incremental',
+        help='Only fetch logs made since the last incremental run, adding them as new pages.',
+        action='store_true',
+    )
+
     args = parser.parse_args()
     guid = args.guid
     directory = args.directory
     pagesize = args.pagesize
     bearer_token = args.token
+    workers = args.workers
 
     # Args handling
     if not directory:
@@ -117,5 +271,13 @@ if __name__ == '__main__':
     if not pagesize:
         pagesize = 100
 
-    main(guid, directory, pagesize, bearer_token)
-
+    main(
+        guid,
+        directory,
+        pagesize,
+        bearer_token,
+        workers,
+        args.incremental,
+        args.format,
+        args.raw,
+    )
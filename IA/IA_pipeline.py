@@ -0,0 +1,172 @@
+import os
+import time
+import asyncio
+import logging
+import argparse
+import settings
+from concurrent.futures import ThreadPoolExecutor
+from typing import Set
+from IA import IA_consume_files, IA_consume_logs, IA_wiki_dump
+from IA.IA_bag_and_tag import bag_and_tag, build_doi, get_datacite_metadata
+from IA.IA_upload import upload_file
+from IA.upload_journal import UploadJournal
+from IA.utils import HostLimiter, run_blocking
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# bagit moves the payload into data/, so that's where fetched files are uploaded to from the start.
+PAYLOAD_DIRECTORY = 'data'
+
+
+async def archive(
+        guid: str,
+        directory: str,
+        token: str = None,
+        pagesize: int = 100,
+        concurrency: int = None,
+        queue_size: int = None):
+    '''
+    Archives one registration with every stage overlapped: files, logs, wiki and DataCite metadata
+    are fetched at the same time, and whatever a fetcher has finished goes onto a bounded queue that
+    a pool of uploaders drains while the others are still downloading. Once everything is fetched
+    and uploaded the directory is bagged and the bag's own files go up last.
+
+    Files are uploaded under the keys they'll have in the bag, so the bucket ends up holding the
+    same bag the scripts run one after the other would.
+    '''
+    start = time.monotonic()
+    directory = os.path.abspath(directory)
+    path = os.path.join(directory, guid)
+    os.makedirs(path, exist_ok=True)
+
+    bucket = settings.IA_BUCKET_FORMAT.format(guid=guid)
+    concurrency = concurrency or settings.IA_MAX_CONCURRENCY
+    queue = asyncio.Queue(maxsize=queue_size or settings.PIPELINE_QUEUE_SIZE)
+    limiter = HostLimiter(concurrency)
+    open_files = asyncio.Semaphore(concurrency)
+    journal = UploadJournal.for_directory(path) if settings.UPLOAD_JOURNAL else None
+    queued: Set[str] = set()
+    errors = []
+
+    # Fetchers and uploads each get their own threads, so a slow download never holds up an upload.
+    fetch_executor = ThreadPoolExecutor(max_workers=4)
+    upload_executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def enqueue(root: str, prefix: str = ''):
+        for dirpath, dirs, files in os.walk(root):
+            for file in files:
+                file_path = os.path.join(dirpath, file)
+                key = os.path.join(prefix, os.path.relpath(file_path, path))
+                if key not in queued:
+                    queued.add(key)
+                    await queue.put((file_path, key))
+
+    async def uploader():
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                file_path, key = item
+                await upload_file(
+                    bucket,
+                    file_path,
+                    open_files,
+                    limiter=limiter,
+                    executor=upload_executor,
+                    journal=journal,
+                    key=key,
+                )
+            except Exception as e:
+                # Keep draining the queue, or the fetchers would block on it forever.
+                logger.exception(f'Upload of {item[1]} to {bucket} failed.')
+                errors.append(e)
+            finally:
+                queue.task_done()
+
+    async def fetch(name: str, func, *args):
+        stage_start = time.monotonic()
+        await run_blocking(func, *args, executor=fetch_executor)
+        logger.info(f'{guid} {name} fetched in {time.monotonic() - stage_start:.2f}s.')
+        await enqueue(os.path.join(path, name), PAYLOAD_DIRECTORY)
+
+    uploaders = [asyncio.ensure_future(uploader()) for _ in range(concurrency)]
+    try:
+        *_, xml_metadata = await asyncio.gather(
+            fetch('files', IA_consume_files.main, guid, token, directory),
+            fetch('logs', IA_consume_logs.main, guid, directory, pagesize, token),
+            fetch('wiki', lambda: asyncio.run(IA_wiki_dump.main(guid, directory))),
+            run_blocking(get_datacite_metadata, build_doi(guid), executor=fetch_executor),
+        )
+
+        # bagit moves files as it bags, so everything queued has to be uploaded first.
+        await queue.join()
+        if errors:
+            raise errors[0]
+
+        await run_blocking(bag_and_tag, xml_metadata, path, executor=fetch_executor)
+        await enqueue(path)
+        await queue.join()
+        if errors:
+            raise errors[0]
+    finally:
+        for _ in uploaders:
+            await queue.put(None)
+        await asyncio.gather(*uploaders)
+        fetch_executor.shutdown()
+        upload_executor.shutdown()
+
+    logger.info(f'{guid} archived to {bucket} in {time.monotonic() - start:.2f}s.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-g',
+        '--guid',
+        help='This is the GUID of the registration to archive',
+        required=True,
+    )
+    parser.add_argument(
+        '-d',
+        '--directory',
+        help='This is the target Directory for the registration',
+        default='.',
+    )
+    parser.add_argument(
+        '-t',
+        '--token',
+        help='This is the bearer token for auth.',
+    )
+    parser.add_argument(
+        '-p',
+        '--pagesize',
+        help='How many logs should appear per file? Default is 100',
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        '-c',
+        '--concurrency',
+        help='The most uploads in flight to Internet Archive at once.',
+        type=int,
+    )
+    parser.add_argument(
+        '-q',
+        '--queue-size',
+        help='How many fetched files can wait for an uploader before the fetchers hold off.',
+        type=int,
+    )
+    args = parser.parse_args()
+
+    asyncio.run(
+        archive(
+            args.guid,
+            args.directory,
+            args.token,
+            args.pagesize,
+            args.concurrency,
+            args.queue_size,
+        ),
+    )
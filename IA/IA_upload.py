@@ -1,21 +1,46 @@
+import io
 import os
+import math
+import mmap
+import logging
 import argparse
 import requests
-import boto
-from boto.s3.connection import OrdinaryCallingFormat
+import threading
+from boto.exception import S3ResponseError
 from boto.s3.multipart import MultiPartUpload
 import asyncio
 import xmltodict
-from io import BytesIO
-from IA.utils import put_with_retry
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import BinaryIO, Dict, Optional, Tuple, Union
+from IA.digests import DigestSidecar, get_sidecar
+from IA.upload_journal import UploadJournal
+from IA.utils import (
+    HostLimiter,
+    RetryPolicy,
+    file_md5,
+    get_rate_limiter,
+    get_s3_connection,
+    multipart_etag,
+    put_with_retry,
+    run_blocking,
+)
 from settings import (
     CHUNK_SIZE,
+    IA_MAX_CONCURRENCY,
+    IA_MAX_PART_CONCURRENCY,
+    MAX_PART_SIZE,
+    MAX_PARTS,
+    MIN_PART_SIZE,
     OSF_COLLECTION_NAME,
+    UPLOAD_JOURNAL,
+    UPLOAD_SKIP_UNCHANGED,
     IA_ACCESS_KEY,
     IA_SECRET_KEY,
     IA_URL
 )
 
+logger = logging.getLogger(__name__)
+
 HERE = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -26,28 +51,194 @@ def mp_from_ids(mp_id: str, mp_keyname: str, bucket: str) -> MultiPartUpload:
     return mp
 
 
-async def gather_and_upload(bucket_name: str, parent: str):
+async def gather_and_upload(
+        bucket_name: str,
+        parent: str,
+        concurrency: int = None,
+        part_concurrency: int = None,
+        journal: bool = None,
+        skip_unchanged: bool = None,
+        relative_to: str = None):
     '''
     This script traverses through a directory uploading everything in it to Internet Archive.
+    Files are only opened once their upload starts and are streamed from disk from there, so
+    nothing is read into memory up front. The blocking requests run on a pool of threads, with at
+    most `concurrency` of them in flight to a host and at most `part_concurrency` parts of any one
+    file. Unless `journal` is off, progress is recorded next to `parent` so a rerun skips finished
+    files and resumes interrupted multipart uploads. With `skip_unchanged`, the bucket is listed
+    first and files it already has the same bytes of aren't sent again. With `relative_to`, files
+    are uploaded under their paths relative to it, e.g. data/datacite.xml for a bag, rather than
+    under their paths on disk.
     '''
+    concurrency = concurrency or IA_MAX_CONCURRENCY
+    part_concurrency = part_concurrency or IA_MAX_PART_CONCURRENCY
+    limiter = HostLimiter(concurrency)
+    open_files = asyncio.Semaphore(concurrency)
+    upload_journal = None
+    if UPLOAD_JOURNAL if journal is None else journal:
+        upload_journal = UploadJournal.for_directory(parent)
+
+    remote = md5s = None
+    if UPLOAD_SKIP_UNCHANGED if skip_unchanged is None else skip_unchanged:
+        remote = await run_blocking(list_bucket, bucket_name)
+        md5s = sidecar_md5s(parent)
 
     tasks = []
 
-    for root, dirs, files in os.walk(parent):
-        for file in files:
-            path = os.path.join(root, file)
-            with open(path, 'rb') as fp:
-                data = fp.read()
-                size = len(data)
-                if size > CHUNK_SIZE:
-                    tasks.append(chunked_upload(bucket_name, path, data))
-                else:
-                    tasks.append(upload(bucket_name, path, data))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for root, dirs, files in os.walk(parent):
+            for file in files:
+                path = os.path.join(root, file)
+                tasks.append(
+                    upload_file(
+                        bucket_name,
+                        path,
+                        open_files,
+                        limiter=limiter,
+                        executor=executor,
+                        part_concurrency=part_concurrency,
+                        journal=upload_journal,
+                        key=relative_to and os.path.relpath(path, relative_to),
+                        remote=remote,
+                        md5=md5s and md5s.get(os.path.abspath(path)),
+                    ),
+                )
+
+        await asyncio.gather(*tasks)
+
+
+def list_bucket(bucket_name: str) -> Dict[str, Dict]:
+    '''
+    The size and ETag of every file in the bucket, by key, or nothing if there's no bucket yet.
+    '''
+    def list_keys():
+        bucket = get_bucket(bucket_name)
+        if bucket is None:
+            return {}
+        return {
+            key.name: {'size': key.size, 'etag': key.etag.strip('"')}
+            for key in bucket.list()
+        }
+
+    return RetryPolicy(retry_on=(429,)).run(list_keys, description=f'list {bucket_name}')
+
+
+def sidecar_md5s(parent: str) -> Dict[str, str]:
+    '''
+    md5s from the digest sidecar of the files under `parent` that haven't changed since they were
+    hashed, by absolute path, so they needn't be read again to be compared with the bucket's. The
+    sidecar only has them when BAG_CHECKSUMS includes md5.
+    '''
+    sidecar = get_sidecar(parent)
+    if sidecar is None:
+        return {}
+
+    # Once bagged, the sidecar's paths are relative to the payload.
+    root = sidecar.directory
+    if os.path.exists(os.path.join(root, 'bagit.txt')):
+        root = os.path.join(root, 'data')
 
-    await asyncio.gather(*tasks)
+    md5s = {}
+    for path, entry in sidecar.load().items():
+        location = os.path.join(root, path)
+        try:
+            stat = os.stat(location)
+        except OSError:
+            continue
+        if DigestSidecar.matches(entry, stat, ['md5']):
+            md5s[location] = entry['md5']
+    return md5s
 
 
-async def upload(bucket_name: str, filename: str, file_content: bytes):
+def is_unchanged(remote: Optional[Dict], fp: BinaryIO, size: int, md5: str) -> bool:
+    '''
+    Whether the bucket's copy of a file, as listed by list_bucket, has the same bytes as `fp`. A
+    multipart upload's ETag isn't an md5 of the file, so it's recomputed from the file's parts.
+    '''
+    if not remote or remote['size'] != size:
+        return False
+
+    etag = remote['etag']
+    if '-' not in etag:
+        return etag == md5
+
+    parts = int(etag.split('-')[1])
+    part_size = part_size_for(size)
+    if math.ceil(size / part_size) != parts:
+        return False
+    return multipart_etag(fp, part_size) == etag
+
+
+async def upload_file(
+        bucket_name: str,
+        path: str,
+        open_files: asyncio.Semaphore,
+        limiter: HostLimiter = None,
+        executor: Executor = None,
+        part_concurrency: int = None,
+        journal: UploadJournal = None,
+        key: str = None,
+        remote: Dict[str, Dict] = None,
+        md5: str = None):
+    '''
+    Uploads the file at `path` as `key`, which defaults to the path itself. It's skipped if
+    `remote`, a listing of the bucket, shows the bucket already has it. `md5` saves reading the
+    file to hash it when it's already known. Otherwise it's only hashed to compare with the bucket
+    or to confirm a file the journal has at the same size and mtime.
+    '''
+    key = key or path
+    async with open_files:
+        with open(path, 'rb') as fp:
+            stat = os.fstat(fp.fileno())
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+            recorded = journal and journal.recorded_md5(key, size, mtime_ns)
+            if (recorded or remote is not None) and not md5:
+                md5 = await run_blocking(file_md5, fp, executor=executor)
+
+            if journal and journal.is_uploaded(key, size, mtime_ns, md5):
+                logger.info(f'Skipping {path}, the journal has it as already uploaded.')
+                return
+
+            # Keys are sent as part of the URL path, so the bucket lists them without a leading /.
+            listed = remote and remote.get(key.lstrip('/'))
+            unchanged = listed and await run_blocking(
+                is_unchanged,
+                listed,
+                fp,
+                size,
+                md5,
+                executor=executor,
+            )
+            if unchanged:
+                logger.info(f'Skipping {path}, {bucket_name} already has it.')
+                if journal:
+                    journal.finish(key, size, mtime_ns, md5)
+                return
+
+            if size > CHUNK_SIZE:
+                await chunked_upload(
+                    bucket_name,
+                    key,
+                    fp,
+                    limiter=limiter,
+                    executor=executor,
+                    part_concurrency=part_concurrency,
+                    journal=journal,
+                    md5=md5,
+                )
+            else:
+                await upload(bucket_name, key, fp, limiter=limiter, executor=executor)
+
+            if journal:
+                journal.finish(key, size, mtime_ns, md5)
+
+
+async def upload(
+        bucket_name: str,
+        filename: str,
+        file_content: Union[bytes, BinaryIO],
+        limiter: HostLimiter = None,
+        executor: Executor = None):
     headers = {
         'authorization': 'LOW {}:{}'.format(IA_ACCESS_KEY, IA_SECRET_KEY),
         'x-amz-auto-make-bucket': '1',
@@ -55,33 +246,282 @@ async def upload(bucket_name: str, filename: str, file_content: bytes):
         'x-archive-meta01-collection': OSF_COLLECTION_NAME,
     }
     url = f'{IA_URL}/{bucket_name}/{filename}'
-    resp = put_with_retry(url, headers=headers, data=file_content, retry_on=(429, 503))
+    limiter = limiter or HostLimiter(IA_MAX_CONCURRENCY)
+
+    async with limiter(url):
+        resp = await run_blocking(
+            put_with_retry,
+            url,
+            headers=headers,
+            data=file_content,
+            retry_on=(429, 503),
+            executor=executor,
+        )
 
     if resp.status_code != 200:
         error_json = dict(xmltodict.parse(resp.content))
         raise requests.exceptions.HTTPError(error_json)
 
 
-async def chunked_upload(bucket_name: str, filename: str, file_content: bytes):
-    conn = boto.connect_s3(
-        IA_ACCESS_KEY,
-        IA_SECRET_KEY,
-        host=f'{IA_URL}',
-        is_secure=False,
-        calling_format=OrdinaryCallingFormat(),
+class MemoryViewReader(io.RawIOBase):
+    '''
+    A seekable, read-only file over a memoryview, so boto can send a slice of an mmap'd file
+    without the part ever being copied into a bytes object.
+    '''
+
+    def __init__(self, view: memoryview):
+        self.view = view
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = max(0, min(len(buffer), len(self.view) - self.position))
+        buffer[:size] = self.view[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+
+def part_size_for(file_size: int) -> int:
+    '''
+    Picks the part size for a multipart upload, CHUNK_SIZE unless that would need more than
+    MAX_PARTS parts, and never below MIN_PART_SIZE, S3's minimum for every part but the last.
+    '''
+    part_size = max(CHUNK_SIZE, MIN_PART_SIZE, math.ceil(file_size / MAX_PARTS))
+    if part_size > MAX_PART_SIZE:
+        raise ValueError(f'A {file_size} byte file is too big for a multipart upload.')
+    return part_size
+
+
+def upload_part(mp: MultiPartUpload, part: memoryview, part_num: int) -> str:
+    def send():
+        # boto doesn't go through the shared session, so each attempt takes its turn here.
+        get_rate_limiter(IA_URL).acquire()
+        # Pages of the part are only read from disk as boto sends them.
+        with MemoryViewReader(part) as fp:
+            return mp.upload_part_from_file(fp, part_num).etag
+
+    try:
+        return RetryPolicy(retry_on=(429,)).run(send, description=f'{mp.key_name} part {part_num}')
+    finally:
+        # The mmap can only be closed once every slice of it has been released.
+        part.release()
+
+
+def get_bucket(bucket_name: str):
+    return get_s3_connection().lookup(bucket_name)
+
+
+def initiate_multipart_upload(bucket_name: str, filename: str) -> MultiPartUpload:
+    return RetryPolicy(retry_on=(429,)).run(
+        lambda: get_bucket(bucket_name).initiate_multipart_upload(filename),
+        description=f'{filename} initiate multipart upload',
+        idempotent=False,
     )
-    bucket = conn.lookup(bucket_name)
-    mp = bucket.initiate_multipart_upload(filename)
 
-    tasks = []
-    chunks = [file_content[i:i + CHUNK_SIZE] for i in range(0, len(file_content), CHUNK_SIZE)]
 
-    for i, chunk in enumerate(chunks):
-        mp = mp_from_ids(mp.id, filename, bucket)
-        upload_part_from_file = asyncio.coroutine(mp.upload_part_from_file)
-        tasks.append(asyncio.ensure_future(upload_part_from_file(BytesIO(chunk), i + 1)))
+def complete_multipart_upload(mp: MultiPartUpload):
+    RetryPolicy(retry_on=(429,)).run(
+        mp.complete_upload,
+        description=f'{mp.key_name} complete multipart upload',
+    )
+
+
+def resume_multipart_upload(
+        bucket_name: str,
+        filename: str,
+        upload_id: str) -> Tuple[MultiPartUpload, Dict[int, str]]:
+    '''
+    Returns the multipart upload along with the ETags of the parts IA already has for it.
+    '''
+    mp = mp_from_ids(upload_id, filename, get_bucket(bucket_name))
+    return mp, {part.part_number: part.etag for part in mp}
+
+
+class MultipartUploadWriter:
+    '''
+    A write-only stream into a multipart upload. Each part is sent as soon as `part_size` bytes of
+    it have been written, with up to `part_concurrency` parts in flight, and writes block once that
+    many are, so something like a zip can be uploaded as it's made without ever being on disk in
+    full. Closing it completes the upload and abort() cancels it. Used as a context manager, it's
+    only completed if the block finishes without an exception.
+    '''
+
+    def __init__(
+            self,
+            bucket_name: str,
+            filename: str,
+            part_size: int,
+            part_concurrency: int = None):
+        part_concurrency = part_concurrency or IA_MAX_PART_CONCURRENCY
+        self.mp = initiate_multipart_upload(bucket_name, filename)
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.part_num = 0
+        self.in_flight = threading.BoundedSemaphore(part_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=part_concurrency)
+        self.futures = []
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._send(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def _send(self, part: bytes):
+        self.in_flight.acquire()
+        failed = [future for future in self.futures if future.done() and future.exception()]
+        if failed:
+            self.in_flight.release()
+            self.abort()
+            raise failed[0].exception()
+
+        self.part_num += 1
+        future = self.executor.submit(upload_part, self.mp, memoryview(part), self.part_num)
+        future.add_done_callback(lambda future: self.in_flight.release())
+        self.futures.append(future)
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.executor.shutdown()
+        self.mp.cancel_upload()
 
-    await asyncio.gather(*tasks)
+    def close(self):
+        if self.closed:
+            return
+        try:
+            # An upload needs at least one part, even if it's empty.
+            if self.buffer or not self.part_num:
+                self._send(bytes(self.buffer))
+                self.buffer = bytearray()
+            for future in self.futures:
+                future.result()
+            complete_multipart_upload(self.mp)
+        except Exception:
+            self.abort()
+            raise
+        self.closed = True
+        self.executor.shutdown()
+
+
+async def chunked_upload(
+        bucket_name: str,
+        filename: str,
+        file_content: BinaryIO,
+        limiter: HostLimiter = None,
+        executor: Executor = None,
+        part_concurrency: int = None,
+        journal: UploadJournal = None,
+        md5: str = None):
+    '''
+    Uploads a file as one multipart upload, sending up to `part_concurrency` parts at once as
+    zero-copy slices of the mmap'd file. The upload is completed once every part is in. If any part
+    fails, the upload is cancelled, unless there is a journal, in which case it's left open for the
+    next run to resume, skipping the parts both IA and the journal have.
+    '''
+    limiter = limiter or HostLimiter(IA_MAX_CONCURRENCY)
+    host_limit = limiter(IA_URL)
+    part_limit = asyncio.Semaphore(part_concurrency or IA_MAX_PART_CONCURRENCY)
+    stat = os.fstat(file_content.fileno())
+    size, mtime_ns = stat.st_size, stat.st_mtime_ns
+    part_size = part_size_for(size)
+
+    mp = None
+    done = {}
+    pending = journal and journal.pending_upload(filename, size, mtime_ns, md5, part_size)
+    if pending:
+        try:
+            async with host_limit:
+                mp, uploaded = await run_blocking(
+                    resume_multipart_upload,
+                    bucket_name,
+                    filename,
+                    pending['upload_id'],
+                    executor=executor,
+                )
+            done = {
+                part_num: etag for part_num, etag in pending['parts'].items()
+                if uploaded.get(part_num) == etag
+            }
+            logger.info(f'Resuming upload of {filename}, {len(done)} parts already uploaded.')
+        except S3ResponseError as e:
+            logger.info(f'Can\'t resume upload of {filename} ({e}), starting over.')
+            mp = None
+
+    if mp is None:
+        async with host_limit:
+            mp = await run_blocking(
+                initiate_multipart_upload,
+                bucket_name,
+                filename,
+                executor=executor,
+            )
+        if journal:
+            journal.start(filename, mp.id, size, mtime_ns, md5, part_size)
+
+    async def send_part(view: memoryview, part_num: int, offset: int):
+        if part_num in done:
+            return
+        async with part_limit, host_limit:
+            etag = await run_blocking(
+                upload_part,
+                mp,
+                view[offset:offset + part_size],
+                part_num,
+                executor=executor,
+            )
+        if journal:
+            journal.part_done(filename, mp.id, part_num, etag)
+
+    with mmap.mmap(file_content.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            # Every part has to finish with its slice before the mmap can be closed, so failures
+            # are collected rather than raised straight away.
+            results = await asyncio.gather(
+                *[
+                    send_part(view, part_num + 1, offset)
+                    for part_num, offset in enumerate(range(0, size, part_size))
+                ],
+                return_exceptions=True,
+            )
+
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        if not journal:
+            async with host_limit:
+                await run_blocking(mp.cancel_upload, executor=executor)
+        raise errors[0]
+
+    async with host_limit:
+        await run_blocking(complete_multipart_upload, mp, executor=executor)
 
 
 if __name__ == '__main__':
@@ -98,8 +538,48 @@ if __name__ == '__main__':
         help='The name of the folder you want to dump.',
         required=True,
     )
+    parser.add_argument(
+        '-c',
+        '--concurrency',
+        help='The most requests in flight to Internet Archive at once.',
+        type=int,
+    )
+    parser.add_argument(
+        '-p',
+        '--part-concurrency',
+        help='The most parts of a single file uploaded at once.',
+        type=int,
+    )
+    parser.add_argument(
+        '--no-journal',
+        help='Don\'t record progress, so every file is uploaded from scratch.',
+        action='store_false',
+        dest='journal',
+        default=None,
+    )
+    parser.add_argument(
+        '--skip-unchanged',
+        help='List the bucket first and only upload files that are new or have changed.',
+        action='store_true',
+        default=None,
+    )
+    parser.add_argument(
+        '-r',
+        '--relative-to',
+        help='Upload files under their paths relative to this directory, instead of as given.',
+    )
     args = parser.parse_args()
     bucket = args.bucket
     source = args.source
 
-    asyncio.run(gather_and_upload(bucket, source))
+    asyncio.run(
+        gather_and_upload(
+            bucket,
+            source,
+            args.concurrency,
+            args.part_concurrency,
+            args.journal,
+            args.skip_unchanged,
+            args.relative_to,
+        ),
+    )
@@ -1,23 +1,44 @@
 import os
+import re
 import asyncio
 import argparse
-from settings import OSF_API_URL
+from concurrent.futures import ThreadPoolExecutor
+from settings import OSF_API_URL, OSF_MAX_CONCURRENCY
+from IA.digests import get_sidecar, payload_directory
+from IA.sync_state import get_sync_state
 from IA.utils import (
-    get_with_retry,
-    get_paginated_data,
+    aiter_records,
+    iter_download,
+    run_blocking,
 )
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 
 
-async def write_wiki_content(page):
-    resp = get_with_retry(page['links']['download'], retry_on=(429,))
+def wiki_filename(page):
+    """
+    `{name}.md`, with anything in the name that would make it a path instead replaced.
+    """
+    name = re.sub(r'[/\\\x00]', '_', page['attributes']['name'])
+    return f'{name}.md'
 
-    with open(os.path.join(HERE, f'/{page["attributes"]["name"]}.md'), 'wb') as fp:
-        fp.write(resp.content)
+
+def write_wiki_content(page, path, digests=None):
+    """
+    Streams the page's content to `{path}/{name}.md` a chunk at a time, hashing it on the way.
+    """
+    location = os.path.join(path, wiki_filename(page))
+    hasher = digests.hasher() if digests else None
+    with open(location, 'wb') as fp:
+        for chunk in iter_download(page['links']['download'], retry_on=(429,)):
+            fp.write(chunk)
+            if hasher:
+                hasher.update(chunk)
+    if digests:
+        digests.record(location, hasher)
 
 
-async def main(guid):
+async def main(guid, directory='.', destination=None, concurrency=None, incremental=False):
     """
     Usually asynchronous requests/writes are reserved for times when it's truely necessary, but
     given the fact that we have like 4 days left in the sprint and this going to be the first
@@ -26,17 +47,65 @@ async def main(guid):
     files simultaneously just because it's easy to do with py3 and will save a nano-second or two.
 
     :param guid:
+    :param directory: pages are written to `{directory}/{guid}/wiki/`, or its `data/wiki/` when
+        it's been bagged and the dump is incremental
+    :param destination: where to write the pages instead, they're left out of the digest sidecar
+    :param concurrency: the most pages downloaded at once
+    :param incremental: only download pages whose `date_modified` or version changed since the last
+        incremental run
     :return:
     """
+    path = destination or os.path.join(directory, guid, 'wiki')
+    if incremental and not destination:
+        # Once it's bagged, changed pages replace the ones in the bag's data/.
+        path = os.path.join(payload_directory(os.path.join(directory, guid)), 'wiki')
+    os.makedirs(path, exist_ok=True)
+    digests = None if destination else get_sidecar(os.path.join(directory, guid))
+    concurrency = concurrency or OSF_MAX_CONCURRENCY
+    state = get_sync_state(os.path.join(directory, guid)) if incremental else None
 
     url = f'{OSF_API_URL}v2/registrations/{guid}/wikis/'
 
-    pages_as_list = await get_paginated_data(url)
-    write_tasks = []
-    for page in pages_as_list:
-        write_tasks.append(write_wiki_content(page))
+    # Wiki pages are downloaded as their listing pages arrive, rather than after all of them, and
+    # no more than `concurrency` are pending at once, so thousands of pages don't pile up.
+    pending = set()
+    previous = state.wiki_files() if state else {}
+    current = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        async def fetch(page):
+            await run_blocking(write_wiki_content, page, path, digests, executor=executor)
+            if state:
+                state.wiki_written(page, wiki_filename(page))
 
-    await asyncio.gather(*write_tasks)
+        try:
+            async for page in aiter_records(url):
+                current[page['id']] = wiki_filename(page)
+                if state and not state.is_wiki_changed(page):
+                    continue
+                if len(pending) >= concurrency:
+                    done, pending = await asyncio.wait(
+                        pending,
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                    for future in done:
+                        future.result()
+                pending.add(asyncio.ensure_future(fetch(page)))
+            await asyncio.gather(*pending)
+
+            # Files of pages that were renamed or deleted since would stay in the bag otherwise.
+            for page_id, file in previous.items():
+                location = os.path.join(path, file)
+                if file not in current.values() and os.path.exists(location):
+                    os.remove(location)
+                if page_id not in current:
+                    state.wiki_removed(page_id)
+        finally:
+            for future in pending:
+                future.cancel()
+            if state:
+                # Whatever made it is kept, even if a page failed.
+                state.save()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -46,7 +115,31 @@ if __name__ == '__main__':
         help='The guid of the registration of who\'s wiki you want to dump.',
         required=True
     )
+    parser.add_argument(
+        '-d',
+        '--directory',
+        help='This is the target Directory for the project and its wiki',
+        default='.',
+    )
+    parser.add_argument(
+        '-o',
+        '--destination',
+        help='Where to write the wiki pages, instead of {directory}/{guid}/wiki/',
+    )
+    parser.add_argument(
+        '-c',
+        '--concurrency',
+        help='The most wiki pages downloaded at once.',
+        type=int,
+    )
+    parser.add_argument(
+        '-i',
+        '--incremental',
+        help='Only download pages that changed since the last incremental run.',
+        action='store_true',
+    )
     args = parser.parse_args()
 
     guid = args.guid
-    asyncio.run(main(guid))
+    directory = args.directory
+    asyncio.run(main(guid, directory, args.destination, args.concurrency, args.incremental))
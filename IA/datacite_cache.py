@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import threading
+import settings
+from urllib.parse import quote
+from typing import Dict, Optional
+from requests.exceptions import RequestException
+from datacite import DataCiteMDSClient
+from datacite.errors import DataCiteError, HttpError
+from datacite.request import DataCiteRequest
+from IA.utils import RetryPolicy, get_session
+
+HTTP_OK = 200
+HTTP_NOT_MODIFIED = 304
+
+
+class PooledDataCiteRequest(DataCiteRequest):
+    '''
+    Sends DataCite requests through the shared session, so they reuse its keep-alive connections
+    and are retried like every other request, rather than opening a new connection each time. Like
+    datacite's own, it leaves the status and text in `code` and `data`, which is what the client's
+    methods read, and it returns the response too.
+    '''
+
+    def request(self, url, method='GET', body=None, params=None, headers=None):
+        params = dict(params or {}, **self.default_params)
+        if self.base_url:
+            url = self.base_url + url
+        if body and isinstance(body, str):
+            body = body.encode('utf-8')
+
+        kwargs = dict(
+            auth=(self.username, self.password),
+            params=params,
+            headers=headers or {},
+            data=body,
+        )
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+
+        try:
+            resp = RetryPolicy(retry_on=(429,)).run(
+                get_session().request,
+                method,
+                url,
+                description=f'{method} {url}',
+                idempotent=method in ('GET', 'PUT', 'DELETE'),
+                **kwargs,
+            )
+        except RequestException as e:
+            raise HttpError(e)
+        self.code = resp.status_code
+        self.data = resp.text
+        return resp
+
+
+class MetadataCache:
+    '''
+    DataCite metadata on disk, one JSON file per DOI of:
+
+        {"doi": ..., "metadata": ..., "etag": ..., "last_modified": ..., "fetched_at": ...}
+
+    An entry younger than `ttl` seconds is used as it is. Older ones are revalidated with the
+    ETag or Last-Modified DataCite sent with them, so an unchanged record costs a 304 and not the
+    whole XML again.
+    '''
+
+    def __init__(self, directory: str, ttl: float = None):
+        self.directory = directory
+        self.ttl = settings.DATACITE_CACHE_TTL if ttl is None else ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def location(self, doi: str) -> str:
+        return os.path.join(self.directory, quote(doi, safe='') + '.json')
+
+    def get(self, doi: str) -> Optional[Dict]:
+        try:
+            with open(self.location(doi), 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, doi: str, entry: Dict):
+        entry = dict(entry, doi=doi, fetched_at=time.time())
+        location = self.location(doi)
+        # Written whole then moved into place, so a reader never sees half an entry.
+        temp = f'{location}.{threading.get_ident()}.tmp'
+        with open(temp, 'w') as fp:
+            json.dump(entry, fp)
+        os.replace(temp, location)
+
+    def is_fresh(self, entry: Dict) -> bool:
+        return time.time() - entry['fetched_at'] < self.ttl
+
+
+class CachingDataCiteClient(DataCiteMDSClient):
+    '''
+    A DataCiteMDSClient meant to be made once and shared, whose requests go through the pooled
+    session and whose metadata_get is answered from a MetadataCache when there is one.
+    '''
+
+    def __init__(self, *args, cache: MetadataCache = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = cache
+
+    def _request_factory(self):
+        return PooledDataCiteRequest(
+            base_url=self.api_url,
+            username=self.username,
+            password=self.password,
+            default_params={'testMode': '1'} if self.test_mode else {},
+            timeout=self.timeout,
+        )
+
+    def metadata_get(self, doi):
+        if self.cache is None:
+            return super().metadata_get(doi)
+
+        entry = self.cache.get(doi)
+        if entry and self.cache.is_fresh(entry):
+            return entry['metadata']
+
+        headers = {'Accept': 'application/xml', 'Accept-Encoding': 'UTF-8'}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        resp = self._request_factory().get('metadata/' + doi, headers=headers)
+        if resp.status_code == HTTP_NOT_MODIFIED and entry:
+            self.cache.put(doi, entry)
+            return entry['metadata']
+        if resp.status_code != HTTP_OK:
+            raise DataCiteError.factory(resp.status_code, resp.text)
+
+        self.cache.put(
+            doi,
+            {
+                'metadata': resp.text,
+                'etag': resp.headers.get('ETag'),
+                'last_modified': resp.headers.get('Last-Modified'),
+            },
+        )
+        return resp.text
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_datacite_client() -> CachingDataCiteClient:
+    '''
+    The process-wide DataCite client, caching metadata in DATACITE_CACHE_DIRECTORY unless that's
+    None.
+    '''
+    global _client
+    with _client_lock:
+        if _client is None:
+            directory = settings.DATACITE_CACHE_DIRECTORY
+            _client = CachingDataCiteClient(
+                url=settings.DATACITE_URL,
+                username=settings.DATACITE_USERNAME,
+                password=settings.DATACITE_PASSWORD,
+                prefix=settings.DATACITE_PREFIX,
+                cache=MetadataCache(directory) if directory else None,
+            )
+        return _client
+
+
+def reset_datacite_client():
+    global _client
+    with _client_lock:
+        _client = None
@@ -0,0 +1,130 @@
+import os
+import hashlib
+import threading
+import settings
+from typing import Dict, Iterable, Optional
+from IA import jsonl
+
+SIDECAR_SUFFIX = '.digests.jsonl'
+
+
+class MultiHash:
+    '''
+    Feeds the same bytes to several hash algorithms at once, counting them as it goes.
+    '''
+
+    def __init__(self, algorithms: Iterable[str]):
+        self.hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+        self.size = 0
+
+    def update(self, data: bytes):
+        for hash in self.hashes.values():
+            hash.update(data)
+        self.size += len(data)
+
+    def hexdigests(self) -> Dict[str, str]:
+        return {algorithm: hash.hexdigest() for algorithm, hash in self.hashes.items()}
+
+
+class DigestSidecar:
+    '''
+    Digests of the files in a registration's payload, computed by the fetchers while they wrote
+    them and by bagging for anything else, so the bag's manifests can be made without reading the
+    payload back. It lives next to the directory, so it never ends up in the bag, as JSON lines of:
+
+        {"path": ..., "size": ..., "mtime_ns": ..., "inode": ..., "sha256": ..., "sha512": ...}
+
+    Paths are relative to the payload, which is the directory itself until it's bagged and its
+    data/ directory after, and a later line for a path replaces earlier ones. The size, mtime and
+    inode tell whether the file has changed since.
+    '''
+
+    def __init__(self, directory: str, algorithms: Iterable[str] = None):
+        self.directory = os.path.abspath(directory)
+        self.location = self.directory + SIDECAR_SUFFIX
+        self.algorithms = list(algorithms or settings.BAG_CHECKSUMS)
+        self.lock = threading.Lock()
+
+    def hasher(self) -> MultiHash:
+        return MultiHash(self.algorithms)
+
+    def entry(self, path: str, hasher: MultiHash, root: str = None) -> Dict:
+        path = os.path.abspath(path)
+        if root is None:
+            # Files written straight into a bag's data/ are taken relative to it.
+            payload = payload_directory(self.directory)
+            root = payload if path.startswith(payload + os.sep) else self.directory
+        stat = os.stat(path)
+        entry = {
+            'path': os.path.relpath(path, root),
+            'size': hasher.size,
+            'mtime_ns': stat.st_mtime_ns,
+            'inode': stat.st_ino,
+        }
+        entry.update(hasher.hexdigests())
+        return entry
+
+    def record(self, path: str, hasher: MultiHash, root: str = None):
+        '''
+        Call once the file at `path` is closed, so its mtime is final. Its path is taken relative to
+        `root` if given, and otherwise to the payload it's in.
+        '''
+        entry = self.entry(path, hasher, root)
+        with self.lock:
+            jsonl.append(self.location, entry)
+
+    def record_bytes(self, path: str, data: bytes):
+        hasher = self.hasher()
+        hasher.update(data)
+        self.record(path, hasher)
+
+    def load(self) -> Dict[str, Dict]:
+        return {entry['path']: entry for entry in jsonl.load(self.location)}
+
+    def rewrite(self, entries: Iterable[Dict]):
+        '''
+        Replaces the whole sidecar with `entries`, dropping superseded lines and deleted files.
+        '''
+        with self.lock:
+            jsonl.rewrite(self.location, entries)
+
+    @staticmethod
+    def matches(entry: Optional[Dict], stat: os.stat_result, algorithms: Iterable[str]) -> bool:
+        '''
+        Whether `entry` still describes the file `stat` is of and has all of `algorithms`.
+        '''
+        return bool(
+            entry and
+            (entry['size'], entry['mtime_ns'], entry.get('inode')) ==
+            (stat.st_size, stat.st_mtime_ns, stat.st_ino) and
+            all(algorithm in entry for algorithm in algorithms)
+        )
+
+
+def payload_directory(directory: str) -> str:
+    '''
+    Where a registration's content lives: its data/ directory once it's been bagged, and the
+    directory itself before.
+    '''
+    if os.path.exists(os.path.join(directory, 'bagit.txt')):
+        return os.path.join(directory, 'data')
+    return directory
+
+
+_sidecars = {}
+_sidecars_lock = threading.Lock()
+
+
+def get_sidecar(directory: str) -> Optional[DigestSidecar]:
+    '''
+    The sidecar for a registration's directory, shared by every fetcher writing into it, or None
+    when BAG_DIGEST_SIDECAR is off.
+    '''
+    if not settings.BAG_DIGEST_SIDECAR:
+        return None
+
+    directory = os.path.abspath(directory)
+    with _sidecars_lock:
+        if directory not in _sidecars:
+            _sidecars[directory] = DigestSidecar(directory)
+        return _sidecars[directory]
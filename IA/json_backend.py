@@ -0,0 +1,79 @@
+import re
+import json
+import settings
+from typing import Any, Callable, Dict, Tuple, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# Every backend's dumps gives UTF-8 bytes, whatever its own returns.
+BACKENDS: Dict[str, Tuple[Callable, Callable]] = {
+    'json': (json.loads, lambda obj: json.dumps(obj).encode()),
+}
+if ujson:
+    BACKENDS['ujson'] = (ujson.loads, lambda obj: ujson.dumps(obj).encode())
+if orjson:
+    BACKENDS['orjson'] = (orjson.loads, orjson.dumps)
+
+# Fastest first, for JSON_BACKEND = 'auto'.
+PREFERENCE = ('orjson', 'ujson', 'json')
+
+# JSON:API documents from OSF start with their data, which is all split_data relies on.
+LEADING_DATA = re.compile(r'\s*{\s*"data"\s*:\s*')
+DECODER = json.JSONDecoder()
+
+
+def get_backend(name: str = None) -> Tuple[Callable, Callable]:
+    '''
+    The loads and dumps of the JSON_BACKEND, 'json', 'ujson', 'orjson' or 'auto' for the fastest
+    one installed.
+    '''
+    name = name or settings.JSON_BACKEND
+    if name == 'auto':
+        name = next(backend for backend in PREFERENCE if backend in BACKENDS)
+    if name not in PREFERENCE:
+        raise ValueError(
+            f'Unknown JSON backend {name}, expected one of auto, {", ".join(PREFERENCE)}.',
+        )
+    if name not in BACKENDS:
+        raise ImportError(f'The {name} JSON backend isn\'t installed.')
+    return BACKENDS[name]
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    return get_backend()[0](data)
+
+
+def dumps(obj: Any) -> bytes:
+    return get_backend()[1](obj)
+
+
+def split_data(body: bytes) -> Dict:
+    '''
+    Decodes a JSON:API document but leaves its data as the bytes it came as, so it can be written
+    out without being encoded again. Finding where the data ends still means the stdlib decoding
+    it, objects and all, so all this saves is the encoding: faster than decoding and encoding with
+    the stdlib, but slower than either with orjson or ujson. So unless JSON_BACKEND is 'json' the
+    document is just decoded, data included. Documents that don't start with their data are
+    decoded in full too.
+    '''
+    if get_backend() is not BACKENDS['json']:
+        return loads(body)
+
+    text = body.decode('utf-8')
+    match = LEADING_DATA.match(text)
+    if not match:
+        return loads(text)
+
+    start = match.end()
+    end = DECODER.raw_decode(text, start)[1]
+    document = loads('{"data": null' + text[end:])
+    document['data'] = text[start:end].encode('utf-8')
+    return document
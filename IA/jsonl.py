@@ -0,0 +1,36 @@
+import os
+import json
+from typing import Dict, Iterable, Iterator
+
+
+def load(location: str) -> Iterator[Dict]:
+    '''
+    Yields the records of the JSON lines file at `location`, if there is one.
+    '''
+    if not os.path.exists(location):
+        return
+
+    with open(location, 'r') as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A crash can leave the last line half written.
+                continue
+            yield record
+
+
+def append(location: str, record: Dict):
+    with open(location, 'a') as fp:
+        fp.write(json.dumps(record) + '\n')
+
+
+def rewrite(location: str, records: Iterable[Dict]):
+    '''
+    Replaces the whole file with `records`, atomically, so a crash leaves either the old or the new
+    records behind.
+    '''
+    temp = f'{location}.tmp'
+    with open(temp, 'w') as fp:
+        fp.writelines(json.dumps(record) + '\n' for record in records)
+    os.replace(temp, location)
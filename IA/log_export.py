@@ -0,0 +1,104 @@
+import io
+import os
+import re
+import gzip
+import settings
+from typing import Dict, Iterator, List
+from IA.json_backend import dumps, loads
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 'pages' is one {guid}-{page}.json file per page of the API, the rest are every log in a single
+# {guid}.ndjson file, one per line, compressed or not.
+LOG_EXPORT_FORMATS = ('pages', 'ndjson', 'ndjson.gz', 'ndjson.zst')
+
+PAGE_FILE = re.compile(r'^.+-(\d+)\.json$')
+
+
+def open_export(location: str, mode: str):
+    '''
+    Opens an NDJSON export as text, compressed according to its extension. Appending to a
+    compressed export adds another gzip member or zstd frame, which read back as one stream.
+    '''
+    if location.endswith('.gz'):
+        return gzip.open(location, mode + 't', encoding='utf-8')
+    if location.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError('zstandard needs to be installed for .zst log exports.')
+        if 'r' in mode:
+            raw = zstandard.ZstdDecompressor().stream_reader(
+                open(location, 'rb'),
+                read_across_frames=True,
+                closefd=True,
+            )
+        else:
+            raw = zstandard.ZstdCompressor().stream_writer(open(location, mode + 'b'), closefd=True)
+        return io.TextIOWrapper(raw, encoding='utf-8')
+    return open(location, mode + 't', encoding='utf-8')
+
+
+class LogExport:
+    '''
+    Writes every log of a registration into one NDJSON file as the pages arrive, instead of a file
+    per page. A full export replaces the file, while `mode` 'a' appends to it, for incremental
+    syncs that only fetch the new logs, after cutting it back to `truncate_to` bytes. Its digests
+    are recorded once it's closed, as compression means the bytes on disk aren't the ones written.
+    '''
+
+    def __init__(self, location: str, digests=None, mode: str = 'w', truncate_to: int = None):
+        self.location = location
+        self.digests = digests
+        if truncate_to is not None and os.path.exists(location):
+            with open(location, 'r+b') as fp:
+                fp.truncate(truncate_to)
+        self.fp = open_export(location, mode)
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, logs: List[Dict]):
+        self.fp.writelines(dumps(log).decode() + '\n' for log in logs)
+        self.count += len(logs)
+
+    def write_page(self, page_num: int, response: Dict):
+        self.write(response['data'])
+
+    def close(self):
+        if self.fp.closed:
+            return
+        self.fp.close()
+        if self.digests:
+            hasher = self.digests.hasher()
+            with open(self.location, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(settings.DOWNLOAD_CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+            self.digests.record(self.location, hasher)
+
+
+def iter_logs(location: str) -> Iterator[Dict]:
+    '''
+    Yields every log in an export, either an NDJSON file or a directory of per page files, in the
+    order they were written.
+    '''
+    if os.path.isdir(location):
+        pages = sorted(
+            (int(match.group(1)), name)
+            for name in os.listdir(location)
+            for match in [PAGE_FILE.match(name)] if match
+        )
+        for page_num, name in pages:
+            with open(os.path.join(location, name), 'rb') as fp:
+                yield from loads(fp.read())
+        return
+
+    with open_export(location, 'r') as fp:
+        for line in fp:
+            if line.strip():
+                yield loads(line)
@@ -0,0 +1,127 @@
+import os
+import json
+import threading
+from typing import Dict, Iterable, Optional
+
+SYNC_STATE_SUFFIX = '.sync-state.json'
+
+
+class SyncState:
+    '''
+    What the incremental log and wiki dumps have already fetched for a registration, so a rerun
+    only asks OSF for what's new or changed since:
+
+        {
+            "logs": {"last_date": ..., "last_ids": [...], "pages": ..., "export_size": ...},
+            "wiki": {
+                page id: {"name": ..., "date_modified": ..., "version": ..., "file": ...},
+                ...
+            }
+        }
+
+    `last_ids` are the logs at `last_date`, which the next run asks for again so none that share
+    it are missed, `pages` is how many log files have been written and `export_size` how long the
+    NDJSON export was when the last sync finished. Each wiki page's `file` is what it was written
+    as, so it can be removed once the page is renamed or deleted. It lives next to the
+    registration's directory, so it's never bagged or uploaded.
+    '''
+
+    def __init__(self, location: str):
+        self.location = location
+        self.lock = threading.Lock()
+        self.state = {'logs': {}, 'wiki': {}}
+
+        if os.path.exists(location):
+            with open(location, 'r') as fp:
+                self.state.update(json.load(fp))
+
+    def save(self):
+        with self.lock:
+            temp = f'{self.location}.tmp'
+            with open(temp, 'w') as fp:
+                json.dump(self.state, fp, indent=2)
+            os.replace(temp, self.location)
+
+    @property
+    def logs_since(self) -> Optional[str]:
+        return self.state['logs'].get('last_date')
+
+    @property
+    def log_pages(self) -> int:
+        return self.state['logs'].get('pages', 0)
+
+    @property
+    def export_size(self) -> int:
+        return self.state['logs'].get('export_size', 0)
+
+    def export_written(self, size: int):
+        with self.lock:
+            self.state['logs']['export_size'] = size
+
+    def is_new_log(self, log: Dict) -> bool:
+        state = self.state['logs']
+        if state.get('last_date') and log['attributes']['date'] < state['last_date']:
+            return False
+        return log['id'] not in state.get('last_ids', [])
+
+    def logs_written(self, logs: Iterable[Dict], pages: int):
+        logs = list(logs)
+        with self.lock:
+            state = self.state['logs']
+            state['pages'] = pages
+            if not logs:
+                return
+
+            last_date = max(log['attributes']['date'] for log in logs)
+            if state.get('last_date') and last_date < state['last_date']:
+                return
+            last_ids = [log['id'] for log in logs if log['attributes']['date'] == last_date]
+            if last_date == state.get('last_date'):
+                last_ids += state['last_ids']
+            state['last_date'] = last_date
+            state['last_ids'] = sorted(set(last_ids))
+
+    def is_wiki_changed(self, page: Dict) -> bool:
+        seen = self.state['wiki'].get(page['id'])
+        attributes = page['attributes']
+        return not seen or (seen['date_modified'], seen['version'], seen['name']) != (
+            attributes['date_modified'],
+            attributes.get('extra', {}).get('version'),
+            attributes['name'],
+        )
+
+    def wiki_files(self) -> Dict[str, str]:
+        return {
+            page_id: seen.get('file', f'{seen["name"]}.md')
+            for page_id, seen in self.state['wiki'].items()
+        }
+
+    def wiki_written(self, page: Dict, file: str):
+        attributes = page['attributes']
+        with self.lock:
+            self.state['wiki'][page['id']] = {
+                'name': attributes['name'],
+                'date_modified': attributes['date_modified'],
+                'version': attributes.get('extra', {}).get('version'),
+                'file': file,
+            }
+
+    def wiki_removed(self, page_id: str):
+        with self.lock:
+            self.state['wiki'].pop(page_id, None)
+
+
+_states = {}
+_states_lock = threading.Lock()
+
+
+def get_sync_state(parent: str) -> SyncState:
+    '''
+    The sync state of a registration's directory, shared by the log and wiki dumps so the one
+    saving doesn't undo what the other has recorded when they run side by side.
+    '''
+    location = os.path.abspath(parent) + SYNC_STATE_SUFFIX
+    with _states_lock:
+        if location not in _states:
+            _states[location] = SyncState(location)
+        return _states[location]
@@ -0,0 +1,33 @@
+import os
+import json
+import responses
+import settings
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def fixture(name, mode='r'):
+    with open(os.path.join(HERE, name), mode) as fp:
+        return fp.read()
+
+
+def mock_osf(guid, zip_name='sgg32.zip', zip_callback=None):
+    '''
+    Mocks the OSF endpoints a registration is fetched from: its files as a zip, its logs and its
+    wiki listing. The zip is served from `zip_name`, unless `zip_callback` is given to serve it.
+    '''
+    zip_url = f'{settings.OSF_API_URL}v1/resources/{guid}/providers/osfstorage/?zip='
+    if zip_callback:
+        responses.add_callback(responses.GET, zip_url, callback=zip_callback)
+    else:
+        responses.add(responses.GET, zip_url, body=fixture(zip_name, 'rb'))
+    responses.add(
+        responses.GET,
+        f'{settings.OSF_API_URL}v2/registrations/{guid}/logs/?page[size]=100',
+        json=json.loads(fixture('njs82.json')),
+    )
+    responses.add(
+        responses.GET,
+        f'{settings.OSF_API_URL}v2/registrations/{guid}/wikis/',
+        json=json.loads(fixture('wiki-metadata-response.json')),
+    )
@@ -1,9 +1,21 @@
+import io
 import os
 import mock
 import json
+import bagit
+import shutil
+import tempfile
+import zipfile
 import unittest
-from nose.tools import assert_in
-from IA.IA_bag_and_tag import bag_and_tag, zip_bag
+from nose.tools import assert_equal, assert_in, assert_raises
+from IA.digests import get_sidecar
+from IA.IA_bag_and_tag import (
+    bag_and_tag,
+    bag_files,
+    hash_file,
+    upload_zip_bag,
+    zip_bag,
+)
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 
@@ -21,14 +33,188 @@ def datacite_xml():
 class TestBagAndTag(unittest.TestCase):
 
     @mock.patch('IA.IA_bag_and_tag.bagit.make_bag')
-    @mock.patch('IA.IA_bag_and_tag.bagit.Bag')
-    def test_bag_and_tag(self, mock_bagit, mock_zipfile):
+    @mock.patch('IA.digests.settings.BAG_DIGEST_SIDECAR', False)
+    def test_bag_and_tag(self, mock_make_bag):
         with mock.patch('builtins.open', mock.mock_open()) as m:
-            bag_and_tag(datacite_xml(), 'tests/test_directory')
+            bag_and_tag(datacite_xml(), 'tests/test_directory', processes=2, checksums=['md5'])
             m.assert_called_with(os.path.join(HERE, 'test_directory/datacite.xml'), 'w')
-            assert_in('IA/tests/test_directory', mock_bagit.call_args_list[0][0][0])
+            assert_in('IA/tests/test_directory', mock_make_bag.call_args_list[0][0][0])
+            assert_equal(mock_make_bag.call_args[1], {'processes': 2, 'checksums': ['md5']})
+            # The manifests were just made, so by default only the Payload-Oxum is checked.
+            mock_make_bag.return_value.validate.assert_called_once_with(fast=True)
 
-    @mock.patch('IA.IA_bag_and_tag.zipfile.ZipFile')
-    def test_bag_and_tag_and_zip(self, mock_zipfile):
-        zip_bag('tests/test_directory')
-        mock_zipfile.assert_called_with('bag.zip', 'w')
+    def test_bag_and_tag_validation(self):
+        for validation in ('none', 'fast', 'complete'):
+            with tempfile.TemporaryDirectory() as tmp:
+                # The sidecar goes next to the bag, so it's inside the temporary directory too.
+                path = os.path.join(tmp, 'bag')
+                os.mkdir(path)
+                with open(os.path.join(path, 'file.txt'), 'w') as fp:
+                    fp.write('payload')
+
+                with mock.patch('IA.IA_bag_and_tag.bagit.Bag.validate') as mock_validate:
+                    bag_and_tag('<resource/>', path, checksums=['md5'], validation=validation)
+
+                if validation == 'none':
+                    mock_validate.assert_not_called()
+                else:
+                    assert_equal(mock_validate.call_count, 1)
+                assert os.path.exists(os.path.join(path, 'manifest-md5.txt'))
+                assert bagit.Bag(path).is_valid()
+
+    @mock.patch('IA.IA_bag_and_tag.bagit.make_bag')
+    @mock.patch('IA.digests.settings.BAG_DIGEST_SIDECAR', False)
+    def test_bag_and_tag_unknown_validation(self, mock_make_bag):
+        with tempfile.TemporaryDirectory() as tmp:
+            with assert_raises(ValueError):
+                bag_and_tag('<resource/>', tmp, validation='thorough')
+
+    @mock.patch('IA.digests.settings.BAG_DIGEST_SIDECAR', False)
+    def test_bag_and_tag_complete_validation_catches_changes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'file.txt'), 'w') as fp:
+                fp.write('payload')
+
+            original_make_bag = bagit.make_bag
+
+            def make_bag_then_change(path, **kwargs):
+                bag = original_make_bag(path, **kwargs)
+                with open(os.path.join(path, 'data', 'file.txt'), 'w') as fp:
+                    fp.write('PAYLOAD')
+                return bag
+
+            with mock.patch('IA.IA_bag_and_tag.bagit.make_bag', make_bag_then_change):
+                with assert_raises(bagit.BagValidationError):
+                    bag_and_tag('<resource/>', tmp, processes=2, validation='complete')
+
+    def test_bag_and_tag_from_digests(self):
+        bags = {}
+        for sidecar in (False, True):
+            root = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, root)
+            tmp = os.path.join(root, 'bag')
+            os.makedirs(os.path.join(tmp, 'files', 'nested'))
+            os.makedirs(os.path.join(tmp, 'logs'))
+            payload = {
+                'files/nested/data.csv': b'a,b\n1,2\n',
+                'logs/guid-1.json': b'[]',
+                'unrecorded.txt': b'written by something else',
+            }
+            with mock.patch('IA.digests.settings.BAG_DIGEST_SIDECAR', sidecar):
+                digests = get_sidecar(tmp)
+                for name, content in payload.items():
+                    with open(os.path.join(tmp, name), 'wb') as fp:
+                        fp.write(content)
+                    if digests and name != 'unrecorded.txt':
+                        digests.record_bytes(os.path.join(tmp, name), content)
+
+                with mock.patch('IA.IA_bag_and_tag.hash_file', wraps=hash_file) as mock_hash:
+                    bag_and_tag('<resource/>', tmp, validation='complete')
+
+            hashed = [os.path.relpath(args[0], tmp) for args, kwargs in mock_hash.call_args_list]
+            bags[sidecar] = (hashed, bagit.Bag(tmp))
+
+        hashed, bag = bags[True]
+        # Only the file the fetchers didn't record, and the bag's own tag files, were read.
+        assert_equal(
+            [name for name in hashed if name.startswith('data')],
+            [os.path.join('data', 'unrecorded.txt')],
+        )
+        assert_equal(bag.payload_entries(), bags[False][1].payload_entries())
+        assert_equal(bag.info['Payload-Oxum'], bags[False][1].info['Payload-Oxum'])
+
+    def test_bag_and_tag_incremental(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'guid')
+            os.makedirs(os.path.join(path, 'files'))
+            os.makedirs(os.path.join(path, 'wiki'))
+            for name, content in (
+                ('files/big.bin', b'x' * 1000),
+                ('wiki/home.md', b'v1'),
+                ('wiki/other.md', b'other'),
+            ):
+                with open(os.path.join(path, name), 'wb') as fp:
+                    fp.write(content)
+            bag_and_tag('<resource/>', path)
+
+            # Only one wiki page is fetched again, with an edit, nothing else changes.
+            os.makedirs(os.path.join(path, 'wiki'))
+            with open(os.path.join(path, 'wiki', 'home.md'), 'wb') as fp:
+                fp.write(b'v2')
+            get_sidecar(path).record_bytes(os.path.join(path, 'wiki', 'home.md'), b'v2')
+            with open(os.path.join(path, '.manifest-sha256.txt.tmp'), 'w') as fp:
+                fp.write('left behind by a crash')
+
+            with mock.patch('IA.IA_bag_and_tag.hash_file', wraps=hash_file) as mock_hash:
+                bag_and_tag('<resource/>', path, validation='complete')
+
+            hashed = [os.path.relpath(args[0], path) for args, kwargs in mock_hash.call_args_list]
+            assert_equal([name for name in hashed if name.startswith('data')], [])
+            assert_equal(
+                sorted(os.listdir(path)),
+                sorted([
+                    'bag-info.txt',
+                    'bagit.txt',
+                    'data',
+                    'manifest-sha256.txt',
+                    'manifest-sha512.txt',
+                    'tagmanifest-sha256.txt',
+                    'tagmanifest-sha512.txt',
+                ]),
+            )
+            with open(os.path.join(path, 'data', 'wiki', 'home.md'), 'rb') as fp:
+                assert_equal(fp.read(), b'v2')
+            # The pages that weren't fetched again are still in the bag.
+            with open(os.path.join(path, 'data', 'wiki', 'other.md'), 'rb') as fp:
+                assert_equal(fp.read(), b'other')
+            assert 'data/wiki/other.md' in bagit.Bag(path).payload_entries()
+
+            # Files changed in place are noticed too, even with the same size.
+            with open(os.path.join(path, 'data', 'files', 'big.bin'), 'wb') as fp:
+                fp.write(b'y' * 1000)
+            with mock.patch('IA.IA_bag_and_tag.hash_file', wraps=hash_file) as mock_hash:
+                bag_and_tag('<resource/>', path, validation='complete')
+            hashed = [os.path.relpath(args[0], path) for args, kwargs in mock_hash.call_args_list]
+            assert_equal(
+                [name for name in hashed if name.startswith('data')],
+                [os.path.join('data', 'files', 'big.bin')],
+            )
+            assert_equal(len(get_sidecar(path).load()), 4)
+
+    def test_bag_and_tag_and_zip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bag')
+            shutil.copytree(os.path.join(HERE, 'test_folder'), path)
+            bag_and_tag('<resource/>', path)
+
+            for compression in ('store', 'deflate'):
+                target = zip_bag(path, compression=compression, workers=2)
+                assert_equal(target, path + '.zip')
+
+                zip_file = zipfile.ZipFile(target)
+                assert zip_file.testzip() is None
+                names = zip_file.namelist()
+                assert_equal(names[0], 'bag-info.txt')
+                assert_in('data/datacite.xml', names)
+                for location, arcname in bag_files(path):
+                    with open(location, 'rb') as fp:
+                        assert_equal(zip_file.read(arcname), fp.read())
+
+    @mock.patch('IA.IA_bag_and_tag.MultipartUploadWriter')
+    def test_bag_and_tag_and_upload_zip(self, mock_writer):
+        uploaded = io.BytesIO()
+        mock_writer.return_value.__enter__.return_value = uploaded
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bag')
+            shutil.copytree(os.path.join(HERE, 'test_folder'), path)
+            bag_and_tag('<resource/>', path)
+            upload_zip_bag(path, 'osf-registration-guid0', 'guid0.zip')
+
+            assert not os.path.exists(path + '.zip')
+            bucket, filename, part_size = mock_writer.call_args[0]
+            assert_equal((bucket, filename), ('osf-registration-guid0', 'guid0.zip'))
+            assert_equal(
+                sorted(zipfile.ZipFile(uploaded).namelist()),
+                sorted(arcname for location, arcname in bag_files(path)),
+            )
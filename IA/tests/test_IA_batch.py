@@ -0,0 +1,78 @@
+import os
+import re
+import json
+import mock
+import tempfile
+import unittest
+import responses
+import settings
+from nose.tools import assert_equal, assert_in
+from IA.IA_batch import main, read_guids
+from IA.tests.fixtures import mock_osf
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_read_guids(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as fp:
+            fp.write('# nightly\nsgg32\n\njj81a\nsgg32\n')
+            fp.flush()
+            assert_equal(read_guids(['njs82', 'jj81a'], fp.name), ['njs82', 'jj81a', 'sgg32'])
+
+    @responses.activate
+    @mock.patch('IA.IA_bag_and_tag.build_doi', lambda guid: f'10.70102/fk2osf.io/{guid}')
+    @mock.patch('IA.IA_bag_and_tag.get_datacite_metadata')
+    def test_batch_end_to_end(self, mock_datacite):
+        mock_datacite.return_value = '<resource></resource>'
+        mock_osf('sgg32', 'sgg32.zip')
+        mock_osf('jj81a', 'jj81a.zip')
+        responses.add(
+            responses.GET,
+            re.compile(f'{settings.OSF_API_URL}v2/wikis/\\w+/content/'),
+            body=b'wiki data',
+        )
+        responses.add(
+            responses.GET,
+            f'{settings.OSF_API_URL}v1/resources/fail1/providers/osfstorage/?zip=',
+            status=404,
+        )
+        responses.add(
+            responses.PUT,
+            re.compile(f'{settings.IA_URL}/osf-registration-(sgg32|jj81a)/.*'),
+        )
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch('IA.IA_upload.UPLOAD_JOURNAL', False):
+            report = os.path.join(tmp, 'report.json')
+            results = main(['sgg32', 'fail1', 'jj81a'], tmp, workers=2, report=report)
+
+            assert_equal([result['guid'] for result in results], ['sgg32', 'fail1', 'jj81a'])
+            assert_equal([result['status'] for result in results], ['ok', 'failed', 'ok'])
+            assert_equal(results[0]['completed'], ['files', 'logs', 'wiki', 'bag', 'upload'])
+            assert_equal(results[1]['failed_step'], 'files')
+            assert 'HTTPError' in results[1]['error']
+
+            # One failure doesn't leave anything behind in the other registrations.
+            for guid in ('sgg32', 'jj81a'):
+                data = os.path.join(tmp, guid, 'data')
+                assert os.path.exists(os.path.join(tmp, guid, 'bagit.txt'))
+                assert os.path.exists(os.path.join(data, 'logs', f'{guid}-1.json'))
+                assert os.path.exists(os.path.join(data, 'wiki', 'home.md'))
+                assert os.path.exists(os.path.join(data, 'datacite.xml'))
+                assert os.listdir(os.path.join(data, 'files'))
+
+            uploaded = [
+                call.request.url for call in responses.calls if call.request.method == 'PUT'
+            ]
+            for guid in ('sgg32', 'jj81a'):
+                bucket = f'{settings.IA_URL}/osf-registration-{guid}/'
+                assert_in(f'{bucket}bagit.txt', uploaded)
+                assert_in(f'{bucket}data/datacite.xml', uploaded)
+                assert_in(f'{bucket}data/logs/{guid}-1.json', uploaded)
+                assert_in(f'{bucket}data/wiki/home.md', uploaded)
+            # Keys are relative to the bag, nothing of where it is on disk.
+            assert not any(tmp.lstrip('/') in url for url in uploaded)
+            assert not any('fail1' in url for url in uploaded)
+
+            with open(report, 'r') as fp:
+                assert_equal(json.load(fp), results)
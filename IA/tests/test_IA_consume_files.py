@@ -1,8 +1,10 @@
 import os
 import mock
+import tempfile
 import unittest
 import responses
 import settings
+from zipfile import ZipFile
 from IA.IA_consume_files import main
 
 HERE = os.path.dirname(os.path.abspath(__file__))
@@ -11,10 +13,11 @@ HERE = os.path.dirname(os.path.abspath(__file__))
 class TestIAFiles(unittest.TestCase):
 
     @responses.activate
+    @mock.patch('IA.utils.os.replace')
     @mock.patch('IA.IA_consume_files.os.mkdir')
     @mock.patch('IA.IA_consume_files.os.remove')
     @mock.patch('IA.IA_consume_files.ZipFile')
-    def test_file_dump(self, mock_zipfile, mock_rm, mock_mkdir):
+    def test_file_dump(self, mock_zipfile, mock_rm, mock_mkdir, mock_replace):
         with open('IA/tests/fixtures/sgg32.zip', 'rb') as zipfile:
             responses.add(
                 responses.Response(
@@ -29,15 +32,20 @@ class TestIAFiles(unittest.TestCase):
         with mock.patch('builtins.open', mock.mock_open()) as m:
             main('sgg32', 'asdfasdfasdgfasg', '.')
             mock_mkdir.assert_called_with('./sgg32/files')
-            m.assert_called_with('./sgg32/files/sgg32.zip', 'wb')
+            m.assert_called_with('./sgg32/files/sgg32.zip.partial', 'wb')
+            mock_replace.assert_called_with(
+                './sgg32/files/sgg32.zip.partial',
+                './sgg32/files/sgg32.zip',
+            )
             mock_zipfile.assert_called_with('./sgg32/files/sgg32.zip', 'r')
             mock_rm.assert_called_with('./sgg32/files/sgg32.zip')
 
     @responses.activate
+    @mock.patch('IA.utils.os.replace')
     @mock.patch('IA.IA_consume_files.os.mkdir')
     @mock.patch('IA.IA_consume_files.os.remove')
     @mock.patch('IA.IA_consume_files.ZipFile')
-    def test_file_dump_multiple_levels(self, mock_zipfile, mock_rm, mock_mkdir):
+    def test_file_dump_multiple_levels(self, mock_zipfile, mock_rm, mock_mkdir, mock_replace):
         with open('IA/tests/fixtures/jj81a.zip', 'rb') as zipfile:
             responses.add(
                 responses.Response(
@@ -52,6 +60,30 @@ class TestIAFiles(unittest.TestCase):
         with mock.patch('builtins.open', mock.mock_open()) as m:
             main('jj81a', None, '.')
             mock_mkdir.assert_called_with('./jj81a/files')
-            m.assert_called_with('./jj81a/files/jj81a.zip', 'wb')
+            m.assert_called_with('./jj81a/files/jj81a.zip.partial', 'wb')
+            mock_replace.assert_called_with(
+                './jj81a/files/jj81a.zip.partial',
+                './jj81a/files/jj81a.zip',
+            )
             mock_zipfile.assert_called_with('./jj81a/files/jj81a.zip', 'r')
             mock_rm.assert_called_with('./jj81a/files/jj81a.zip')
+
+    @responses.activate
+    def test_file_dump_stream(self):
+        with open(os.path.join(HERE, 'fixtures/jj81a.zip'), 'rb') as zipfile:
+            responses.add(
+                responses.Response(
+                    responses.GET,
+                    f'{settings.OSF_API_URL}v1/resources/jj81a/providers/osfstorage/?zip=',
+                    body=zipfile.read(),
+                    status=200,
+                )
+            )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            main('jj81a', None, tmp, stream=True)
+            path = os.path.join(tmp, 'jj81a', 'files')
+            assert not os.path.exists(os.path.join(path, 'jj81a.zip'))
+            with open(os.path.join(path, 'Folder 1', 'Folder two', 'test3.txt'), 'rb') as fp:
+                with ZipFile(os.path.join(HERE, 'fixtures/jj81a.zip')) as expected:
+                    assert fp.read() == expected.read('Folder 1/Folder two/test3.txt')
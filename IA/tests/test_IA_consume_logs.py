@@ -1,10 +1,19 @@
 import os
 import mock
+import bagit
+import requests
 import json
+import time
+import tempfile
 import unittest
 import responses
 import settings
+from urllib.parse import unquote
+from nose.tools import assert_equal, assert_raises
+from IA.digests import get_sidecar
+from IA.IA_bag_and_tag import bag_and_tag
 from IA.IA_consume_logs import main
+from IA.log_export import iter_logs, LogExport, zstandard
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 
@@ -27,6 +36,7 @@ class TestIALogs(unittest.TestCase):
 
     @responses.activate
     @mock.patch('IA.IA_consume_files.os.mkdir')
+    @mock.patch('IA.digests.settings.BAG_DIGEST_SIDECAR', False)
     def test_log_dump(self, mock_mkdir):
         responses.add(
             responses.Response(
@@ -38,7 +48,7 @@ class TestIALogs(unittest.TestCase):
 
         with mock.patch('builtins.open', mock.mock_open()) as m:
             main('njs82', '.', 100, 'asdfasdfasdgfasg')
-            m.assert_called_with('./njs82/logs/njs82-1.json', 'w')
+            m.assert_called_with('./njs82/logs/njs82-1.json', 'wb')
             mock_mkdir.assert_called_with('./njs82/logs')
 
         with open(os.path.join(HERE, 'fixtures/njs82.json')) as json_file:
@@ -50,6 +60,7 @@ class TestIALogs(unittest.TestCase):
 
     @responses.activate
     @mock.patch('IA.IA_consume_files.os.mkdir')
+    @mock.patch('IA.digests.settings.BAG_DIGEST_SIDECAR', False)
     def test_log_dump_two_pages(self, mock_mkdir):
         responses.add(
             responses.Response(
@@ -70,7 +81,7 @@ class TestIALogs(unittest.TestCase):
 
         with mock.patch('builtins.open', mock.mock_open()) as m:
             main('8jpzs', '.', 3, 'asdfasdfasdgfasg')
-            m.assert_called_with('./8jpzs/logs/8jpzs-2.json', 'w')
+            m.assert_called_with('./8jpzs/logs/8jpzs-2.json', 'wb')
             mock_mkdir.assert_called_with('./8jpzs/logs')
 
         with open(os.path.join(HERE, 'fixtures/8jpzs-1.json')) as json_file:
@@ -86,3 +97,257 @@ class TestIALogs(unittest.TestCase):
         target_json = target_json_1 + target_json_2
 
         assert source_json == target_json
+
+    @responses.activate
+    def test_log_dump_concurrent(self):
+        page1, page2 = log_files_two_pages()
+        responses.add(
+            responses.Response(
+                responses.GET,
+                f'{settings.OSF_API_URL}v2/registrations/8jpzs/logs/?page[size]=3',
+                json=page1,
+                match_querystring=True,
+            )
+        )
+        responses.add(
+            responses.Response(
+                responses.GET,
+                f'{settings.OSF_API_URL}v2/registrations/8jpzs/logs/?page[size]=3&page=2',
+                status=429,
+                headers={'Retry-After': '1'},
+                match_querystring=True,
+            )
+        )
+        responses.add(
+            responses.Response(
+                responses.GET,
+                f'{settings.OSF_API_URL}v2/registrations/8jpzs/logs/?page[size]=3&page=2',
+                json=page2,
+                match_querystring=True,
+            )
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.monotonic()
+            main('8jpzs', tmp, 3, 'asdfasdfasdgfasg', workers=4)
+            assert time.monotonic() - start >= 1
+
+            assert_equal(sorted(os.listdir(os.path.join(tmp, '8jpzs', 'logs'))), [
+                '8jpzs-1.json',
+                '8jpzs-2.json',
+            ])
+            for page, source in enumerate((page1, page2), 1):
+                with open(os.path.join(tmp, '8jpzs', 'logs', f'8jpzs-{page}.json')) as fp:
+                    assert_equal(json.load(fp), source['data'])
+
+        assert_equal(
+            responses.calls[0].request.headers['Authorization'],
+            'Bearer asdfasdfasdgfasg',
+        )
+
+    @responses.activate
+    def test_log_dump_incremental(self):
+        logs = log_files()
+        newest = logs['data'][0]
+        new_log = dict(newest, id='5dbc53066b36540009a5c7dc')
+        new_log['attributes'] = dict(newest['attributes'], date='2019-11-02T09:00:00.000000')
+        requested = []
+
+        def list_logs(request):
+            requested.append(unquote(request.url))
+            if 'filter' in request.url:
+                # The logs at the date asked for come back along with anything newer.
+                return 200, {}, json.dumps(dict(logs, data=[new_log, newest]))
+            return 200, {}, json.dumps(logs)
+
+        responses.add_callback(
+            responses.GET,
+            f'{settings.OSF_API_URL}v2/registrations/njs82/logs/',
+            callback=list_logs,
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'njs82', 'logs')
+            for expected in ([logs['data']], [logs['data'], [new_log]], [logs['data'], [new_log]]):
+                main('njs82', tmp, 100, 'asdfasdfasdgfasg', incremental=True)
+                assert_equal(len(os.listdir(path)), len(expected))
+                for page, data in enumerate(expected, 1):
+                    with open(os.path.join(path, f'njs82-{page}.json')) as fp:
+                        assert_equal(json.load(fp), data)
+
+        assert 'filter' not in requested[0]
+        assert_equal(
+            requested[1],
+            f'{settings.OSF_API_URL}v2/registrations/njs82/logs/'
+            f'?page[size]=100&filter[date][gte]={newest["attributes"]["date"]}',
+        )
+        assert requested[2].endswith('filter[date][gte]=2019-11-02T09:00:00.000000')
+
+    @responses.activate
+    def test_log_dump_incremental_pages(self):
+        page1, page2 = log_files_two_pages()
+        newest = page1['data'][0]
+
+        def list_logs(request):
+            if 'filter' in request.url:
+                return 200, {}, json.dumps(dict(page2, data=[newest]))
+            return 200, {}, json.dumps(page2 if 'page=2' in request.url else page1)
+
+        responses.add_callback(
+            responses.GET,
+            f'{settings.OSF_API_URL}v2/registrations/8jpzs/logs/',
+            callback=list_logs,
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, '8jpzs', 'logs')
+            for run in range(2):
+                main('8jpzs', tmp, 3, 'token', incremental=True)
+                # Older logs on later pages are kept, and nothing is fetched twice.
+                assert_equal(list(iter_logs(path)), page1['data'] + page2['data'])
+
+            with open(f'{os.path.join(tmp, "8jpzs")}.sync-state.json') as fp:
+                state = json.load(fp)['logs']
+            assert_equal(state['pages'], 2)
+            assert_equal(state['last_date'], newest['attributes']['date'])
+            assert_equal(state['last_ids'], [newest['id']])
+
+    @responses.activate
+    def test_log_dump_incremental_ndjson_after_failure(self):
+        page1, page2 = log_files_two_pages()
+        available = [page1]
+
+        def list_logs(request):
+            page = page2 if 'page=2' in request.url else page1
+            if page not in available:
+                return 404, {}, ''
+            return 200, {}, json.dumps(page)
+
+        responses.add_callback(
+            responses.GET,
+            f'{settings.OSF_API_URL}v2/registrations/8jpzs/logs/',
+            callback=list_logs,
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            location = os.path.join(tmp, '8jpzs', 'logs', '8jpzs.ndjson')
+            with assert_raises(requests.exceptions.HTTPError):
+                main('8jpzs', tmp, 3, 'token', incremental=True, export_format='ndjson')
+            assert_equal(list(iter_logs(location)), page1['data'])
+
+            # The rerun drops what the failed one wrote before fetching it all again.
+            available.append(page2)
+            main('8jpzs', tmp, 3, 'token', incremental=True, export_format='ndjson')
+            assert_equal(list(iter_logs(location)), page1['data'] + page2['data'])
+
+    @responses.activate
+    def test_log_dump_incremental_into_bag(self):
+        logs = log_files()
+        newest = logs['data'][0]
+        new_log = dict(newest, id='5dbc53066b36540009a5c7dc')
+        new_log['attributes'] = dict(newest['attributes'], date='2019-11-02T09:00:00.000000')
+        responses.add_callback(
+            responses.GET,
+            f'{settings.OSF_API_URL}v2/registrations/njs82/logs/',
+            callback=lambda request: (
+                200,
+                {},
+                json.dumps(dict(logs, data=[new_log, newest]) if 'filter' in request.url else logs),
+            ),
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'njs82')
+            main('njs82', tmp, 100, 'asdfasdfasdgfasg', incremental=True)
+            bag_and_tag('<resource/>', path)
+
+            # The bag is synced again, so the new page goes in after the one in data/.
+            main('njs82', tmp, 100, 'asdfasdfasdgfasg', incremental=True)
+            assert not os.path.exists(os.path.join(path, 'logs'))
+            bag_and_tag('<resource/>', path, validation='complete')
+
+            assert_equal(
+                sorted(bagit.Bag(path).payload_entries()),
+                ['data/datacite.xml', 'data/logs/njs82-1.json', 'data/logs/njs82-2.json'],
+            )
+            for page, data in enumerate([logs['data'], [new_log]], 1):
+                with open(os.path.join(path, 'data', 'logs', f'njs82-{page}.json')) as fp:
+                    assert_equal(json.load(fp), data)
+            assert_equal(
+                sorted(get_sidecar(path).load()),
+                ['datacite.xml', 'logs/njs82-1.json', 'logs/njs82-2.json'],
+            )
+
+    @responses.activate
+    def test_log_dump_ndjson(self):
+        page1, page2 = log_files_two_pages()
+        responses.add(
+            responses.GET,
+            f'{settings.OSF_API_URL}v2/registrations/8jpzs/logs/?page[size]=3',
+            json=page1,
+            match_querystring=True,
+        )
+        responses.add(
+            responses.GET,
+            f'{settings.OSF_API_URL}v2/registrations/8jpzs/logs/?page[size]=3&page=2',
+            json=page2,
+            match_querystring=True,
+        )
+        responses.add(
+            responses.GET,
+            f'{settings.OSF_API_URL}v2/registrations/'
+            f'8jpzs/logs/?format=json&page=2&page%5Bsize%5D=3',
+            json=page2,
+            match_querystring=True,
+        )
+        formats = ['ndjson', 'ndjson.gz'] + (['ndjson.zst'] if zstandard else [])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            main('8jpzs', tmp, 3, 'asdfasdfasdgfasg', workers=4)
+            logs = os.path.join(tmp, '8jpzs', 'logs')
+            assert_equal(list(iter_logs(logs)), page1['data'] + page2['data'])
+
+            for export_format in formats:
+                for workers in (None, 4):
+                    directory = os.path.join(tmp, f'{export_format}-{workers}')
+                    os.mkdir(directory)
+                    main('8jpzs', directory, 3, 'token', workers, export_format=export_format)
+
+                    location = os.path.join(directory, '8jpzs', 'logs', f'8jpzs.{export_format}')
+                    assert_equal(os.listdir(os.path.dirname(location)), [f'8jpzs.{export_format}'])
+                    assert_equal(list(iter_logs(location)), page1['data'] + page2['data'])
+
+                    # Another run replaces the file rather than adding the same logs again.
+                    main('8jpzs', directory, 3, 'token', workers, export_format=export_format)
+                    assert_equal(list(iter_logs(location)), page1['data'] + page2['data'])
+
+                    # What incremental syncs write is appended.
+                    with LogExport(location, mode='a') as export:
+                        export.write(page2['data'])
+                    assert_equal(
+                        list(iter_logs(location)),
+                        page1['data'] + page2['data'] + page2['data'],
+                    )
+
+            with open(os.path.join(tmp, 'ndjson-None', '8jpzs', 'logs', '8jpzs.ndjson')) as fp:
+                assert_equal(json.loads(fp.readline()), page1['data'][0])
+
+    @responses.activate
+    @mock.patch('IA.json_backend.settings.JSON_BACKEND', 'json')
+    def test_log_dump_raw(self):
+        with open(os.path.join(HERE, 'fixtures/njs82.json'), 'rb') as fp:
+            body = fp.read()
+        responses.add(
+            responses.GET,
+            f'{settings.OSF_API_URL}v2/registrations/njs82/logs/?page[size]=100',
+            body=body,
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            main('njs82', tmp, 100, 'asdfasdfasdgfasg', raw=True)
+            with open(os.path.join(tmp, 'njs82', 'logs', 'njs82-1.json'), 'rb') as fp:
+                written = fp.read()
+
+        # The data is written exactly as it was sent.
+        assert written in body
+        assert_equal(json.loads(written), json.loads(body)['data'])
@@ -0,0 +1,92 @@
+import os
+import re
+import time
+import mock
+import asyncio
+import tempfile
+import unittest
+from urllib.parse import unquote
+import responses
+import settings
+from nose.tools import assert_equal, assert_raises
+from IA.IA_pipeline import archive
+from IA.tests.fixtures import fixture, mock_osf
+
+
+@mock.patch('IA.IA_bag_and_tag.build_doi', lambda guid: f'10.70102/fk2osf.io/{guid}')
+@mock.patch('IA.IA_pipeline.build_doi', lambda guid: f'10.70102/fk2osf.io/{guid}')
+@mock.patch('IA.IA_pipeline.get_datacite_metadata', lambda doi: '<resource></resource>')
+class TestPipeline(unittest.TestCase):
+
+    def mock_osf(self, zip_status=200):
+        self.events = []
+        zip_body = fixture('sgg32.zip', 'rb')
+
+        def slow_zip(request):
+            time.sleep(0.3)
+            self.events.append(('zip fetched', None))
+            return zip_status, {}, zip_body
+
+        def put(request):
+            self.events.append(('put', unquote(request.url.split('/osf-registration-sgg32/')[1])))
+            return 200, {}, b''
+
+        mock_osf('sgg32', zip_callback=slow_zip)
+        responses.add(
+            responses.GET,
+            re.compile(f'{settings.OSF_API_URL}v2/wikis/\\w+/content/'),
+            body=b'wiki data',
+        )
+        responses.add_callback(
+            responses.PUT,
+            re.compile(f'{settings.IA_URL}/osf-registration-sgg32/.*'),
+            callback=put,
+        )
+
+    @responses.activate
+    def test_uploads_overlap_fetching(self):
+        self.mock_osf()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(archive('sgg32', tmp))
+
+            uploaded = [key for event, key in self.events if event == 'put']
+            # The logs and wiki went up while the zip was still downloading.
+            before_zip = self.events[:self.events.index(('zip fetched', None))]
+            assert_equal(
+                sorted(key for event, key in before_zip),
+                [
+                    'data/logs/sgg32-1.json',
+                    'data/wiki/home.md',
+                    'data/wiki/test1Ω≈ç√∫˜µ≤≥≥÷åß∂ƒ©˙∆∆˚¬…æ.md',
+                    'data/wiki/test2.md',
+                ],
+            )
+
+            bag = os.path.join(tmp, 'sgg32')
+            on_disk = {
+                os.path.relpath(os.path.join(root, file), bag)
+                for root, dirs, files in os.walk(bag) for file in files
+            }
+            assert_equal(sorted(uploaded), sorted(on_disk))
+
+            # The bag's own files go up last, once every fetched file is in.
+            tag_files = {
+                key for key in on_disk
+                if not key.startswith(('data/files/', 'data/logs/', 'data/wiki/'))
+            }
+            assert 'bagit.txt' in tag_files and 'data/datacite.xml' in tag_files
+            assert_equal(set(uploaded[-len(tag_files):]), tag_files)
+
+    @responses.activate
+    def test_fetch_failure_stops_before_bagging(self):
+        self.mock_osf(zip_status=404)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with assert_raises(Exception):
+                asyncio.run(archive('sgg32', tmp))
+
+            assert not os.path.exists(os.path.join(tmp, 'sgg32', 'bagit.txt'))
+            uploaded = [key for event, key in self.events if event == 'put']
+            assert 'data/logs/sgg32-1.json' in uploaded
+            assert not any(key.startswith('data/files') for key in uploaded)
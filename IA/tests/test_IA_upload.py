@@ -1,8 +1,28 @@
 import os
+import io
+import time
+import hashlib
+import mock
+import threading
 import asyncio
+import tempfile
 import unittest
 import responses
-from IA.IA_upload import upload, chunked_upload
+import requests
+from boto.exception import S3ResponseError
+from nose.tools import assert_equal, assert_raises
+from settings import CHUNK_SIZE, MAX_PART_SIZE, MAX_PARTS
+from IA.digests import DigestSidecar
+from IA.upload_journal import UploadJournal
+from IA.utils import file_md5
+from IA.IA_upload import (
+    upload,
+    chunked_upload,
+    gather_and_upload,
+    part_size_for,
+    sidecar_md5s,
+    MultipartUploadWriter,
+)
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 
@@ -19,12 +39,315 @@ class TestIAUploader(unittest.TestCase):
         )
         asyncio.run(upload('bucketname', 'file_name', b'content'))
 
+    @mock.patch('IA.IA_upload.MIN_PART_SIZE', 10)
+    @mock.patch('IA.IA_upload.CHUNK_SIZE', 10)
+    @mock.patch('IA.IA_upload.initiate_multipart_upload')
+    def test_IA_chunked_upload(self, mock_initiate):
+        parts = {}
+        mp = mock_initiate.return_value
+
+        def record(fp, part_num):
+            parts[part_num] = fp.read()
+            return mock.Mock(etag=f'"etag-{part_num}"')
+
+        mp.upload_part_from_file.side_effect = record
+
+        with tempfile.TemporaryFile() as fp:
+            fp.write(b'0123456789' * 2 + b'abcde')
+            fp.flush()
+            asyncio.run(chunked_upload('bucketname', 'file_name', fp))
+
+        mock_initiate.assert_called_once_with('bucketname', 'file_name')
+        assert_equal(parts, {1: b'0123456789', 2: b'0123456789', 3: b'abcde'})
+        mp.complete_upload.assert_called_once_with()
+        mp.cancel_upload.assert_not_called()
+
+    @mock.patch('IA.IA_upload.MIN_PART_SIZE', 10)
+    @mock.patch('IA.IA_upload.CHUNK_SIZE', 10)
+    @mock.patch('IA.IA_upload.initiate_multipart_upload')
+    def test_IA_chunked_upload_cancelled_on_failure(self, mock_initiate):
+        mp = mock_initiate.return_value
+        mp.upload_part_from_file.side_effect = [
+            mock.Mock(etag='"etag-1"'),
+            S3ResponseError(403, 'Forbidden'),
+        ]
+
+        with tempfile.TemporaryFile() as fp:
+            fp.write(b'0123456789' * 2)
+            fp.flush()
+            with assert_raises(S3ResponseError):
+                asyncio.run(chunked_upload('bucketname', 'file_name', fp, part_concurrency=1))
+
+        mp.complete_upload.assert_not_called()
+        mp.cancel_upload.assert_called_once_with()
+
+    @mock.patch('IA.IA_upload.initiate_multipart_upload')
+    def test_multipart_upload_writer(self, mock_initiate):
+        parts = {}
+        mp = mock_initiate.return_value
+
+        def record(fp, part_num):
+            parts[part_num] = fp.read()
+            return mock.Mock(etag=f'"etag-{part_num}"')
+
+        mp.upload_part_from_file.side_effect = record
+
+        with MultipartUploadWriter('bucketname', 'file_name', 10, part_concurrency=2) as writer:
+            for data in (b'0123', b'456789abcd', b'efghijklmnopq'):
+                writer.write(data)
+
+        mock_initiate.assert_called_once_with('bucketname', 'file_name')
+        assert_equal(parts, {1: b'0123456789', 2: b'abcdefghij', 3: b'klmnopq'})
+        mp.complete_upload.assert_called_once_with()
+        mp.cancel_upload.assert_not_called()
+
+    @mock.patch('IA.IA_upload.initiate_multipart_upload')
+    def test_multipart_upload_writer_cancelled_on_failure(self, mock_initiate):
+        mp = mock_initiate.return_value
+        mp.upload_part_from_file.side_effect = S3ResponseError(403, 'Forbidden')
+
+        with assert_raises(S3ResponseError):
+            with MultipartUploadWriter('bucketname', 'file_name', 10) as writer:
+                writer.write(b'0123456789')
+                writer.write(b'abc')
+
+        mp.complete_upload.assert_not_called()
+        mp.cancel_upload.assert_called_once_with()
+
+    @mock.patch('IA.utils.settings.RETRY_BACKOFF', 0)
+    @mock.patch('IA.IA_upload.MIN_PART_SIZE', 10)
+    @mock.patch('IA.IA_upload.CHUNK_SIZE', 10)
+    @mock.patch('IA.IA_upload.initiate_multipart_upload')
+    def test_IA_chunked_upload_retries_parts(self, mock_initiate):
+        mp = mock_initiate.return_value
+        mp.upload_part_from_file.side_effect = [
+            requests.exceptions.ConnectionError(),
+            S3ResponseError(503, 'Slow Down'),
+            mock.Mock(etag='"etag-1"'),
+        ]
+
+        with tempfile.TemporaryFile() as fp:
+            fp.write(b'0123456789')
+            fp.flush()
+            with mock.patch('IA.IA_upload.get_rate_limiter') as mock_limiter:
+                asyncio.run(chunked_upload('bucketname', 'file_name', fp, part_concurrency=1))
+
+        assert_equal(mp.upload_part_from_file.call_count, 3)
+        # Each attempt takes its turn with IA's rate limiter, retries included.
+        assert_equal(mock_limiter.return_value.acquire.call_count, 3)
+        mp.complete_upload.assert_called_once_with()
+        mp.cancel_upload.assert_not_called()
+
+    def test_part_size_for(self):
+        assert_equal(part_size_for(100), CHUNK_SIZE)
+        assert_equal(part_size_for(10 ** 12), 10 ** 8)
+        assert part_size_for(10 ** 12) * MAX_PARTS >= 10 ** 12
+        with assert_raises(ValueError):
+            part_size_for(MAX_PART_SIZE * MAX_PARTS + 1)
+
     @responses.activate
-    async def test_IA_chunked_upload(self):
+    def test_IA_upload_file_object(self):
         responses.add(
             responses.Response(
                 responses.PUT,
                 'http://s3.us.archive.org/bucketname/file_name',
             ),
         )
-        asyncio.run(chunked_upload('bucketname', 'file_name', b'content'))
+        fp = io.BytesIO(b'content')
+        fp.read()  # a previous attempt left the position at the end
+        asyncio.run(upload('bucketname', 'file_name', fp))
+        assert_equal(responses.calls[0].request.body, b'content')
+
+    @mock.patch('IA.IA_upload.CHUNK_SIZE', 1000)
+    def test_gather_and_upload_streams_files(self):
+        uploaded = {}
+
+        async def record(bucket_name, filename, file_content, **kwargs):
+            assert not isinstance(file_content, bytes)
+            uploaded[os.path.basename(filename)] = file_content.read()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            parent = os.path.join(tmp, 'bag')
+            os.makedirs(os.path.join(parent, 'data'))
+            with open(os.path.join(parent, 'small.txt'), 'wb') as fp:
+                fp.write(b'small')
+            with open(os.path.join(parent, 'data', 'big.txt'), 'wb') as fp:
+                fp.write(b'b' * 5000)
+
+            with mock.patch('IA.IA_upload.upload', side_effect=record) as mock_upload:
+                with mock.patch('IA.IA_upload.chunked_upload', side_effect=record) as mock_chunked:
+                    asyncio.run(gather_and_upload('bucketname', parent))
+                    mock_upload.assert_called_once()
+                    mock_chunked.assert_called_once()
+
+        assert_equal(uploaded, {'small.txt': b'small', 'big.txt': b'b' * 5000})
+
+    @mock.patch('IA.IA_upload.MIN_PART_SIZE', 10)
+    @mock.patch('IA.IA_upload.CHUNK_SIZE', 10)
+    @mock.patch('IA.IA_upload.get_bucket')
+    def test_gather_and_upload_skips_unchanged(self, mock_get_bucket):
+        uploaded = []
+
+        async def record(bucket_name, filename, file_content, **kwargs):
+            uploaded.append(os.path.basename(filename))
+
+        def listed(path, etag, size):
+            key = mock.Mock(size=size, etag=f'"{etag}"')
+            key.name = path.lstrip('/')
+            return key
+
+        def part_md5s(*parts):
+            digests = b''.join(hashlib.md5(part).digest() for part in parts)
+            return f'{hashlib.md5(digests).hexdigest()}-{len(parts)}'
+
+        with tempfile.TemporaryDirectory() as tmp:
+            parent = os.path.join(tmp, 'bag')
+            os.mkdir(parent)
+            contents = {
+                'same.txt': b'same',
+                'changed.txt': b'changed',
+                'new.txt': b'new',
+                'big.txt': b'0123456789' * 2 + b'abc',
+                'big-changed.txt': b'0123456789' * 2 + b'xyz',
+            }
+            paths = {}
+            for name, content in contents.items():
+                paths[name] = os.path.join(parent, name)
+                with open(paths[name], 'wb') as fp:
+                    fp.write(content)
+
+            mock_get_bucket.return_value.list.return_value = [
+                listed(paths['same.txt'], hashlib.md5(b'same').hexdigest(), 4),
+                listed(paths['changed.txt'], hashlib.md5(b'chonged').hexdigest(), 7),
+                listed(paths['big.txt'], part_md5s(b'0123456789', b'0123456789', b'abc'), 23),
+                listed(
+                    paths['big-changed.txt'],
+                    part_md5s(b'0123456789', b'0123456789', b'abc'),
+                    23,
+                ),
+            ]
+
+            with mock.patch('IA.IA_upload.upload', side_effect=record), \
+                    mock.patch('IA.IA_upload.chunked_upload', side_effect=record):
+                asyncio.run(
+                    gather_and_upload('bucketname', parent, journal=False, skip_unchanged=True),
+                )
+
+        mock_get_bucket.assert_called_once_with('bucketname')
+        assert_equal(sorted(uploaded), ['big-changed.txt', 'changed.txt', 'new.txt'])
+
+    def test_sidecar_md5s(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            parent = os.path.join(tmp, 'bag')
+            os.makedirs(os.path.join(parent, 'files'))
+            paths = [os.path.join(parent, 'files', name) for name in ('one.txt', 'two.txt')]
+            sidecar = DigestSidecar(parent, ['md5'])
+            for path in paths:
+                with open(path, 'wb') as fp:
+                    fp.write(b'data')
+                sidecar.record_bytes(path, b'data')
+
+            with open(paths[1], 'ab') as fp:
+                fp.write(b' changed')
+            assert_equal(sidecar_md5s(parent), {paths[0]: hashlib.md5(b'data').hexdigest()})
+
+    def test_gather_and_upload_concurrency(self):
+        in_flight = []
+        peak = []
+        lock = threading.Lock()
+
+        def slow_put(url, data, headers=None, retry_on=()):
+            with lock:
+                in_flight.append(url)
+                peak.append(len(in_flight))
+            time.sleep(0.1)
+            with lock:
+                in_flight.remove(url)
+            return mock.Mock(status_code=200)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            parent = os.path.join(tmp, 'bag')
+            os.mkdir(parent)
+            for i in range(12):
+                with open(os.path.join(parent, f'{i}.txt'), 'wb') as fp:
+                    fp.write(b'small')
+
+            with mock.patch('IA.IA_upload.put_with_retry', side_effect=slow_put) as mock_put:
+                start = time.monotonic()
+                asyncio.run(gather_and_upload('bucketname', parent, concurrency=4))
+                elapsed = time.monotonic() - start
+
+        assert_equal(mock_put.call_count, 12)
+        assert_equal(max(peak), 4)
+        assert elapsed < 12 * 0.1
+
+    @mock.patch('IA.IA_upload.MIN_PART_SIZE', 10)
+    @mock.patch('IA.IA_upload.CHUNK_SIZE', 10)
+    @mock.patch('IA.IA_upload.initiate_multipart_upload')
+    @mock.patch('IA.IA_upload.resume_multipart_upload')
+    def test_gather_and_upload_resumes_from_journal(self, mock_resume, mock_initiate):
+        mp = mock.Mock(id='upload-id')
+        mp.upload_part_from_file.side_effect = lambda fp, part_num: mock.Mock(etag=f'"{part_num}"')
+        mock_resume.return_value = (mp, {1: '"1"'})
+
+        with tempfile.TemporaryDirectory() as tmp:
+            parent = os.path.join(tmp, 'bag')
+            os.mkdir(parent)
+            path = os.path.join(parent, 'big.txt')
+            with open(path, 'wb') as fp:
+                fp.write(b'0123456789' * 3)
+
+            journal = UploadJournal.for_directory(parent)
+            md5 = hashlib.md5(b'0123456789' * 3).hexdigest()
+            journal.start(path, 'upload-id', 30, os.stat(path).st_mtime_ns, md5, 10)
+            journal.part_done(path, 'upload-id', 1, '"1"')
+
+            asyncio.run(gather_and_upload('bucketname', parent))
+            mock_resume.assert_called_once_with('bucketname', path, 'upload-id')
+            mock_initiate.assert_not_called()
+            assert_equal(
+                [call[0][1] for call in mp.upload_part_from_file.call_args_list],
+                [2, 3],
+            )
+            mp.complete_upload.assert_called_once_with()
+
+            # Once complete, a rerun doesn't touch IA at all.
+            mock_resume.reset_mock()
+            asyncio.run(gather_and_upload('bucketname', parent))
+            mock_resume.assert_not_called()
+            mock_initiate.assert_not_called()
+
+    def test_gather_and_upload_only_hashes_journal_matches(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            parent = os.path.join(tmp, 'bag')
+            os.mkdir(parent)
+            for name in ('one.txt', 'two.txt'):
+                with open(os.path.join(parent, name), 'wb') as fp:
+                    fp.write(b'small')
+
+            with mock.patch('IA.IA_upload.put_with_retry') as mock_put, \
+                    mock.patch('IA.IA_upload.file_md5', wraps=file_md5) as mock_md5:
+                mock_put.return_value.status_code = 200
+                asyncio.run(gather_and_upload('bucketname', parent))
+                assert_equal(mock_put.call_count, 2)
+                mock_md5.assert_not_called()
+
+                # Nothing has changed, and nothing was hashed before, so size and mtime are enough.
+                asyncio.run(gather_and_upload('bucketname', parent))
+                assert_equal(mock_put.call_count, 2)
+                mock_md5.assert_not_called()
+
+                two = os.path.join(parent, 'two.txt')
+                with open(two, 'wb') as fp:
+                    fp.write(b'other')
+                os.utime(two, ns=(0, 0))
+                asyncio.run(gather_and_upload('bucketname', parent))
+                assert_equal(mock_put.call_count, 3)
+                mock_md5.assert_not_called()
+
+                # A match with an md5 on record is hashed to check it's still the same bytes.
+                journal = UploadJournal.for_directory(parent)
+                journal.finish(two, 5, 0, hashlib.md5(b'small').hexdigest())
+                asyncio.run(gather_and_upload('bucketname', parent))
+                assert_equal(mock_put.call_count, 4)
+                assert_equal(mock_md5.call_count, 1)
@@ -1,11 +1,15 @@
 import os
+import re
+import time
 import asyncio
 import json
 import mock
-from mock import call
+import tempfile
+import threading
 import unittest
 import responses
 from nose.tools import assert_equal
+from IA.IA_bag_and_tag import bag_and_tag
 from IA.IA_wiki_dump import main
 
 HERE = os.path.dirname(os.path.abspath(__file__))
@@ -26,9 +30,18 @@ def wiki_metadata_two_pages():
     return page1, page2
 
 
+def read_pages(path):
+    pages = {}
+    for name in os.listdir(path):
+        with open(os.path.join(path, name), 'rb') as fp:
+            pages[name] = fp.read()
+    return pages
+
+
 class TestWikiDumper(unittest.TestCase):
 
     @responses.activate
+    @mock.patch('IA.digests.settings.BAG_DIGEST_SIDECAR', False)
     def test_wiki_dump(self):
         responses.add(
             responses.Response(
@@ -59,22 +72,20 @@ class TestWikiDumper(unittest.TestCase):
             ),
         )
 
-        with mock.patch('builtins.open', mock.mock_open()) as m:
-            asyncio.run(main('fxehm'))
-            assert m.call_args_list == [
-                call('/home.md', 'wb'),
-                call('/test1Ω≈ç√∫˜µ≤≥≥÷åß∂ƒ©˙∆∆˚¬…æ.md', 'wb'),
-                call('/test2.md', 'wb')
-            ]
-            handle = m()
-
-            assert handle.write.call_args_list == [
-                call(b'dtns3 data'),
-                call(b'md549 data'),
-                call(b'p8kxa data')
-            ]
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(main('fxehm', tmp))
+            path = os.path.join(tmp, 'fxehm', 'wiki')
+            assert_equal(
+                read_pages(path),
+                {
+                    'home.md': b'dtns3 data',
+                    'test1Ω≈ç√∫˜µ≤≥≥÷åß∂ƒ©˙∆∆˚¬…æ.md': b'md549 data',
+                    'test2.md': b'p8kxa data',
+                },
+            )
 
     @responses.activate
+    @mock.patch('IA.digests.settings.BAG_DIGEST_SIDECAR', False)
     def test_wiki_dump_retry(self):
         responses.add(
             responses.Response(
@@ -113,22 +124,20 @@ class TestWikiDumper(unittest.TestCase):
             ),
         )
 
-        with mock.patch('builtins.open', mock.mock_open()) as m:
-            asyncio.run(main('fxehm'))
-            assert m.call_args_list == [
-                call('/home.md', 'wb'),
-                call('/test1Ω≈ç√∫˜µ≤≥≥÷åß∂ƒ©˙∆∆˚¬…æ.md', 'wb'),
-                call('/test2.md', 'wb')
-            ]
-            handle = m()
-
-            assert handle.write.call_args_list == [
-                call(b'dtns3 data'),
-                call(b'md549 data'),
-                call(b'p8kxa data')
-            ]
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(main('fxehm', tmp))
+            path = os.path.join(tmp, 'fxehm', 'wiki')
+            assert_equal(
+                read_pages(path),
+                {
+                    'home.md': b'dtns3 data',
+                    'test1Ω≈ç√∫˜µ≤≥≥÷åß∂ƒ©˙∆∆˚¬…æ.md': b'md549 data',
+                    'test2.md': b'p8kxa data',
+                },
+            )
 
     @responses.activate
+    @mock.patch('IA.digests.settings.BAG_DIGEST_SIDECAR', False)
     def test_wiki_dump_multiple_pages(self):
         page1, page2 = wiki_metadata_two_pages()
         responses.add(
@@ -158,15 +167,151 @@ class TestWikiDumper(unittest.TestCase):
                 ),
             )
 
-        with mock.patch('builtins.open', mock.mock_open()) as m:
-            asyncio.run(main('fxehm'))
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(main('fxehm', tmp))
+            path = os.path.join(tmp, 'fxehm', 'wiki')
+            assert_equal(
+                read_pages(path),
+                {
+                    f'{wiki["attributes"]["name"]}.md':
+                        f'{wiki["attributes"]["path"]} data'.encode()
+                    for wiki in data
+                },
+            )
+
+    @responses.activate
+    def test_wiki_dump_concurrent_to_destination(self):
+        page1, page2 = wiki_metadata_two_pages()
+        data = page1['data'] + page2['data']
+        page1['data'], page1['links']['next'] = data, None
+        responses.add(
+            responses.GET,
+            'https://localhost:8000/v2/registrations/fxehm/wikis/',
+            json=page1,
+        )
+
+        lock = threading.Lock()
+        in_flight = []
+        most_in_flight = []
+
+        def slow_content(request):
+            with lock:
+                in_flight.append(request.url)
+                most_in_flight.append(len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.remove(request.url)
+            return 200, {}, request.url.encode()
+
+        responses.add_callback(
+            responses.GET,
+            re.compile('https://localhost:8000/v2/wikis/\\w+/content/'),
+            callback=slow_content,
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            destination = os.path.join(tmp, 'pages')
+            asyncio.run(main('fxehm', tmp, destination=destination, concurrency=3))
+            assert not os.path.exists(os.path.join(tmp, 'fxehm'))
             assert_equal(
-                m.call_args_list,
-                [call(f'/{wiki["attributes"]["name"]}.md', 'wb') for wiki in data]
+                read_pages(destination),
+                {
+                    f'{wiki["attributes"]["name"]}.md':
+                        wiki['links']['download'].encode()
+                    for wiki in data
+                },
             )
 
-            handle = m()
+        assert_equal(max(most_in_flight), 3)
+
+    @responses.activate
+    def test_wiki_dump_incremental(self):
+        metadata = wiki_metadata()
+        responses.add_callback(
+            responses.GET,
+            'https://localhost:8000/v2/registrations/fxehm/wikis/',
+            callback=lambda request: (200, {}, json.dumps(metadata)),
+        )
+        downloaded = []
+
+        def content(request):
+            downloaded.append(request.url.split('/')[-3])
+            return 200, {}, f'{request.url.split("/")[-3]} data'
+
+        responses.add_callback(
+            responses.GET,
+            re.compile('https://localhost:8000/v2/wikis/\\w+/content/'),
+            callback=content,
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(main('fxehm', tmp, incremental=True))
+            assert_equal(sorted(downloaded), ['dtns3', 'md549', 'p8kxa'])
+
+            downloaded.clear()
+            asyncio.run(main('fxehm', tmp, incremental=True))
+            assert_equal(downloaded, [])
+
+            metadata['data'][1]['attributes']['date_modified'] = '2020-01-01T00:00:00.000000Z'
+            metadata['data'][1]['attributes']['extra']['version'] = 2
+            asyncio.run(main('fxehm', tmp, incremental=True))
+            assert_equal(downloaded, ['md549'])
+
+            # Without incremental everything is fetched, as before.
+            downloaded.clear()
+            asyncio.run(main('fxehm', tmp))
+            assert_equal(len(downloaded), 3)
+
+            # Once bagged, a changed page replaces its copy in data/ and the rest stay.
+            path = os.path.join(tmp, 'fxehm')
+            bag_and_tag('<resource/>', path)
+            metadata['data'][1]['attributes']['extra']['version'] = 3
+            downloaded.clear()
+            asyncio.run(main('fxehm', tmp, incremental=True))
+            assert_equal(downloaded, ['md549'])
+            assert not os.path.exists(os.path.join(path, 'wiki'))
+            bag_and_tag('<resource/>', path, validation='complete')
+            assert_equal(
+                read_pages(os.path.join(path, 'data', 'wiki')),
+                {
+                    'home.md': b'dtns3 data',
+                    'test1Ω≈ç√∫˜µ≤≥≥÷åß∂ƒ©˙∆∆˚¬…æ.md': b'md549 data',
+                    'test2.md': b'p8kxa data',
+                },
+            )
+
+    @responses.activate
+    def test_wiki_dump_incremental_renames_and_deletes(self):
+        metadata = wiki_metadata()
+        responses.add_callback(
+            responses.GET,
+            'https://localhost:8000/v2/registrations/fxehm/wikis/',
+            callback=lambda request: (200, {}, json.dumps(metadata)),
+        )
+        responses.add_callback(
+            responses.GET,
+            re.compile('https://localhost:8000/v2/wikis/\\w+/content/'),
+            callback=lambda request: (200, {}, f'{request.url.split("/")[-3]} data'),
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'fxehm', 'wiki')
+            asyncio.run(main('fxehm', tmp, incremental=True))
+            assert_equal(len(os.listdir(path)), 3)
+
+            # home is deleted and test2 renamed, to a name that would be a path.
+            renamed = next(page for page in metadata['data'] if page['id'] == 'p8kxa')
+            renamed['attributes']['name'] = '../renamed'
+            renamed['attributes']['date_modified'] = '2020-01-01T00:00:00.000000Z'
+            metadata['data'] = [page for page in metadata['data'] if page['id'] != 'dtns3']
+            asyncio.run(main('fxehm', tmp, incremental=True))
+
             assert_equal(
-                handle.write.call_args_list,
-                [call(f'{wiki["attributes"]["path"]} data'.encode()) for wiki in data]
+                read_pages(path),
+                {
+                    'test1Ω≈ç√∫˜µ≤≥≥÷åß∂ƒ©˙∆∆˚¬…æ.md': b'md549 data',
+                    '.._renamed.md': b'p8kxa data',
+                },
             )
+            with open(f'{os.path.join(tmp, "fxehm")}.sync-state.json') as fp:
+                assert_equal(sorted(json.load(fp)['wiki']), ['md549', 'p8kxa'])
@@ -0,0 +1,113 @@
+import mock
+import tempfile
+import unittest
+import responses
+from nose.tools import assert_equal, assert_raises
+from datacite.errors import DataCiteNotFoundError
+from IA.datacite_cache import CachingDataCiteClient, MetadataCache
+from IA.utils import get_session
+
+DATACITE_URL = 'https://mds.test.datacite.org/'
+DOI = '10.70102/fk2osf.io/guid0'
+
+
+class StandInDataCite:
+    '''
+    Answers metadata requests like DataCite's MDS API would, honoring If-None-Match.
+    '''
+
+    def __init__(self):
+        self.records = {}
+        self.requests = []
+        responses.add_callback(
+            responses.GET,
+            f'{DATACITE_URL}metadata/{DOI}',
+            callback=self.metadata,
+        )
+
+    def metadata(self, request):
+        self.requests.append(request)
+        if DOI not in self.records:
+            return 404, {}, 'DOI not found'
+        metadata, etag = self.records[DOI]
+        if request.headers.get('If-None-Match') == etag:
+            return 304, {'ETag': etag}, ''
+        return 200, {'ETag': etag}, metadata
+
+
+class TestDataCiteCache(unittest.TestCase):
+
+    def client(self, directory, ttl=60):
+        return CachingDataCiteClient(
+            username='user',
+            password='password',
+            prefix='10.70102',
+            url=DATACITE_URL,
+            cache=MetadataCache(directory, ttl),
+        )
+
+    @responses.activate
+    def test_metadata_cached(self):
+        datacite = StandInDataCite()
+        datacite.records[DOI] = ('<resource>v1</resource>', '"v1"')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            client = self.client(tmp)
+            assert_equal(client.metadata_get(DOI), '<resource>v1</resource>')
+            assert_equal(client.metadata_get(DOI), '<resource>v1</resource>')
+            # The cache outlives the client.
+            assert_equal(self.client(tmp).metadata_get(DOI), '<resource>v1</resource>')
+
+        assert_equal(len(datacite.requests), 1)
+        assert 'Authorization' in datacite.requests[0].headers
+
+    @responses.activate
+    def test_metadata_revalidated_once_stale(self):
+        datacite = StandInDataCite()
+        datacite.records[DOI] = ('<resource>v1</resource>', '"v1"')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            client = self.client(tmp, ttl=60)
+            client.metadata_get(DOI)
+
+            later = client.cache.get(DOI)['fetched_at'] + 120
+            with mock.patch('IA.datacite_cache.time.time', return_value=later):
+                assert_equal(client.metadata_get(DOI), '<resource>v1</resource>')
+                assert_equal(datacite.requests[-1].headers['If-None-Match'], '"v1"')
+
+                # Revalidating counts as fetching, so it's fresh again.
+                client.metadata_get(DOI)
+                assert_equal(len(datacite.requests), 2)
+
+            datacite.records[DOI] = ('<resource>v2</resource>', '"v2"')
+            with mock.patch('IA.datacite_cache.time.time', return_value=later + 120):
+                assert_equal(client.metadata_get(DOI), '<resource>v2</resource>')
+            assert_equal(client.cache.get(DOI)['etag'], '"v2"')
+
+    @responses.activate
+    def test_metadata_not_found(self):
+        StandInDataCite()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            client = self.client(tmp)
+            with assert_raises(DataCiteNotFoundError):
+                client.metadata_get(DOI)
+            assert client.cache.get(DOI) is None
+
+    @responses.activate
+    def test_requests_are_pooled_without_cache(self):
+        datacite = StandInDataCite()
+        datacite.records[DOI] = ('<resource>v1</resource>', '"v1"')
+        client = CachingDataCiteClient(
+            username='user',
+            password='password',
+            prefix='10.70102',
+            url=DATACITE_URL,
+            test_mode=True,
+        )
+
+        # Straight through datacite's own metadata_get, which builds its request with the hook.
+        with mock.patch('IA.datacite_cache.get_session', wraps=get_session) as mock_session:
+            assert_equal(client.metadata_get(DOI), '<resource>v1</resource>')
+        mock_session.assert_called_once_with()
+        assert_equal(datacite.requests[0].url, f'{DATACITE_URL}metadata/{DOI}?testMode=1')
@@ -0,0 +1,45 @@
+import os
+import mock
+import hashlib
+import tempfile
+import unittest
+from nose.tools import assert_equal
+from IA.digests import DigestSidecar, get_sidecar
+
+
+class TestDigestSidecar(unittest.TestCase):
+
+    def test_sidecar_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = os.path.join(tmp, 'sgg32')
+            os.makedirs(os.path.join(directory, 'wiki'))
+            location = os.path.join(directory, 'wiki', 'home.md')
+            sidecar = DigestSidecar(directory, ['md5', 'sha256'])
+            assert_equal(sidecar.location, f'{directory}.digests.jsonl')
+
+            for content in (b'first', b'second'):
+                with open(location, 'wb') as fp:
+                    fp.write(content)
+                sidecar.record_bytes(location, content)
+
+            with open(sidecar.location, 'a') as fp:
+                fp.write('{"path": "wiki/test2.md"')  # cut off by a crash
+
+            assert_equal(
+                DigestSidecar(directory).load(),
+                {
+                    'wiki/home.md': {
+                        'path': 'wiki/home.md',
+                        'size': 6,
+                        'mtime_ns': os.stat(location).st_mtime_ns,
+                        'inode': os.stat(location).st_ino,
+                        'md5': hashlib.md5(b'second').hexdigest(),
+                        'sha256': hashlib.sha256(b'second').hexdigest(),
+                    },
+                },
+            )
+
+    def test_get_sidecar_is_shared(self):
+        assert get_sidecar('sgg32') is get_sidecar('./sgg32')
+        with mock.patch('IA.digests.settings.BAG_DIGEST_SIDECAR', False):
+            assert get_sidecar('sgg32') is None
@@ -0,0 +1,55 @@
+import json
+import mock
+import unittest
+from nose.tools import assert_equal, assert_raises
+from IA.json_backend import BACKENDS, dumps, get_backend, loads, split_data
+from IA.tests.fixtures import fixture
+
+
+class TestJSONBackend(unittest.TestCase):
+
+    def test_backends_round_trip(self):
+        document = json.loads(fixture('njs82.json', 'rb'))
+        for name in BACKENDS:
+            with mock.patch('IA.json_backend.settings.JSON_BACKEND', name):
+                encoded = dumps(document)
+                assert isinstance(encoded, bytes)
+                assert_equal(loads(encoded), document)
+
+    def test_get_backend(self):
+        assert_equal(get_backend('json'), BACKENDS['json'])
+        assert get_backend('auto') in BACKENDS.values()
+        with assert_raises(ValueError):
+            get_backend('simplejson')
+        with mock.patch.dict('IA.json_backend.BACKENDS', {'json': BACKENDS['json']}, clear=True):
+            assert_equal(get_backend('auto'), BACKENDS['json'])
+            with assert_raises(ImportError):
+                get_backend('orjson')
+
+    @mock.patch('IA.json_backend.settings.JSON_BACKEND', 'json')
+    def test_split_data(self):
+        for name in ('njs82.json', '8jpzs-1.json', '8jpzs-2.json'):
+            body = fixture(name, 'rb')
+            document = split_data(body)
+            expected = json.loads(body)
+            assert_equal(json.loads(document.pop('data')), expected.pop('data'))
+            assert_equal(document, expected)
+
+    @mock.patch('IA.json_backend.settings.JSON_BACKEND', 'json')
+    def test_split_data_keeps_bytes(self):
+        body = '{"data": [{"name": "Ω≈ç", "path": "a\\\\"}, [], {}],\n "links": {"next": null}}'
+        document = split_data(body.encode())
+        assert_equal(document['data'], '[{"name": "Ω≈ç", "path": "a\\\\"}, [], {}]'.encode())
+        assert_equal(document['links'], {'next': None})
+
+        # Anything that doesn't lead with its data is decoded as usual.
+        assert_equal(split_data(b'{"links": {}, "data": [1]}'), {'links': {}, 'data': [1]})
+
+    def test_split_data_decodes_with_faster_backends(self):
+        body = fixture('njs82.json', 'rb')
+        fast = (mock.Mock(side_effect=json.loads), BACKENDS['json'][1])
+        with mock.patch.dict('IA.json_backend.BACKENDS', {'fast': fast}), \
+                mock.patch('IA.json_backend.PREFERENCE', ('fast', 'json')), \
+                mock.patch('IA.json_backend.settings.JSON_BACKEND', 'fast'):
+            assert_equal(split_data(body), json.loads(body))
+        fast[0].assert_called_once_with(body)
@@ -0,0 +1,23 @@
+import os
+import tempfile
+import unittest
+from nose.tools import assert_equal
+from IA import jsonl
+
+
+class TestJSONLines(unittest.TestCase):
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            location = os.path.join(tmp, 'records.jsonl')
+            assert_equal(list(jsonl.load(location)), [])
+
+            jsonl.append(location, {'n': 1})
+            jsonl.append(location, {'n': 2})
+            with open(location, 'a') as fp:
+                fp.write('{"n": 3')  # cut off by a crash
+            assert_equal(list(jsonl.load(location)), [{'n': 1}, {'n': 2}])
+
+            jsonl.rewrite(location, [{'n': 2}])
+            assert_equal(list(jsonl.load(location)), [{'n': 2}])
+            assert_equal(os.listdir(tmp), ['records.jsonl'])
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+from nose.tools import assert_equal
+from IA.upload_journal import UploadJournal
+
+
+class TestUploadJournal(unittest.TestCase):
+
+    def test_journal_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            parent = os.path.join(tmp, 'bag')
+            journal = UploadJournal.for_directory(parent)
+            assert_equal(journal.location, f'{parent}.upload-journal.jsonl')
+
+            journal.start('bag/big.txt', 'id', 30, 1000, 'md5', 10)
+            journal.part_done('bag/big.txt', 'id', 1, '"a"')
+            journal.part_done('bag/big.txt', 'id', 2, '"b"')
+            journal.finish('bag/small.txt', 5, 1000, 'small-md5')
+
+            with open(journal.location, 'a') as fp:
+                fp.write('{"event": "part", "key": "bag/big.txt"')  # cut off by a crash
+
+            reloaded = UploadJournal.for_directory(parent)
+            assert_equal(
+                reloaded.pending_upload('bag/big.txt', 30, 1000, 'md5', 10),
+                {'upload_id': 'id', 'parts': {1: '"a"', 2: '"b"'}},
+            )
+            assert reloaded.is_uploaded('bag/small.txt', 5, 1000, 'small-md5')
+            assert not reloaded.is_uploaded('bag/big.txt', 30, 1000, 'md5')
+
+    def test_journal_ignores_changed_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = UploadJournal(os.path.join(tmp, 'journal.jsonl'))
+            journal.start('big.txt', 'id', 30, 1000, 'md5', 10)
+            journal.finish('small.txt', 5, 1000, 'small-md5')
+
+            assert_equal(journal.pending_upload('big.txt', 30, 1000, 'other-md5', 10), None)
+            assert_equal(journal.pending_upload('big.txt', 30, 1000, 'md5', 20), None)
+            assert_equal(journal.pending_upload('big.txt', 30, 2000, 'md5', 10), None)
+            assert not journal.is_uploaded('small.txt', 6, 1000, 'small-md5')
+            assert not journal.is_uploaded('small.txt', 5, 2000, 'small-md5')
+
+    def test_journal_matches_by_size_and_mtime(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = UploadJournal(os.path.join(tmp, 'journal.jsonl'))
+            journal.finish('hashed.txt', 5, 1000, 'md5')
+            journal.finish('unhashed.txt', 5, 1000, None)
+
+            assert_equal(journal.recorded_md5('hashed.txt', 5, 1000), 'md5')
+            assert_equal(journal.recorded_md5('hashed.txt', 5, 2000), None)
+            assert_equal(journal.recorded_md5('unhashed.txt', 5, 1000), None)
+            assert_equal(journal.recorded_md5('new.txt', 5, 1000), None)
+            assert journal.is_uploaded('unhashed.txt', 5, 1000, None)
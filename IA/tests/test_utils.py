@@ -0,0 +1,570 @@
+import os
+import re
+import json
+import time
+import email.utils
+import mock
+import asyncio
+import tempfile
+import unittest
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+import responses
+from mock import call
+from nose.tools import assert_equal, assert_raises
+from concurrent.futures import ThreadPoolExecutor
+from IA.utils import (
+    bounded_map,
+    connection_stats,
+    download_to_file,
+    aiter_pages,
+    get_paginated_data,
+    iter_pages,
+    get_session,
+    get_with_retry,
+    parse_retry_after,
+    put_with_retry,
+    reset_session,
+    RateLimiter,
+    RetryPolicy,
+)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def ranged_body(body, requested_ranges, etag='"v1"'):
+    '''
+    A `responses` callback that behaves like a range-capable server, recording every Range header.
+    '''
+    def callback(request):
+        header = request.headers.get('Range')
+        requested_ranges.append(header)
+        headers = {'Accept-Ranges': 'bytes', 'ETag': etag}
+        if not header or request.headers.get('If-Range', etag) != etag:
+            return 200, headers, body
+
+        start, end = map(int, re.match(r'bytes=(\d+)-(\d+)?', header).groups('-1'))
+        end = len(body) - 1 if end < 0 else end
+        if start >= len(body):
+            return 416, dict(headers, **{'Content-Range': f'bytes */{len(body)}'}), b''
+        headers['Content-Range'] = f'bytes {start}-{end}/{len(body)}'
+        return 206, headers, body[start:end + 1]
+    return callback
+
+
+def write_partial(location, data, validator, size):
+    with open(f'{location}.partial', 'wb') as fp:
+        fp.write(data)
+    with open(f'{location}.partial.resume', 'w') as fp:
+        json.dump({'validator': validator, 'size': size}, fp)
+
+
+class TestDownloadToFile(unittest.TestCase):
+
+    @responses.activate
+    @mock.patch('IA.utils.os.replace')
+    def test_download_to_file_streams_chunks(self, mock_replace):
+        responses.add(
+            responses.Response(
+                responses.GET,
+                'https://localhost:8000/big.zip',
+                body=b'0123456789',
+                stream=True,
+            )
+        )
+
+        with mock.patch('builtins.open', mock.mock_open()) as m:
+            written = download_to_file('https://localhost:8000/big.zip', 'big.zip', chunk_size=4)
+            m.assert_called_with('big.zip.partial', 'wb')
+            mock_replace.assert_called_with('big.zip.partial', 'big.zip')
+            handle = m()
+            # What the response said about the body is recorded first, for resuming.
+            assert_equal(
+                [args for args in handle.write.call_args_list if isinstance(args[0][0], bytes)],
+                [call(b'0123'), call(b'4567'), call(b'89')]
+            )
+
+        assert_equal(written, 10)
+
+    @responses.activate
+    def test_download_to_file_error(self):
+        responses.add(
+            responses.Response(
+                responses.GET,
+                'https://localhost:8000/big.zip',
+                status=404,
+            )
+        )
+
+        with mock.patch('builtins.open', mock.mock_open()) as m:
+            with assert_raises(requests.exceptions.HTTPError):
+                download_to_file('https://localhost:8000/big.zip', 'big.zip')
+            m.assert_not_called()
+
+    @responses.activate
+    def test_download_to_file_resumes_partial(self):
+        body = b'0123456789'
+        requested_ranges = []
+        responses.add_callback(
+            responses.GET,
+            'https://localhost:8000/big.zip',
+            callback=ranged_body(body, requested_ranges),
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            location = os.path.join(tmp, 'big.zip')
+            write_partial(location, body[:6], '"v1"', 10)
+
+            assert_equal(download_to_file('https://localhost:8000/big.zip', location), 10)
+            assert_equal(requested_ranges, ['bytes=6-'])
+            assert_equal(responses.calls[0].request.headers['If-Range'], '"v1"')
+            with open(location, 'rb') as fp:
+                assert_equal(fp.read(), body)
+            assert_equal(os.listdir(tmp), ['big.zip'])
+
+    @responses.activate
+    def test_download_to_file_restarts_changed_partial(self):
+        body = b'abcdefghij'
+        requested_ranges = []
+        responses.add_callback(
+            responses.GET,
+            'https://localhost:8000/big.zip',
+            callback=ranged_body(body, requested_ranges, etag='"v2"'),
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            location = os.path.join(tmp, 'big.zip')
+
+            # The ETag doesn't match, so the server sends all of the new body.
+            write_partial(location, b'012345', '"v1"', 10)
+            download_to_file('https://localhost:8000/big.zip', location)
+            with open(location, 'rb') as fp:
+                assert_equal(fp.read(), body)
+
+            # A body of another size is noticed from Content-Range, even without a validator.
+            write_partial(location, b'012345', None, 12)
+            download_to_file('https://localhost:8000/big.zip', location)
+            with open(location, 'rb') as fp:
+                assert_equal(fp.read(), body)
+            assert 'If-Range' not in responses.calls[1].request.headers
+            assert_equal(requested_ranges[1:], ['bytes=6-', None])
+
+            # A partial with nothing recorded about it isn't trusted.
+            with open(f'{location}.partial', 'wb') as fp:
+                fp.write(b'012345')
+            download_to_file('https://localhost:8000/big.zip', location)
+            assert_equal(requested_ranges[3:], [None])
+            assert_equal(os.listdir(tmp), ['big.zip'])
+
+    @responses.activate
+    def test_download_to_file_range_not_satisfiable(self):
+        body = b'0123456789'
+        requested_ranges = []
+        responses.add_callback(
+            responses.GET,
+            'https://localhost:8000/big.zip',
+            callback=ranged_body(body, requested_ranges),
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            location = os.path.join(tmp, 'big.zip')
+
+            # The partial has every byte already.
+            write_partial(location, body, '"v1"', 10)
+            assert_equal(download_to_file('https://localhost:8000/big.zip', location), 10)
+            assert_equal(requested_ranges, ['bytes=10-'])
+
+            # It's longer than the body is now, so it's downloaded again.
+            write_partial(location, body + b'extra', '"v1"', None)
+            assert_equal(download_to_file('https://localhost:8000/big.zip', location), 10)
+            assert_equal(requested_ranges[1:], ['bytes=15-', None])
+            with open(location, 'rb') as fp:
+                assert_equal(fp.read(), body)
+
+    @responses.activate
+    def test_download_to_file_parallel_ranges(self):
+        body = bytes(range(256)) * 40
+        requested_ranges = []
+        responses.add(
+            responses.HEAD,
+            'https://localhost:8000/big.zip',
+            headers={'Accept-Ranges': 'bytes', 'Content-Length': str(len(body))},
+        )
+        responses.add_callback(
+            responses.GET,
+            'https://localhost:8000/big.zip',
+            callback=ranged_body(body, requested_ranges),
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            location = os.path.join(tmp, 'big.zip')
+            download_to_file('https://localhost:8000/big.zip', location, workers=4)
+            assert_equal(
+                sorted(requested_ranges),
+                ['bytes=0-2559', 'bytes=2560-5119', 'bytes=5120-7679', 'bytes=7680-10239'],
+            )
+            with open(location, 'rb') as fp:
+                assert_equal(fp.read(), body)
+            assert_equal(os.listdir(tmp), ['big.zip'])
+
+    @responses.activate
+    def test_download_to_file_parallel_restarts_changed_body(self):
+        body = b'0123456789ab'
+        requested_ranges = []
+        responses.add(
+            responses.HEAD,
+            'https://localhost:8000/big.zip',
+            headers={'Accept-Ranges': 'bytes', 'Content-Length': '10'},
+        )
+        responses.add_callback(
+            responses.GET,
+            'https://localhost:8000/big.zip',
+            callback=ranged_body(body, requested_ranges),
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            location = os.path.join(tmp, 'big.zip')
+            size = download_to_file('https://localhost:8000/big.zip', location, workers=2)
+            assert_equal(size, 12)
+            assert_equal(requested_ranges[-1], None)
+            with open(location, 'rb') as fp:
+                assert_equal(fp.read(), body)
+            assert_equal(os.listdir(tmp), ['big.zip'])
+
+    @responses.activate
+    def test_download_to_file_parallel_discards_progress_of_changed_body(self):
+        body = b'0123456789'
+        requested_ranges = []
+        responses.add(
+            responses.HEAD,
+            'https://localhost:8000/big.zip',
+            headers={'Accept-Ranges': 'bytes', 'Content-Length': '10', 'ETag': '"v1"'},
+        )
+        responses.add_callback(
+            responses.GET,
+            'https://localhost:8000/big.zip',
+            callback=ranged_body(body, requested_ranges),
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            location = os.path.join(tmp, 'big.zip')
+            with open(f'{location}.partial', 'wb') as fp:
+                fp.write(b'abcde\0\0\0\0\0')
+            with open(f'{location}.partial.ranges', 'w') as fp:
+                json.dump({'size': 10, 'validator': '"v0"', 'progress': [5, 0]}, fp)
+
+            download_to_file('https://localhost:8000/big.zip', location, workers=2)
+            assert_equal(sorted(requested_ranges), ['bytes=0-4', 'bytes=5-9'])
+            assert_equal(
+                {call.request.headers.get('If-Range') for call in responses.calls[1:]},
+                {'"v1"'},
+            )
+            with open(location, 'rb') as fp:
+                assert_equal(fp.read(), body)
+
+    @responses.activate
+    def test_download_to_file_parallel_restarts_body_changed_since_head(self):
+        body = b'0123456789'
+        requested_ranges = []
+        responses.add(
+            responses.HEAD,
+            'https://localhost:8000/big.zip',
+            headers={'Accept-Ranges': 'bytes', 'Content-Length': '10', 'ETag': '"v1"'},
+        )
+        responses.add_callback(
+            responses.GET,
+            'https://localhost:8000/big.zip',
+            callback=ranged_body(body, requested_ranges, etag='"v2"'),
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            location = os.path.join(tmp, 'big.zip')
+            download_to_file('https://localhost:8000/big.zip', location, workers=2)
+            assert_equal(requested_ranges[-1], None)
+            with open(location, 'rb') as fp:
+                assert_equal(fp.read(), body)
+            assert_equal(os.listdir(tmp), ['big.zip'])
+
+    @responses.activate
+    def test_download_to_file_parallel_falls_back_without_ranges(self):
+        responses.add(
+            responses.HEAD,
+            'https://localhost:8000/big.zip',
+            headers={'Content-Length': '10'},
+        )
+        responses.add(
+            responses.GET,
+            'https://localhost:8000/big.zip',
+            body=b'0123456789',
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            location = os.path.join(tmp, 'big.zip')
+            download_to_file('https://localhost:8000/big.zip', location, workers=4)
+            assert_equal(len(responses.calls), 2)
+            assert 'Range' not in responses.calls[1].request.headers
+            with open(location, 'rb') as fp:
+                assert_equal(fp.read(), b'0123456789')
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        reset_session()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        reset_session()
+
+    def test_session_is_shared(self):
+        assert get_session() is get_session()
+
+    def test_connections_are_kept_alive(self):
+        for _ in range(5):
+            assert_equal(get_with_retry(self.url).content, b'ok')
+
+        assert_equal(connection_stats(), {'requests_made': 5, 'connections_opened': 1})
+
+
+def paginated_callback(pages, in_flight, peak):
+    '''
+    Serves `pages` pages of one record each, slowly, keeping track of how many overlap.
+    '''
+    def callback(request):
+        match = re.search(r'page=(\d+)', request.url)
+        page = int(match.group(1)) if match else 1
+        in_flight.append(page)
+        peak.append(len(in_flight))
+        time.sleep(0.05)
+        in_flight.remove(page)
+        body = {
+            'data': [{'id': f'{request.url.split("/")[3]}-{page}'}],
+            'links': {'next': None if page == pages else 'next'},
+            'meta': {'total': pages, 'per_page': 1},
+        }
+        return 200, {}, json.dumps(body)
+    return callback
+
+
+class TestGetPaginatedData(unittest.TestCase):
+
+    @responses.activate
+    def test_get_paginated_data_concurrent_and_ordered(self):
+        in_flight, peak = [], []
+        responses.add_callback(
+            responses.GET,
+            re.compile(r'https://localhost:8000/first/.*'),
+            callback=paginated_callback(20, in_flight, peak),
+        )
+
+        start = time.monotonic()
+        data = asyncio.run(get_paginated_data('https://localhost:8000/first/', concurrency=5))
+        elapsed = time.monotonic() - start
+
+        assert_equal(data, [{'id': f'first-{page}'} for page in range(1, 21)])
+        assert_equal(max(peak), 5)
+        assert elapsed < 20 * 0.05
+
+    @responses.activate
+    def test_get_paginated_data_keeps_no_state_between_calls(self):
+        for name, pages in (('first', 3), ('second', 2)):
+            responses.add_callback(
+                responses.GET,
+                re.compile(f'https://localhost:8000/{name}/.*'),
+                callback=paginated_callback(pages, [], []),
+            )
+
+        asyncio.run(get_paginated_data('https://localhost:8000/first/'))
+        assert_equal(
+            asyncio.run(get_paginated_data('https://localhost:8000/second/')),
+            [{'id': 'second-1'}, {'id': 'second-2'}],
+        )
+
+
+class TestPageIterators(unittest.TestCase):
+
+    @responses.activate
+    def test_aiter_pages_bounded_prefetch(self):
+        responses.add_callback(
+            responses.GET,
+            re.compile(r'https://localhost:8000/first/.*'),
+            callback=paginated_callback(50, [], []),
+        )
+
+        async def first_two():
+            seen = []
+            async for data in aiter_pages('https://localhost:8000/first/', prefetch=3):
+                seen.append(data['data'][0]['id'])
+                if len(seen) == 2:
+                    break
+            return seen
+
+        assert_equal(asyncio.run(first_two()), ['first-1', 'first-2'])
+        # The first page, the one consumed from the prefetch window and the window refilled.
+        assert len(responses.calls) <= 1 + 3 + 1
+
+    def test_iter_pages_fetches_ahead(self):
+        fetched = []
+
+        def fetch(url):
+            fetched.append(url)
+            page = int(url)
+            return {'data': [page], 'links': {'next': str(page + 1) if page < 10 else None}}
+
+        pages = iter_pages('1', fetch=fetch, prefetch=2)
+        assert_equal(next(pages)['data'], [1])
+        time.sleep(0.1)
+        # The producer ran ahead while we weren't looking, but only as far as the queue allows.
+        assert_equal(len(fetched), 4)
+        assert_equal([data['data'][0] for data in pages], list(range(2, 11)))
+
+    def test_iter_pages_raises_fetch_errors(self):
+        def fetch(url):
+            if url == '2':
+                raise requests.exceptions.HTTPError('Status code 500.')
+            return {'data': [], 'links': {'next': '2'}}
+
+        with assert_raises(requests.exceptions.HTTPError):
+            list(iter_pages('1', fetch=fetch))
+
+    def test_bounded_map_submits_a_window_ahead(self):
+        started = []
+
+        def double(item):
+            started.append(item)
+            return item * 2
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = bounded_map(executor, double, range(10), 3)
+            assert_equal(next(results), 0)
+            time.sleep(0.05)
+            assert_equal(sorted(started), [0, 1, 2, 3])
+            assert_equal(list(results), [item * 2 for item in range(1, 10)])
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_token_bucket_spaces_requests(self):
+        limiter = RateLimiter(rate=20, burst=1)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.acquire()
+        assert 0.25 <= time.monotonic() - start < 0.5
+
+    def test_acquire_async(self):
+        limiter = RateLimiter(rate=20, burst=1)
+
+        async def acquire_all():
+            await asyncio.gather(*[limiter.acquire_async() for _ in range(6)])
+
+        start = time.monotonic()
+        asyncio.run(acquire_all())
+        assert 0.25 <= time.monotonic() - start < 0.5
+
+    def test_retry_after_pauses_and_slows_down(self):
+        limiter = RateLimiter(rate=10, burst=10)
+        limiter.update(mock.Mock(status_code=429, headers={'Retry-After': '2'}))
+        assert limiter.reserve() > 1.9
+        assert_equal(limiter.rate, 9)
+
+    def test_throttling_without_retry_after(self):
+        limiter = RateLimiter(rate=10, burst=10)
+        for _ in range(5):
+            limiter.update(mock.Mock(status_code=429, headers={}))
+        assert limiter.reserve() > 0.9
+        assert limiter.rate < 6
+
+        # Errors don't speed it back up, only successes do.
+        rate = limiter.rate
+        limiter.update(mock.Mock(status_code=500, headers={}))
+        assert_equal(limiter.rate, rate)
+        limiter.update(mock.Mock(status_code=200, headers={}))
+        assert limiter.rate > rate
+
+    def test_retry_after_date(self):
+        retry_at = email.utils.formatdate(time.time() + 30, usegmt=True)
+        assert 28 < parse_retry_after(retry_at) <= 30
+        assert_equal(parse_retry_after(email.utils.formatdate(time.time() - 30, usegmt=True)), 0)
+        assert_equal(parse_retry_after('soon'), None)
+
+        limiter = RateLimiter(rate=10, burst=10)
+        limiter.update(mock.Mock(status_code=503, headers={'Retry-After': retry_at}))
+        assert limiter.reserve() > 28
+
+    def test_rate_limit_headers(self):
+        limiter = RateLimiter()
+        assert_equal(limiter.reserve(), 0)
+        limiter.update(
+            mock.Mock(
+                status_code=200,
+                headers={'X-RateLimit-Remaining': '50', 'X-RateLimit-Reset': '10'},
+            ),
+        )
+        assert_equal(limiter.rate, 4.5)
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_backoff_is_capped_and_jittered(self):
+        policy = RetryPolicy(backoff=1, max_backoff=10)
+        delays = [policy.delay(attempt) for attempt in range(1, 20) for _ in range(20)]
+        assert all(0 <= delay <= 10 for delay in delays)
+        assert len(set(delays)) > 1
+        assert max(policy.delay(1) for _ in range(50)) <= 1
+
+    def test_retry_after_is_honored(self):
+        resp = mock.Mock(headers={'Retry-After': '3'})
+        assert_equal(RetryPolicy().delay(1, resp), 3)
+
+    def test_retried_responses_are_closed(self):
+        failed = mock.Mock(status_code=503, headers={})
+        ok = mock.Mock(status_code=200)
+        func = mock.Mock(side_effect=[failed, ok])
+
+        assert_equal(RetryPolicy(sleep_period=0).run(func), ok)
+        failed.close.assert_called_once_with()
+        ok.close.assert_not_called()
+
+    @responses.activate
+    def test_connection_errors_are_retried(self):
+        responses.add(
+            responses.GET,
+            'https://localhost:8000/flaky',
+            body=requests.exceptions.ConnectionError('Connection reset by peer'),
+        )
+        responses.add(responses.GET, 'https://localhost:8000/flaky', status=503)
+        responses.add(responses.GET, 'https://localhost:8000/flaky', body=b'ok')
+
+        resp = get_with_retry('https://localhost:8000/flaky', sleep_period=0)
+        assert_equal(resp.content, b'ok')
+        assert_equal(len(responses.calls), 3)
+
+    @responses.activate
+    def test_unrewindable_put_is_not_retried(self):
+        responses.add(
+            responses.PUT,
+            'https://localhost:8000/upload',
+            body=requests.exceptions.ConnectionError('Connection reset by peer'),
+        )
+
+        with assert_raises(requests.exceptions.ConnectionError):
+            put_with_retry('https://localhost:8000/upload', iter([b'content']), sleep_period=0)
+        assert_equal(len(responses.calls), 1)
@@ -0,0 +1,190 @@
+import os
+import io
+import hashlib
+import zipfile
+import tempfile
+import unittest
+import mock
+from nose.tools import assert_equal, assert_raises
+from IA.digests import DigestSidecar
+from IA.zip_stream import (
+    extract_parallel,
+    extract_stream,
+    UnsupportedZipStream,
+    ZipWriter,
+)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class Unseekable(io.RawIOBase):
+    '''
+    Forces zipfile to write data descriptors, like zips streamed by OSF do.
+    '''
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+def chunked(data, size=7):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+def streamed_zip(members, compression=zipfile.ZIP_DEFLATED, force_zip64=False):
+    target = Unseekable()
+    with zipfile.ZipFile(target, 'w', compression=compression) as zip_file:
+        for name, data in members.items():
+            with zip_file.open(name, 'w', force_zip64=force_zip64) as fp:
+                fp.write(data)
+    return target.buffer.getvalue()
+
+
+class TestZipStream(unittest.TestCase):
+
+    def test_extract_stream_fixture(self):
+        with open(os.path.join(HERE, 'fixtures/jj81a.zip'), 'rb') as fp:
+            data = fp.read()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            extracted = extract_stream(chunked(data), tmp)
+            with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+                expected = [info for info in zip_file.infolist() if not info.is_dir()]
+                assert_equal(extracted, [os.path.join(tmp, info.filename) for info in expected])
+                for info in expected:
+                    with open(os.path.join(tmp, info.filename), 'rb') as fp:
+                        assert_equal(fp.read(), zip_file.read(info))
+
+    def test_extract_stream_data_descriptors_and_zip64(self):
+        members = {'a/b.txt': os.urandom(5000), 'c.txt': b'c' * 100000}
+        data = streamed_zip(members, force_zip64=True)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            extract_stream(chunked(data, 1000), tmp)
+            for name, content in members.items():
+                with open(os.path.join(tmp, name), 'rb') as fp:
+                    assert_equal(fp.read(), content)
+
+    def test_extract_stream_rejects_bad_crc(self):
+        target = io.BytesIO()
+        with zipfile.ZipFile(target, 'w') as zip_file:
+            zip_file.writestr('a.txt', b'a' * 100)
+        data = bytearray(target.getvalue())
+        data[40] ^= 0xFF  # flip a byte of the stored member
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with assert_raises(zipfile.BadZipFile):
+                extract_stream(chunked(bytes(data)), tmp)
+
+    def test_extract_stream_stored_without_sizes(self):
+        data = streamed_zip({'a.txt': b'a' * 100}, compression=zipfile.ZIP_STORED)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+                assert zip_file.infolist()[0].flag_bits & 0x08
+            with assert_raises(UnsupportedZipStream):
+                extract_stream(chunked(data), tmp)
+
+    def test_extract_parallel(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with zipfile.ZipFile(os.path.join(HERE, 'fixtures/jj81a.zip')) as zip_file:
+                extract_parallel(zip_file, tmp, 4)
+                for info in zip_file.infolist():
+                    path = os.path.join(tmp, info.filename)
+                    if info.is_dir():
+                        assert os.path.isdir(path)
+                    else:
+                        with open(path, 'rb') as fp:
+                            assert_equal(fp.read(), zip_file.read(info))
+
+    def test_extract_records_digests(self):
+        members = {'a/one.txt': b'one' * 1000, 'two.bin': bytes(range(256))}
+        data = streamed_zip(members)
+
+        for extract in (
+            lambda destination, digests: extract_stream(chunked(data), destination, digests),
+            lambda destination, digests: extract_parallel(
+                zipfile.ZipFile(io.BytesIO(data)),
+                destination,
+                2,
+                digests,
+            ),
+        ):
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'guid')
+                digests = DigestSidecar(path, ['sha256'])
+                extract(os.path.join(path, 'files'), digests)
+                recorded = digests.load()
+                for name, content in members.items():
+                    entry = recorded[os.path.join('files', name)]
+                    assert_equal(entry['sha256'], hashlib.sha256(content).hexdigest())
+                    assert_equal(entry['size'], len(content))
+
+    def write_zip(self, tmp, members, **kwargs):
+        files = []
+        for name, content in members.items():
+            location = os.path.join(tmp, name.replace('/', '_'))
+            with open(location, 'wb') as fp:
+                fp.write(content)
+            files.append((location, name))
+
+        target = Unseekable()
+        with ZipWriter(target, **kwargs) as zip_file:
+            zip_file.write_files(files)
+        return target.buffer.getvalue()
+
+    def test_zip_writer(self):
+        members = {
+            'bagit.txt': b'BagIt-Version: 0.97\n',
+            'data/empty.txt': b'',
+            'data/big.bin': os.urandom(5000) + b'a' * 20000,
+        }
+        for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            with tempfile.TemporaryDirectory() as tmp:
+                # Small blocks, so big.bin is compressed by several workers at once.
+                data = self.write_zip(
+                    tmp,
+                    members,
+                    compression=compression,
+                    workers=3,
+                    block_size=1000,
+                )
+
+                zip_file = zipfile.ZipFile(io.BytesIO(data))
+                assert zip_file.testzip() is None
+                assert_equal(zip_file.namelist(), list(members))
+                for name, content in members.items():
+                    assert_equal(zip_file.read(name), content)
+                    assert_equal(zip_file.getinfo(name).compress_type, compression)
+
+                destination = os.path.join(tmp, 'extracted')
+                extract_stream(chunked(data, 333), destination)
+                for name, content in members.items():
+                    with open(os.path.join(destination, name), 'rb') as fp:
+                        assert_equal(fp.read(), content)
+
+    def test_zip_writer_unsupported_compression(self):
+        with assert_raises(ValueError):
+            ZipWriter(Unseekable(), compression=zipfile.ZIP_BZIP2)
+
+    def test_zip_writer_zip64(self):
+        members = {f'{i}.txt': str(i).encode() * i for i in range(5)}
+        with tempfile.TemporaryDirectory() as tmp:
+            data = self.write_zip(tmp, members, force_zip64=True)
+            zip_file = zipfile.ZipFile(io.BytesIO(data))
+            assert zip_file.testzip() is None
+            for name, content in members.items():
+                assert_equal(zip_file.read(name), content)
+
+            # More members than the end of central directory record can count.
+            with mock.patch('IA.zip_stream.ZIP_FILECOUNT_LIMIT', 3):
+                data = self.write_zip(tmp, members)
+            assert b'PK\x06\x06' in data and b'PK\x06\x07' in data
+            zip_file = zipfile.ZipFile(io.BytesIO(data))
+            assert_equal(len(zip_file.namelist()), 5)
+            assert zip_file.testzip() is None
@@ -0,0 +1,145 @@
+import os
+import threading
+from typing import Dict, Optional
+from IA import jsonl
+
+JOURNAL_SUFFIX = '.upload-journal.jsonl'
+
+
+class UploadJournal:
+    '''
+    An append-only JSON lines record of uploads to Internet Archive, so a rerun after a crash can
+    skip files that already made it and pick multipart uploads back up where they stopped instead
+    of orphaning them. Every line is one of:
+
+        {"event": "start", "key": ..., "upload_id": ..., "size": ..., "mtime_ns": ..., "md5": ...,
+         "part_size": ...}
+        {"event": "part", "key": ..., "upload_id": ..., "part_num": ..., "etag": ...}
+        {"event": "complete", "key": ..., "size": ..., "mtime_ns": ..., "md5": ...}
+
+    Files are matched by size and mtime, so one the journal has never seen isn't read to find out.
+    The md5 is only there when it was known without reading the file for it, and a file that
+    matches one is hashed to confirm it.
+    '''
+
+    def __init__(self, location: str):
+        self.location = location
+        self.lock = threading.Lock()
+        self.files = {}
+        for record in jsonl.load(location):
+            self.apply(record)
+
+    @classmethod
+    def for_directory(cls, parent: str) -> 'UploadJournal':
+        '''
+        The journal lives next to the directory rather than in it, so it's never uploaded itself.
+        '''
+        return cls(os.path.abspath(parent) + JOURNAL_SUFFIX)
+
+    def apply(self, record: Dict):
+        key = record['key']
+        if record['event'] == 'start':
+            self.files[key] = {
+                'upload_id': record['upload_id'],
+                'size': record['size'],
+                'mtime_ns': record.get('mtime_ns'),
+                'md5': record['md5'],
+                'part_size': record['part_size'],
+                'parts': {},
+                'complete': False,
+            }
+        elif record['event'] == 'part':
+            state = self.files.get(key)
+            if state and state['upload_id'] == record['upload_id']:
+                state['parts'][record['part_num']] = record['etag']
+        elif record['event'] == 'complete':
+            self.files[key] = {
+                'upload_id': None,
+                'size': record['size'],
+                'mtime_ns': record.get('mtime_ns'),
+                'md5': record['md5'],
+                'part_size': None,
+                'parts': {},
+                'complete': True,
+            }
+
+    def append(self, record: Dict):
+        with self.lock:
+            self.apply(record)
+            jsonl.append(self.location, record)
+
+    def recorded_md5(self, key: str, size: int, mtime_ns: int) -> Optional[str]:
+        '''
+        The md5 recorded for `key` if the journal has it at this size and mtime, to check the file
+        against before trusting the match.
+        '''
+        state = self.files.get(key)
+        if state and (state['size'], state['mtime_ns']) == (size, mtime_ns):
+            return state['md5']
+        return None
+
+    def _matches(self, key: str, size: int, mtime_ns: int, md5: Optional[str]) -> Optional[Dict]:
+        state = self.files.get(key)
+        if not state or (state['size'], state['mtime_ns']) != (size, mtime_ns):
+            return None
+        if state['md5'] not in (None, md5):
+            return None
+        return state
+
+    def is_uploaded(self, key: str, size: int, mtime_ns: int, md5: Optional[str]) -> bool:
+        state = self._matches(key, size, mtime_ns, md5)
+        return bool(state and state['complete'])
+
+    def pending_upload(
+            self,
+            key: str,
+            size: int,
+            mtime_ns: int,
+            md5: Optional[str],
+            part_size: int) -> Optional[Dict]:
+        '''
+        Returns the upload id and finished parts of an interrupted multipart upload of the same
+        file, split the same way, if there is one.
+        '''
+        state = self._matches(key, size, mtime_ns, md5)
+        if not state or state['complete']:
+            return None
+        if state['part_size'] != part_size:
+            return None
+        return {'upload_id': state['upload_id'], 'parts': dict(state['parts'])}
+
+    def start(
+            self,
+            key: str,
+            upload_id: str,
+            size: int,
+            mtime_ns: int,
+            md5: Optional[str],
+            part_size: int):
+        self.append({
+            'event': 'start',
+            'key': key,
+            'upload_id': upload_id,
+            'size': size,
+            'mtime_ns': mtime_ns,
+            'md5': md5,
+            'part_size': part_size,
+        })
+
+    def part_done(self, key: str, upload_id: str, part_num: int, etag: str):
+        self.append({
+            'event': 'part',
+            'key': key,
+            'upload_id': upload_id,
+            'part_num': part_num,
+            'etag': etag,
+        })
+
+    def finish(self, key: str, size: int, mtime_ns: int, md5: Optional[str]):
+        self.append({
+            'event': 'complete',
+            'key': key,
+            'size': size,
+            'mtime_ns': mtime_ns,
+            'md5': md5,
+        })
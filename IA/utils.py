@@ -1,73 +1,884 @@
+import os
+import re
+import json
 import math
+import hashlib
+import time
 import asyncio
+import logging
+import functools
+import threading
+import queue
+import random
+import email.utils
+import http.client
+import boto
 import requests
-from typing import Tuple, Dict
-from ratelimit import sleep_and_retry
-from ratelimit.exception import RateLimitException
+import settings
+from boto.exception import BotoServerError
+from IA.json_backend import loads
+from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from concurrent.futures import Executor, ThreadPoolExecutor
+from collections import deque
+from datetime import datetime, timezone
+from typing import (
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Tuple,
+    Union,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    '''
+    How many seconds a Retry-After header asks for, whether it's given in seconds or as an HTTP
+    date, or None if there's no header or it can't be read.
+    '''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class RateLimiter:
+    '''
+    A token bucket shared by every thread and coroutine talking to one host, so requests are spaced
+    out ahead of time instead of everyone running into a 429 and sleeping at once. It starts from
+    the host's RATE_LIMITS entry, if any, and adapts from what the server says:
+
+    - A 429 or 503 pauses every caller for its Retry-After, or RATE_LIMIT_PAUSE without one, and
+      the rate drops below what was being sent.
+    - X-RateLimit-Remaining/X-RateLimit-Reset (or RateLimit-*) spread the remaining requests
+      evenly over the rest of the window.
+    - Otherwise the rate creeps back up by RATE_LIMIT_RECOVERY per successful response.
+    '''
+
+    def __init__(self, rate: float = None, burst: int = 1):
+        self.rate = rate
+        self.ceiling = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.sent = deque(maxlen=50)
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        '''
+        Takes a token and returns how long to wait before using it.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0, self.paused_until - now)
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+            self.sent.append(now + wait)
+            return wait
+
+    def acquire(self):
+        time.sleep(self.reserve())
+
+    async def acquire_async(self):
+        await asyncio.sleep(self.reserve())
+
+    def sending_rate(self) -> Optional[float]:
+        if len(self.sent) < 2 or self.sent[-1] <= self.sent[0]:
+            return None
+        return (len(self.sent) - 1) / (self.sent[-1] - self.sent[0])
+
+    def update(self, resp: requests.Response):
+        headers = resp.headers
+        with self.lock:
+            now = time.monotonic()
+            if resp.status_code in (429, 503):
+                pause = parse_retry_after(headers.get('Retry-After'))
+                if pause is None:
+                    pause = settings.RATE_LIMIT_PAUSE
+                self.paused_until = max(self.paused_until, now + pause)
+                current = self.rate or self.sending_rate()
+                if current:
+                    self.rate = current * settings.RATE_LIMIT_BACKOFF
+                    self.tokens = min(self.tokens, 0)
+                    self.updated = now
+                return
+
+            remaining = headers.get('X-RateLimit-Remaining', headers.get('RateLimit-Remaining'))
+            reset = headers.get('X-RateLimit-Reset', headers.get('RateLimit-Reset'))
+            if remaining is not None and reset is not None:
+                try:
+                    remaining, reset = float(remaining), float(reset)
+                except ValueError:
+                    return
+                if reset > 1e9:
+                    # An epoch timestamp rather than a number of seconds.
+                    reset -= time.time()
+                if reset > 0:
+                    self.rate = max(remaining, 1) / reset * settings.RATE_LIMIT_BACKOFF
+                    return
+
+            if not 200 <= resp.status_code < 300:
+                return
+            if self.rate and (self.ceiling is None or self.rate < self.ceiling):
+                self.rate *= 1 + settings.RATE_LIMIT_RECOVERY
+                if self.ceiling:
+                    self.rate = min(self.rate, self.ceiling)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(url: str) -> RateLimiter:
+    host = urlparse(url).netloc
+    with _rate_limiters_lock:
+        if host not in _rate_limiters:
+            rate, burst = settings.RATE_LIMITS.get(host, (None, 1))
+            _rate_limiters[host] = RateLimiter(rate, burst)
+        return _rate_limiters[host]
+
+
+class PooledSession(requests.Session):
+    '''
+    A Session that keeps up to HTTP_POOL_MAXSIZE connections alive per host, applies HTTP_TIMEOUT
+    to every request and counts requests made, so that can be compared with connections opened.
+    Every request waits its turn with the host's RateLimiter.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.requests_made = 0
+        for prefix in ('http://', 'https://'):
+            self.mount(
+                prefix,
+                HTTPAdapter(
+                    pool_connections=settings.HTTP_POOL_CONNECTIONS,
+                    pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+                ),
+            )
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', settings.HTTP_TIMEOUT)
+        with self.lock:
+            self.requests_made += 1
+        limiter = get_rate_limiter(url)
+        limiter.acquire()
+        resp = super().request(method, url, **kwargs)
+        limiter.update(resp)
+        return resp
+
+    def connections_opened(self) -> int:
+        opened = 0
+        for adapter in self.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    opened += pool.num_connections
+        return opened
+
+
+_session = None
+_session_lock = threading.Lock()
+_s3_connections = threading.local()
+
+
+def get_session() -> PooledSession:
+    '''
+    Returns the process-wide session every script makes its requests through.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = PooledSession()
+        return _session
+
+
+def reset_session():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+    with _rate_limiters_lock:
+        _rate_limiters.clear()
+
+
+def connection_stats() -> Dict[str, int]:
+    session = get_session()
+    return {
+        'requests_made': session.requests_made,
+        'connections_opened': session.connections_opened(),
+    }
+
+
+def get_s3_connection() -> S3Connection:
+    '''
+    boto connections aren't safe to share between threads, so each thread keeps one for its whole
+    life rather than connecting for every file.
+    '''
+    if not hasattr(_s3_connections, 'connection'):
+        _s3_connections.connection = boto.connect_s3(
+            settings.IA_ACCESS_KEY,
+            settings.IA_SECRET_KEY,
+            host=f'{settings.IA_URL}',
+            is_secure=False,
+            calling_format=OrdinaryCallingFormat(),
+        )
+    return _s3_connections.connection
+
+
+class RetryPolicy:
+    '''
+    How a request, or any other call, is retried: up to `max_attempts` tries, waiting Retry-After
+    when the server sends one and otherwise a capped exponential backoff with full jitter. Responses
+    whose status is in `retry_on` are retried, as are exceptions in `retry_exceptions` (or carrying
+    a retryable `status`, like boto's). Calls that aren't idempotent are only retried when the
+    request can't have reached the server. Every attempt is logged with how long it took.
+    '''
+
+    def __init__(
+            self,
+            retry_on: Tuple[int] = (),
+            max_attempts: int = None,
+            backoff: float = None,
+            max_backoff: float = None,
+            sleep_period: float = None,
+            retry_exceptions: Tuple[type] = None):
+        self.retry_on = tuple(retry_on) + tuple(settings.RETRY_ON_STATUSES)
+        self.max_attempts = max_attempts or settings.RETRY_MAX_ATTEMPTS
+        self.backoff = settings.RETRY_BACKOFF if backoff is None else backoff
+        self.max_backoff = settings.RETRY_MAX_BACKOFF if max_backoff is None else max_backoff
+        self.sleep_period = sleep_period
+        self.retry_exceptions = retry_exceptions or RETRYABLE_EXCEPTIONS
+
+    def delay(self, attempt: int, resp: requests.Response = None) -> float:
+        if self.sleep_period is not None:
+            return self.sleep_period
+        if resp is not None:
+            retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+            if retry_after is not None:
+                return retry_after
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def is_retryable(self, error: BaseException, idempotent: bool) -> bool:
+        if not idempotent and not isinstance(error, UNSENT_REQUEST_EXCEPTIONS):
+            return False
+        status = getattr(error, 'status', None)
+        if isinstance(status, int):
+            return status in self.retry_on or status >= 500
+        return isinstance(error, self.retry_exceptions)
+
+    def run(self, func, *args, description: str = None, idempotent: bool = True, **kwargs):
+        description = description or getattr(func, '__name__', 'call')
+        for attempt in range(1, self.max_attempts + 1):
+            start = time.monotonic()
+            resp = None
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_attempts or not self.is_retryable(e, idempotent):
+                    raise
+                outcome = repr(e)
+            else:
+                status = getattr(result, 'status_code', None)
+                if status not in self.retry_on or attempt == self.max_attempts:
+                    return result
+                resp = result
+                outcome = f'status {status}'
+                # Its body is never read, so give the connection back before sleeping.
+                resp.close()
+
+            delay = self.delay(attempt, resp)
+            logger.info(
+                f'{description} attempt {attempt}/{self.max_attempts} failed with {outcome} after '
+                f'{time.monotonic() - start:.2f}s, retrying in {delay:.2f}s',
+            )
+            time.sleep(delay)
+
+
+# Errors where the request can be sent again as is, provided it's idempotent.
+RETRYABLE_EXCEPTIONS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    ConnectionError,
+    http.client.HTTPException,
+    BotoServerError,
+)
+
+# Errors raised before the request was sent, so even non-idempotent calls can be retried.
+UNSENT_REQUEST_EXCEPTIONS = (
+    requests.exceptions.ConnectTimeout,
+)
 
 
-@sleep_and_retry
 def get_with_retry(
         url,
         retry_on: Tuple[int] = (),
         sleep_period: int = None,
-        headers: Dict = None) -> requests.Response:
-
-    resp = requests.get(url, headers=headers)
-    if resp.status_code in retry_on:
-        raise RateLimitException(
-            message='Too many requests, sleeping.',
-            period_remaining=sleep_period or int(resp.headers.get('Retry-After') or 0)
-        )  # This will be caught by @sleep_and_retry and retried
-
-    return resp
+        headers: Dict = None,
+        stream: bool = False,
+        policy: RetryPolicy = None) -> requests.Response:
+    policy = policy or RetryPolicy(retry_on=retry_on, sleep_period=sleep_period)
+    return policy.run(
+        get_session().get,
+        url,
+        headers=headers,
+        stream=stream,
+        description=f'GET {url}',
+    )
 
 
-@sleep_and_retry
 def put_with_retry(
         url: str,
-        data: bytes,
+        data: Union[bytes, BinaryIO],
         headers: dict = None,
         retry_on: Tuple[int] = (),
-        sleep_period: int = None) -> requests.Response:
+        sleep_period: int = None,
+        policy: RetryPolicy = None) -> requests.Response:
+    '''
+    `data` can be a file-like object, which is streamed from the start on every attempt. Bodies
+    that can't be rewound aren't retried once they may have been sent.
+    '''
 
     if headers is None:
         headers = {}
 
-    resp = requests.put(url, headers=headers, data=data)
-    if resp.status_code in retry_on:
-        raise RateLimitException(
-            message='Too many requests, sleeping.',
-            period_remaining=sleep_period or int(resp.headers.get('Retry-After') or 0)
-        )  # This will be caught by @sleep_and_retry and retried
+    def put():
+        if hasattr(data, 'seek'):
+            data.seek(0)
+        return get_session().put(url, headers=headers, data=data)
+
+    policy = policy or RetryPolicy(retry_on=retry_on, sleep_period=sleep_period)
+    return policy.run(
+        put,
+        description=f'PUT {url}',
+        idempotent=isinstance(data, (bytes, str)) or hasattr(data, 'seek'),
+    )
+
+
+class HostLimiter:
+    '''
+    Hands out one semaphore per host so no host ever has more than `limit` requests in flight.
+    Create it inside the running event loop.
+    '''
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.semaphores = {}
+
+    def __call__(self, url: str) -> asyncio.Semaphore:
+        host = urlparse(url).netloc
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.limit)
+        return self.semaphores[host]
+
+
+async def run_blocking(func, *args, executor: Executor = None, **kwargs):
+    '''
+    Runs a blocking call such as put_with_retry on an executor thread, so other uploads and
+    downloads can make progress on the event loop in the meantime.
+    '''
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+def bounded_map(executor: Executor, func: Callable, items: Iterable, window: int) -> Iterator:
+    '''
+    Like `executor.map`, yields `func(item)` for every item in order, but only submits `window`
+    calls ahead of the one being consumed, so neither the calls waiting to run nor the results
+    waiting on an earlier one pile up.
+    '''
+    items = iter(items)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window:
+                break
+        while pending:
+            result = pending.popleft().result()
+            for item in items:
+                pending.append(executor.submit(func, item))
+                break
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def file_md5(fp: BinaryIO, chunk_size: int = None) -> str:
+    fp.seek(0)
+    md5 = hashlib.md5()
+    for chunk in iter(lambda: fp.read(chunk_size or settings.DOWNLOAD_CHUNK_SIZE), b''):
+        md5.update(chunk)
+    fp.seek(0)
+    return md5.hexdigest()
+
+
+def multipart_etag(fp: BinaryIO, part_size: int) -> str:
+    '''
+    The ETag S3 gives a multipart upload of the file in `part_size` parts: the md5 of the parts'
+    md5s, then a dash and how many parts there were.
+    '''
+    fp.seek(0)
+    digests = []
+    while True:
+        md5 = hashlib.md5()
+        remaining = part_size
+        while remaining:
+            chunk = fp.read(min(remaining, settings.DOWNLOAD_CHUNK_SIZE))
+            if not chunk:
+                break
+            md5.update(chunk)
+            remaining -= len(chunk)
+        if remaining == part_size:
+            break
+        digests.append(md5.digest())
+    fp.seek(0)
+    return f'{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}'
+
+
+class RangesUnsupported(Exception):
+    pass
 
-    return resp
 
+class ContentChanged(Exception):
+    pass
 
-async def get_pages(url, page, result={}):
-    url = f'{url}?page={page}'
-    resp = get_with_retry(url, retry_on=(429,))
-    result[page] = resp.json()['data']
-    return result
 
+# bytes 0-99/1000, or bytes */1000 on a 416.
+CONTENT_RANGE = re.compile(r'^bytes (?:(\d+)-\d+|\*)/(\d+)$')
 
-async def get_paginated_data(url):
 
-    data = get_with_retry(url, retry_on=(429,)).json()
-    result = {1: data['data']}
+# Errors that mean a download was cut off part way through and can be resumed.
+INTERRUPTED_DOWNLOAD_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+def get_ranged_body(url: str, headers: Dict = None) -> Optional[Tuple[int, Optional[str]]]:
+    '''
+    Returns the size of the body at `url` and its validator if the server advertises byte range
+    support for it, otherwise None.
+    '''
+    try:
+        resp = get_session().head(url, headers=headers, allow_redirects=True)
+    except requests.exceptions.RequestException:
+        return None
+
+    if resp.status_code != 200 or resp.headers.get('Accept-Ranges') != 'bytes':
+        return None
+
+    try:
+        return int(resp.headers['Content-Length']), _validator(resp)
+    except (KeyError, ValueError):
+        return None
+
+
+def download_to_file(
+        url: str,
+        location: str,
+        headers: Dict = None,
+        retry_on: Tuple[int] = (),
+        chunk_size: int = None,
+        workers: int = None) -> int:
+    '''
+    Streams the body of a GET request to `location` in fixed-size chunks as they arrive, so peak
+    memory stays at roughly one chunk no matter how big the body is. Bytes land in
+    `{location}.partial` first, and an interrupted download is resumed from there with a Range
+    request. A resume only carries on from the partial if the server shows it's still the same
+    body, by If-Range and the total in Content-Range, and starts over otherwise. With more than one
+    worker the body is fetched as that many byte ranges in parallel when the server advertises
+    `Accept-Ranges`, otherwise it falls back to a single stream. Returns the size of the
+    downloaded file.
+    '''
+    chunk_size = chunk_size or settings.DOWNLOAD_CHUNK_SIZE
+    workers = workers or settings.DOWNLOAD_WORKERS
+    partial = f'{location}.partial'
+    start = time.monotonic()
+
+    ranged = None
+    if workers > 1:
+        ranged = get_ranged_body(url, headers=headers)
+        if ranged is None:
+            logger.info(f'{url} does not support byte ranges, falling back to a single stream.')
+
+    try:
+        if ranged and ranged[0]:
+            size, validator = ranged
+            transferred = _download_ranges(
+                url, partial, size, validator, workers, headers, chunk_size,
+            )
+        else:
+            size, transferred = _download_stream(url, partial, headers, retry_on, chunk_size)
+    except RangesUnsupported:
+        logger.info(f'{url} ignored a Range request, falling back to a single stream.')
+        _remove_partial(partial)
+        size, transferred = _download_stream(url, partial, headers, retry_on, chunk_size)
+    except ContentChanged:
+        logger.info(f'{url} changed while it was being downloaded, starting over.')
+        _remove_partial(partial)
+        size, transferred = _download_stream(url, partial, headers, retry_on, chunk_size)
+
+    os.replace(partial, location)
+    _remove_partial(partial)
+
+    elapsed = time.monotonic() - start
+    logger.info(
+        f'Downloaded {transferred} bytes to {location} in {elapsed:.2f}s '
+        f'({transferred / max(elapsed, 1e-6):.0f} bytes/sec)',
+    )
+    return size
+
+
+def iter_download(
+        url: str,
+        headers: Dict = None,
+        retry_on: Tuple[int] = (),
+        chunk_size: int = None) -> Iterator[bytes]:
+    '''
+    Yields the body of a GET request in fixed-size chunks for consumers that process it on the fly
+    rather than landing it on disk.
+    '''
+    resp = get_with_retry(url, retry_on=retry_on, headers=headers, stream=True)
+    try:
+        resp.raise_for_status()
+        yield from resp.iter_content(chunk_size=chunk_size or settings.DOWNLOAD_CHUNK_SIZE)
+    finally:
+        resp.close()
+
+
+def _remove_partial(partial: str):
+    for leftover in (partial, f'{partial}.ranges', f'{partial}.resume'):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+def _validator(resp: requests.Response) -> Optional[str]:
+    '''
+    What to send as If-Range to get the rest of the body in `resp` only if it hasn't changed: a
+    strong ETag, or else Last-Modified.
+    '''
+    etag = resp.headers.get('ETag')
+    return etag if etag and not etag.startswith('W/') else resp.headers.get('Last-Modified')
+
+
+def _save_resume(partial: str, resp: requests.Response) -> Dict:
+    '''
+    Records what a full response said about its body, so a later resume can tell whether the
+    partial is still a prefix of it: a strong ETag or else Last-Modified to send as If-Range, and
+    the total size, unless the body is encoded and the partial won't be that size anyway.
+    '''
+    size = resp.headers.get('Content-Length')
+    resume = {
+        'validator': _validator(resp),
+        'size': int(size) if size and 'Content-Encoding' not in resp.headers else None,
+    }
+    with open(f'{partial}.resume', 'w') as fp:
+        json.dump(resume, fp)
+    return resume
+
+
+def _load_resume(partial: str) -> Optional[Dict]:
+    if not os.path.exists(partial):
+        return None
+    try:
+        with open(f'{partial}.resume', 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_stale_resume(resp: requests.Response, offset: int, size: Optional[int]) -> bool:
+    '''
+    Whether the response to a Range request from `offset` shows the partial isn't a prefix of the
+    body any more: a range that starts elsewhere or is of a body of another size, or a 416 that
+    isn't because the partial has all `size` bytes of it already.
+    '''
+    if resp.status_code not in (206, 416):
+        return False
+    match = CONTENT_RANGE.match(resp.headers.get('Content-Range', ''))
+    if not match:
+        return True
+    start, total = match.group(1), int(match.group(2))
+    if resp.status_code == 416:
+        return total != offset or size not in (None, offset)
+    return int(start) != offset or size not in (None, total)
+
+
+def _download_stream(
+        url: str,
+        partial: str,
+        headers: Dict,
+        retry_on: Tuple[int],
+        chunk_size: int) -> Tuple[int, int]:
+    if os.path.exists(f'{partial}.ranges'):
+        # A ranged download leaves holes in the file, so its size says nothing about progress.
+        _remove_partial(partial)
+
+    resume = _load_resume(partial)
+    if resume is None:
+        # Nothing says what body the partial is of, so it can't be safely carried on from.
+        _remove_partial(partial)
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    transferred = 0
+
+    for attempt in range(settings.DOWNLOAD_RETRIES + 1):
+        request_headers = dict(headers or {})
+        if offset:
+            request_headers['Range'] = f'bytes={offset}-'
+            if resume['validator']:
+                # The server sends the whole body instead if it's changed since.
+                request_headers['If-Range'] = resume['validator']
+
+        resp = None
+        try:
+            resp = get_with_retry(url, retry_on=retry_on, headers=request_headers, stream=True)
+            if offset and _is_stale_resume(resp, offset, resume['size']):
+                logger.info(f'{url} changed since {partial} was started, downloading it again.')
+                resp.close()
+                _remove_partial(partial)
+                offset = 0
+                resp = get_with_retry(url, retry_on=retry_on, headers=headers, stream=True)
+            elif offset and resp.status_code == 416:
+                # Nothing left to fetch, the previous attempt got every byte.
+                return offset, transferred
+            resp.raise_for_status()
+
+            if resp.status_code != 206:
+                offset = 0
+                resume = _save_resume(partial, resp)
+            with open(partial, 'ab' if offset else 'wb') as fp:
+                for chunk in resp.iter_content(chunk_size=chunk_size):
+                    fp.write(chunk)
+                    offset += len(chunk)
+                    transferred += len(chunk)
+            return offset, transferred
+        except INTERRUPTED_DOWNLOAD_ERRORS as e:
+            if attempt == settings.DOWNLOAD_RETRIES:
+                raise
+            delay = RetryPolicy().delay(attempt + 1)
+            logger.warning(
+                f'Download of {url} interrupted ({e}), resuming at byte {offset} in {delay:.2f}s.',
+            )
+            time.sleep(delay)
+        finally:
+            if resp is not None:
+                resp.close()
+
+
+def _download_ranges(
+        url: str,
+        partial: str,
+        size: int,
+        validator: Optional[str],
+        workers: int,
+        headers: Dict,
+        chunk_size: int) -> int:
+    progress_location = f'{partial}.ranges'
+    step = math.ceil(size / workers)
+    bounds = [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+    progress = None
+    if os.path.exists(partial) and os.path.exists(progress_location):
+        with open(progress_location, 'r') as fp:
+            state = json.load(fp)
+        # Ranges fetched before the body changed are of another body, so they're thrown away.
+        if (state['size'] == size and state.get('validator') == validator
+                and len(state['progress']) == len(bounds)):
+            progress = state['progress']
+
+    if progress is None:
+        progress = [0] * len(bounds)
+        with open(partial, 'wb') as fp:
+            fp.truncate(size)
+
+    lock = threading.Lock()
+    transferred = [0]
+
+    def save_progress():
+        with open(f'{progress_location}.tmp', 'w') as fp:
+            json.dump({'size': size, 'validator': validator, 'progress': progress}, fp)
+        os.replace(f'{progress_location}.tmp', progress_location)
+
+    def fetch_range(index):
+        start, end = bounds[index]
+        for attempt in range(settings.DOWNLOAD_RETRIES + 1):
+            offset = start + progress[index]
+            if offset > end:
+                return
+
+            request_headers = dict(headers or {})
+            request_headers['Range'] = f'bytes={offset}-{end}'
+            if validator:
+                request_headers['If-Range'] = validator
+            resp = None
+            try:
+                resp = get_with_retry(url, headers=request_headers, stream=True)
+                resp.raise_for_status()
+                if resp.status_code != 206:
+                    # With If-Range the whole body comes back because it's changed since the HEAD.
+                    raise (ContentChanged if validator else RangesUnsupported)(url)
+                if _is_stale_resume(resp, offset, size):
+                    raise ContentChanged(url)
+
+                with open(partial, 'r+b') as fp:
+                    fp.seek(offset)
+                    for chunk in resp.iter_content(chunk_size=chunk_size):
+                        fp.write(chunk)
+                        with lock:
+                            progress[index] += len(chunk)
+                            transferred[0] += len(chunk)
+                            save_progress()
+                return
+            except INTERRUPTED_DOWNLOAD_ERRORS as e:
+                if attempt == settings.DOWNLOAD_RETRIES:
+                    raise
+                delay = RetryPolicy().delay(attempt + 1)
+                logger.warning(
+                    f'Range {start}-{end} of {url} interrupted ({e}), resuming in {delay:.2f}s.',
+                )
+                time.sleep(delay)
+            finally:
+                if resp is not None:
+                    resp.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(fetch_range, range(len(bounds))))
+
+    os.remove(progress_location)
+    return transferred[0]
+
+
+def page_url(url: str, page: int) -> str:
+    separator = '&' if '?' in url else '?'
+    return f'{url}{separator}page={page}'
+
+
+def page_count(data: Dict) -> int:
+    # Some endpoints nest the pagination meta under links.
+    meta = data.get('meta') or data['links'].get('meta')
+    return math.ceil(int(meta['total']) / int(meta['per_page']))
+
+
+def get_json(url: str) -> Dict:
+    return loads(get_with_retry(url, retry_on=(429,)).content)
+
+
+async def aiter_pages(url: str, prefetch: int = None) -> AsyncIterator[Dict]:
+    '''
+    Yields every page of a list endpoint, in order, as soon as it and the pages before it have
+    arrived. The page count comes from the first page's meta, and at most `prefetch` pages are
+    requested ahead of the consumer, so memory stays at a few pages however long the list is.
+    '''
+    prefetch = prefetch or settings.OSF_MAX_CONCURRENCY
+
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        data = await run_blocking(get_json, url, executor=executor)
+        yield data
+        if data['links']['next'] is None:
+            return
+
+        pages = iter(range(2, page_count(data) + 1))
+        pending = deque()
+        try:
+            while True:
+                for page in pages:
+                    pending.append(
+                        asyncio.ensure_future(
+                            run_blocking(get_json, page_url(url, page), executor=executor),
+                        ),
+                    )
+                    if len(pending) >= prefetch:
+                        break
+                if not pending:
+                    return
+                yield await pending.popleft()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+async def aiter_records(url: str, prefetch: int = None) -> AsyncIterator[Dict]:
+    async for data in aiter_pages(url, prefetch=prefetch):
+        for record in data['data']:
+            yield record
+
+
+def iter_pages(
+        url: str,
+        fetch: Callable[[str], Dict] = get_json,
+        prefetch: int = None) -> Iterator[Dict]:
+    '''
+    Yields every page of a list endpoint by following `links.next`, from a background thread that
+    keeps up to `prefetch` pages ready, so fetching the next page overlaps whatever the consumer
+    does with the current one.
+    '''
+    pages = queue.Queue(maxsize=prefetch or settings.OSF_MAX_CONCURRENCY)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                return pages.put(item, timeout=0.1)
+            except queue.Full:
+                pass
 
-    tasks = []
-    if data['links']['next'] is not None:
-        pages = math.ceil(int(data['meta']['total']) / int(data['meta']['per_page']))
-        for i in range(1, pages):
-            task = get_pages(url, i + 1, result)
-            tasks.append(task)
+    def produce():
+        try:
+            next_url = url
+            while next_url and not stop.is_set():
+                data = fetch(next_url)
+                put(data)
+                next_url = data['links']['next']
+            put(done)
+        except BaseException as e:
+            put(e)
 
-    await asyncio.gather(*tasks)
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = pages.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
 
-    pages_as_list = []
-    # through the magic of async all our pages have loaded.
-    for page in list(result.values()):
-        pages_as_list += page
 
-    return pages_as_list
+async def get_paginated_data(url: str, concurrency: int = None):
+    '''
+    Fetches every page of a list endpoint, at most `concurrency` at a time, and returns all their
+    records in page order.
+    '''
+    return [record async for record in aiter_records(url, prefetch=concurrency)]
@@ -0,0 +1,517 @@
+import os
+import time
+import zlib
+import struct
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterable, Iterator, List, Tuple
+from IA.digests import DigestSidecar
+
+LOCAL_FILE_HEADER = b'PK\x03\x04'
+DATA_DESCRIPTOR = b'PK\x07\x08'
+CENTRAL_DIRECTORY_HEADERS = (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06', b'PK\x06\x07')
+
+LOCAL_FILE_HEADER_FORMAT = '<HHHHHIIIHH'
+CENTRAL_DIRECTORY_FORMAT = '<4sHHHHHHIIIHHHHHII'
+END_OF_CENTRAL_DIRECTORY_FORMAT = '<4sHHHHIIH'
+ZIP64_END_OF_CENTRAL_DIRECTORY_FORMAT = '<4sQHHIIQQQQ'
+ZIP64_LOCATOR_FORMAT = '<4sIQI'
+ZIP64_EXTRA_ID = 0x0001
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+ZIP64_VERSION = 45
+DEFAULT_VERSION = 20
+UNIX = 3
+# Deflate can only refer back this far, so it's all of the previous block a compressor needs.
+DEFLATE_WINDOW = 32 * 1024
+
+FLAG_ENCRYPTED = 0x1
+FLAG_DATA_DESCRIPTOR = 0x8
+FLAG_UTF8 = 0x800
+
+EXTRACT_CHUNK_SIZE = 1024 * 1024
+
+
+class UnsupportedZipStream(Exception):
+    '''
+    Raised for members that can't be unpacked without the central directory, e.g. stored members
+    whose size only appears in a trailing data descriptor.
+    '''
+    pass
+
+
+class ChunkReader:
+    '''
+    Reads exact byte counts out of an iterable of arbitrarily sized chunks.
+    '''
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def unread(self, data: bytes):
+        self.buffer = data + self.buffer
+
+    def read_some(self) -> bytes:
+        if self.buffer:
+            data, self.buffer = self.buffer, b''
+            return data
+        return next(self.chunks, b'')
+
+    def read(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                raise zipfile.BadZipFile('Unexpected end of zip stream.')
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def drain(self):
+        self.buffer = b''
+        for _ in self.chunks:
+            pass
+
+
+def member_path(destination: str, name: str) -> str:
+    '''
+    Mirrors ZipFile.extract's sanitizing so archive names can never escape `destination`.
+    '''
+    parts = [part for part in name.split('/') if part not in ('', '.', '..')]
+    return os.path.join(destination, *parts)
+
+
+def parse_zip64_extra(extra: bytes, compressed_size: int, file_size: int):
+    while len(extra) >= 4:
+        header_id, length = struct.unpack('<HH', extra[:4])
+        if header_id == ZIP64_EXTRA_ID:
+            values = extra[4:4 + length]
+            if file_size == ZIP64_LIMIT:
+                file_size, = struct.unpack('<Q', values[:8])
+                values = values[8:]
+            if compressed_size == ZIP64_LIMIT:
+                compressed_size, = struct.unpack('<Q', values[:8])
+            return compressed_size, file_size, True
+        extra = extra[4 + length:]
+    return compressed_size, file_size, False
+
+
+def inflate(reader: ChunkReader) -> Iterator[bytes]:
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    while not decompressor.eof:
+        chunk = reader.read_some()
+        if not chunk:
+            raise zipfile.BadZipFile('Unexpected end of zip stream.')
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    reader.unread(decompressor.unused_data)
+
+
+def copy_stored(reader: ChunkReader, size: int) -> Iterator[bytes]:
+    remaining = size
+    while remaining:
+        chunk = reader.read_some()
+        if not chunk:
+            raise zipfile.BadZipFile('Unexpected end of zip stream.')
+        if len(chunk) > remaining:
+            reader.unread(chunk[remaining:])
+            chunk = chunk[:remaining]
+        remaining -= len(chunk)
+        yield chunk
+
+
+def read_data_descriptor(reader: ChunkReader, zip64: bool):
+    signature = reader.read(4)
+    if signature != DATA_DESCRIPTOR:
+        # The signature is optional, so what we read was already the crc.
+        reader.unread(signature)
+    size_format = '<IQQ' if zip64 else '<III'
+    return struct.unpack(size_format, reader.read(struct.calcsize(size_format)))
+
+
+def extract_stream(
+        chunks: Iterable[bytes],
+        destination: str,
+        digests: DigestSidecar = None) -> List[str]:
+    '''
+    Unpacks a zip archive into `destination` straight from an iterable of byte chunks, e.g. an HTTP
+    response, by walking the local file headers as they arrive. Nothing but the extracted members
+    touches the disk and the archive is never seeked, so the central directory at the end is never
+    needed. Members are hashed into `digests` as they're written. Returns the paths of the
+    extracted files.
+    '''
+    reader = ChunkReader(chunks)
+    extracted = []
+
+    while True:
+        signature = reader.read(4)
+        if signature in CENTRAL_DIRECTORY_HEADERS:
+            reader.drain()
+            return extracted
+        if signature != LOCAL_FILE_HEADER:
+            raise zipfile.BadZipFile(f'Bad local file header signature {signature!r}.')
+
+        (
+            _,
+            flags,
+            method,
+            _,
+            _,
+            crc,
+            compressed_size,
+            file_size,
+            name_length,
+            extra_length,
+        ) = struct.unpack(
+            LOCAL_FILE_HEADER_FORMAT,
+            reader.read(struct.calcsize(LOCAL_FILE_HEADER_FORMAT)),
+        )
+        name = reader.read(name_length).decode('utf-8' if flags & FLAG_UTF8 else 'cp437')
+        compressed_size, file_size, zip64 = parse_zip64_extra(
+            reader.read(extra_length),
+            compressed_size,
+            file_size,
+        )
+        has_descriptor = bool(flags & FLAG_DATA_DESCRIPTOR)
+
+        if flags & FLAG_ENCRYPTED:
+            raise UnsupportedZipStream(f'{name} is encrypted.')
+
+        if method == zipfile.ZIP_DEFLATED:
+            data = inflate(reader)
+        elif method == zipfile.ZIP_STORED and not (has_descriptor and not compressed_size):
+            data = copy_stored(reader, compressed_size)
+        else:
+            raise UnsupportedZipStream(f'{name} uses compression method {method} without sizes.')
+
+        path = member_path(destination, name)
+        actual_crc = 0
+        if name.endswith('/'):
+            os.makedirs(path, exist_ok=True)
+            for chunk in data:
+                actual_crc = zlib.crc32(chunk, actual_crc)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            hasher = digests and digests.hasher()
+            with open(path, 'wb') as fp:
+                for chunk in data:
+                    actual_crc = zlib.crc32(chunk, actual_crc)
+                    fp.write(chunk)
+                    if hasher:
+                        hasher.update(chunk)
+            if hasher:
+                digests.record(path, hasher)
+            extracted.append(path)
+
+        if has_descriptor:
+            crc, _, _ = read_data_descriptor(reader, zip64)
+        if actual_crc != crc:
+            raise zipfile.BadZipFile(f'Bad CRC-32 for {name}.')
+
+
+def extract_member(
+        zip_obj: zipfile.ZipFile,
+        member: zipfile.ZipInfo,
+        destination: str,
+        digests: DigestSidecar = None) -> str:
+    path = member_path(destination, member.filename)
+    hasher = digests and digests.hasher()
+    with zip_obj.open(member) as source, open(path, 'wb') as fp:
+        for chunk in iter(lambda: source.read(EXTRACT_CHUNK_SIZE), b''):
+            fp.write(chunk)
+            if hasher:
+                hasher.update(chunk)
+    if hasher:
+        digests.record(path, hasher)
+    return path
+
+
+def extract_parallel(
+        zip_obj: zipfile.ZipFile,
+        destination: str,
+        workers: int,
+        digests: DigestSidecar = None):
+    '''
+    Extracts the members of an open ZipFile with a pool of threads, zlib releases the GIL while
+    inflating so members decompress concurrently. Directories are created up front so the threads
+    never race on them. Members are hashed into `digests` as they're written.
+    '''
+    members = []
+    for member in zip_obj.infolist():
+        path = member_path(destination, member.filename)
+        if member.is_dir():
+            os.makedirs(path, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            members.append(member)
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        list(executor.map(
+            lambda member: extract_member(zip_obj, member, destination, digests),
+            members,
+        ))
+
+
+def dos_date_time(timestamp: float) -> Tuple[int, int]:
+    year, month, day, hour, minute, second = time.localtime(timestamp)[:6]
+    if year < 1980:
+        return (1 << 5) | 1, 0
+    return (year - 1980) << 9 | month << 5 | day, hour << 11 | minute << 5 | second // 2
+
+
+def deflate_block(block: bytes, level: int, zdict: bytes, last: bool) -> bytes:
+    '''
+    Deflates one block of a member on its own, primed with the end of the block before, so blocks
+    compress in parallel and nearly as well as they would in one go. Every block but the last ends
+    on a byte boundary without being marked final, so the outputs concatenate into one stream.
+    '''
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH,
+    )
+
+
+class ZipWriter:
+    '''
+    Writes a zip archive to a stream that's only ever appended to, never seeked, like a multipart
+    upload, so the archive needn't exist anywhere in full. Members are read in blocks that a pool
+    of `workers` threads deflate in parallel, zlib releases the GIL, while the blocks are written
+    out in order. Sizes and CRCs follow each member in a data descriptor and ZIP64 records are
+    written whenever the sizes, offsets or number of members need them.
+
+    Stored members have their sizes in the local header too, so extract_stream can unpack either.
+    '''
+
+    def __init__(
+            self,
+            fp: BinaryIO,
+            compression: int = zipfile.ZIP_DEFLATED,
+            level: int = 6,
+            workers: int = 1,
+            block_size: int = 1024 * 1024,
+            force_zip64: bool = False):
+        if compression not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise ValueError(f'Compression method {compression} isn\'t supported.')
+        self.fp = fp
+        self.compression = compression
+        self.level = level
+        self.workers = max(workers, 1)
+        self.block_size = block_size
+        self.force_zip64 = force_zip64
+        self.offset = 0
+        self.entries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def _write(self, data: bytes):
+        self.fp.write(data)
+        self.offset += len(data)
+
+    def _blocks(self, files: Iterable[Tuple[str, str]]):
+        '''
+        Every block of every member in order, with the member it belongs to the first time.
+        '''
+        for location, arcname in files:
+            with open(location, 'rb') as fp:
+                stat = os.fstat(fp.fileno())
+                member = {'location': location, 'arcname': arcname, 'stat': stat}
+                previous = b''
+                block = fp.read(self.block_size)
+                while True:
+                    following = fp.read(self.block_size) if block else b''
+                    last = not following
+                    yield member, block, previous[-DEFLATE_WINDOW:], last
+                    member = None
+                    if last:
+                        break
+                    previous, block = block, following
+
+    def write_files(self, files: Iterable[Tuple[str, str]]):
+        '''
+        Adds the file at each `location` as `arcname`. At most two blocks per worker are read ahead
+        of what's been written.
+        '''
+        compress = self.compression == zipfile.ZIP_DEFLATED
+        window = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for member, block, zdict, last in self._blocks(files):
+                if compress:
+                    future = executor.submit(deflate_block, block, self.level, zdict, last)
+                else:
+                    future = None
+                window.append((member, block, future, last))
+                if len(window) >= self.workers * 2:
+                    self._write_block(*window.popleft())
+            while window:
+                self._write_block(*window.popleft())
+
+    def write(self, location: str, arcname: str):
+        self.write_files([(location, arcname)])
+
+    def _write_block(self, member, block: bytes, future, last: bool):
+        if member:
+            self._start_member(member)
+        entry = self.entries[-1]
+        data = future.result() if future else block
+        entry['crc'] = zlib.crc32(block, entry['crc'])
+        entry['file_size'] += len(block)
+        entry['compress_size'] += len(data)
+        self._write(data)
+        if last:
+            self._finish_member(entry)
+
+    def _start_member(self, member):
+        stat = member['stat']
+        name = member['arcname'].replace(os.sep, '/').encode('utf-8')
+        stored = self.compression == zipfile.ZIP_STORED
+        # An empty stored member's CRC is known up front, and it can't be streamed with a
+        # descriptor since there's nothing to say where its data ends.
+        flags = 0 if stored and not stat.st_size else FLAG_DATA_DESCRIPTOR
+        if not member['arcname'].isascii():
+            flags |= FLAG_UTF8
+        # zipfile's own rule of thumb for when a member might outgrow 32 bit sizes
+        zip64 = self.force_zip64 or stat.st_size * 1.05 > ZIP64_LIMIT
+        date, time_ = dos_date_time(stat.st_mtime)
+        entry = {
+            'name': name,
+            'flags': flags,
+            'date': date,
+            'time': time_,
+            'mode': stat.st_mode,
+            'zip64': zip64,
+            'offset': self.offset,
+            'expected_size': stat.st_size,
+            'crc': 0,
+            'file_size': 0,
+            'compress_size': 0,
+        }
+        self.entries.append(entry)
+
+        known_size = stat.st_size if stored else 0
+        extra = b''
+        if zip64:
+            extra = struct.pack('<HHQQ', ZIP64_EXTRA_ID, 16, known_size, known_size)
+            known_size = ZIP64_LIMIT
+        self._write(LOCAL_FILE_HEADER + struct.pack(
+            LOCAL_FILE_HEADER_FORMAT,
+            ZIP64_VERSION if zip64 else DEFAULT_VERSION,
+            flags,
+            self.compression,
+            time_,
+            date,
+            0,
+            known_size,
+            known_size,
+            len(name),
+            len(extra),
+        ) + name + extra)
+
+    def _finish_member(self, entry):
+        if self.compression == zipfile.ZIP_STORED and entry['file_size'] != entry['expected_size']:
+            raise zipfile.BadZipFile(f'{entry["name"].decode()} changed size while being zipped.')
+        if not entry['flags'] & FLAG_DATA_DESCRIPTOR:
+            return
+        size_format = '<IQQ' if entry['zip64'] else '<III'
+        self._write(DATA_DESCRIPTOR + struct.pack(
+            size_format,
+            entry['crc'],
+            entry['compress_size'],
+            entry['file_size'],
+        ))
+
+    def close(self):
+        '''
+        Writes the central directory. The stream itself is left open.
+        '''
+        start = self.offset
+        for entry in self.entries:
+            extra_values = []
+            file_size, compress_size, offset = (
+                entry['file_size'], entry['compress_size'], entry['offset'],
+            )
+            if file_size >= ZIP64_LIMIT:
+                extra_values.append(file_size)
+                file_size = ZIP64_LIMIT
+            if compress_size >= ZIP64_LIMIT:
+                extra_values.append(compress_size)
+                compress_size = ZIP64_LIMIT
+            if offset >= ZIP64_LIMIT:
+                extra_values.append(offset)
+                offset = ZIP64_LIMIT
+            extra = b''
+            if extra_values:
+                extra = struct.pack(
+                    f'<HH{len(extra_values)}Q',
+                    ZIP64_EXTRA_ID,
+                    8 * len(extra_values),
+                    *extra_values,
+                )
+            version = ZIP64_VERSION if entry['zip64'] or extra_values else DEFAULT_VERSION
+            self._write(struct.pack(
+                CENTRAL_DIRECTORY_FORMAT,
+                CENTRAL_DIRECTORY_HEADERS[0],
+                UNIX << 8 | ZIP64_VERSION,
+                version,
+                entry['flags'],
+                self.compression,
+                entry['time'],
+                entry['date'],
+                entry['crc'],
+                compress_size,
+                file_size,
+                len(entry['name']),
+                len(extra),
+                0,
+                0,
+                0,
+                (entry['mode'] & 0xFFFF) << 16,
+                offset,
+            ) + entry['name'] + extra)
+
+        count, size = len(self.entries), self.offset - start
+        if count > ZIP_FILECOUNT_LIMIT or size >= ZIP64_LIMIT or start >= ZIP64_LIMIT:
+            zip64_start = self.offset
+            self._write(struct.pack(
+                ZIP64_END_OF_CENTRAL_DIRECTORY_FORMAT,
+                CENTRAL_DIRECTORY_HEADERS[2],
+                44,
+                UNIX << 8 | ZIP64_VERSION,
+                ZIP64_VERSION,
+                0,
+                0,
+                count,
+                count,
+                size,
+                start,
+            ))
+            self._write(struct.pack(
+                ZIP64_LOCATOR_FORMAT,
+                CENTRAL_DIRECTORY_HEADERS[3],
+                0,
+                zip64_start,
+                1,
+            ))
+            count = min(count, ZIP_FILECOUNT_LIMIT)
+            size = min(size, ZIP64_LIMIT)
+            start = min(start, ZIP64_LIMIT)
+        self._write(struct.pack(
+            END_OF_CENTRAL_DIRECTORY_FORMAT,
+            CENTRAL_DIRECTORY_HEADERS[1],
+            0,
+            0,
+            count,
+            count,
+            size,
+            start,
+            0,
+        ))
@@ -0,0 +1,41 @@
+import time
+import argparse
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.server import serve
+from IA.utils import connection_stats, get_with_retry
+
+
+def main(count, workers):
+    server, base_url = serve()
+    url = f'{base_url}1024'
+
+    for mode, get in (('unpooled', requests.get), ('pooled', get_with_retry)):
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda _: get(url).content, range(count)))
+        elapsed = time.monotonic() - start
+        print(f'{mode}: {count} requests in {elapsed:.2f}s ({count / elapsed:.0f} requests/sec)')
+
+    print(connection_stats())
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-n',
+        '--count',
+        help='How many small requests to make. Default is 2000.',
+        type=int,
+        default=2000,
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='How many threads make them. Default is 8.',
+        type=int,
+        default=8,
+    )
+    args = parser.parse_args()
+    main(args.count, args.workers)
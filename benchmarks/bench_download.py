@@ -0,0 +1,65 @@
+import os
+import time
+import argparse
+import resource
+import tempfile
+from benchmarks.server import serve
+from IA.utils import download_to_file, get_with_retry
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def buffered(url, location):
+    resp = get_with_retry(url)
+    with open(location, 'wb') as fp:
+        fp.write(resp.content)
+    return len(resp.content)
+
+
+def main(size, mode, workers):
+    server, base_url = serve()
+    url = f'{base_url}{size}'
+
+    with tempfile.TemporaryDirectory() as tmp:
+        location = os.path.join(tmp, 'bench.zip')
+        start = time.monotonic()
+        if mode == 'buffered':
+            written = buffered(url, location)
+        else:
+            written = download_to_file(url, location, workers=workers)
+        elapsed = time.monotonic() - start
+
+    server.shutdown()
+    print(
+        f'{mode} ({workers} workers): {written} bytes in {elapsed:.2f}s '
+        f'({written / elapsed / 1024 / 1024:.1f} MiB/s), peak RSS {peak_rss_mb():.0f} MiB',
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-s',
+        '--size',
+        help='Size of the body served by the local stand-in, in bytes. Default is 2 GiB.',
+        type=int,
+        default=2 * 1024 ** 3,
+    )
+    parser.add_argument(
+        '-m',
+        '--mode',
+        help='Either "stream" (the default) or "buffered" to compare against response.content.',
+        choices=('stream', 'buffered'),
+        default='stream',
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='How many byte ranges to fetch in parallel when streaming. Default is 1.',
+        type=int,
+        default=1,
+    )
+    args = parser.parse_args()
+    main(args.size, args.mode, args.workers)
@@ -0,0 +1,104 @@
+import os
+import time
+import random
+import zipfile
+import argparse
+import tempfile
+from benchmarks.server import file_handler, serve
+from IA.utils import download_to_file, iter_download
+from IA.zip_stream import extract_parallel, extract_stream
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'IA', 'tests', 'fixtures')
+
+
+def scaled_fixture(location, copies, member_size):
+    '''
+    Writes a zip with the layout of the sgg32/jj81a fixtures repeated `copies` times, with every
+    member padded out to roughly `member_size` bytes of compressible text.
+    '''
+    rng = random.Random(0)
+    words = [bytes(rng.choice(b'abcdefghij ') for _ in range(8)) for _ in range(512)]
+
+    with zipfile.ZipFile(location, 'w', compression=zipfile.ZIP_DEFLATED) as target:
+        for fixture in ('sgg32.zip', 'jj81a.zip'):
+            with zipfile.ZipFile(os.path.join(FIXTURES, fixture)) as source:
+                for copy in range(copies):
+                    for info in source.infolist():
+                        name = f'{fixture[:-4]}-{copy}/{info.filename}'
+                        if info.is_dir():
+                            target.writestr(name, b'')
+                            continue
+                        data = source.read(info)
+                        with target.open(name, 'w') as fp:
+                            written = 0
+                            while written < member_size:
+                                fp.write(data)
+                                block = b''.join(rng.choices(words, k=1024))
+                                fp.write(block)
+                                written += len(data) + len(block)
+
+
+def tree_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, file))
+        for root, dirs, files in os.walk(path)
+        for file in files
+    )
+
+
+def main(copies, member_size, workers):
+    with tempfile.TemporaryDirectory() as tmp:
+        location = os.path.join(tmp, 'scaled.zip')
+        scaled_fixture(location, copies, member_size)
+        zip_size = os.path.getsize(location)
+        server, base_url = serve(file_handler(location))
+
+        for mode in ('disk', 'parallel', 'stream'):
+            destination = os.path.join(tmp, mode)
+            os.mkdir(destination)
+            start = time.monotonic()
+            if mode == 'stream':
+                extract_stream(iter_download(base_url), destination)
+            else:
+                zip_location = os.path.join(destination, 'scaled.zip')
+                download_to_file(base_url, zip_location)
+                with zipfile.ZipFile(zip_location) as zip_obj:
+                    extract_parallel(zip_obj, destination, workers if mode == 'parallel' else 1)
+                os.remove(zip_location)
+            elapsed = time.monotonic() - start
+
+            extracted = tree_size(destination)
+            scratch = extracted if mode == 'stream' else extracted + zip_size
+            print(
+                f'{mode}: {zip_size / elapsed / 1024 / 1024:.1f} MiB/s of zip, '
+                f'{extracted} bytes extracted, peak scratch disk {scratch} bytes',
+            )
+
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c',
+        '--copies',
+        help='How many times the fixture layouts are repeated. Default is 50.',
+        type=int,
+        default=50,
+    )
+    parser.add_argument(
+        '-m',
+        '--member-size',
+        help='Approximate size of every file member, in bytes. Default is 4 MiB.',
+        type=int,
+        default=4 * 1024 * 1024,
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='Threads used by the parallel mode. Default is 4.',
+        type=int,
+        default=4,
+    )
+    args = parser.parse_args()
+    main(args.copies, args.member_size, args.workers)
@@ -0,0 +1,64 @@
+import os
+import json
+import time
+import argparse
+import settings
+from IA.json_backend import BACKENDS, get_backend, split_data
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'IA', 'tests', 'fixtures')
+
+
+def scaled_page(name, pagesize):
+    '''
+    A page of logs shaped like the fixture's, with its logs repeated up to `pagesize` of them.
+    '''
+    with open(os.path.join(FIXTURES, name), 'r') as fp:
+        document = json.load(fp)
+    logs = document['data']
+    document['data'] = (logs * (pagesize // len(logs) + 1))[:pagesize]
+    return json.dumps(document).encode()
+
+
+def timed(pages, func):
+    start = time.monotonic()
+    for body in pages:
+        func(body)
+    return time.monotonic() - start
+
+
+def main(pages, pagesize):
+    for name in ('8jpzs-1.json', 'njs82.json'):
+        body = scaled_page(name, pagesize)
+        bodies = [body] * pages
+        size = len(body) * pages / 1024 / 1024
+        print(f'{name}: {pages} pages of {pagesize} logs, {size:.1f} MiB')
+
+        for backend in BACKENDS:
+            loads, dumps = get_backend(backend)
+            elapsed = timed(bodies, lambda body: dumps(loads(body)['data']))
+            print(f'  {backend} decode and encode: {elapsed:.2f}s ({size / elapsed:.1f} MiB/s)')
+
+        # Only the json backend keeps the data raw, the others decode it like above.
+        settings.JSON_BACKEND = 'json'
+        elapsed = timed(bodies, split_data)
+        print(f'  json raw data: {elapsed:.2f}s ({size / elapsed:.1f} MiB/s)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-n',
+        '--pages',
+        help='How many pages are decoded. Default is 1000.',
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        '-p',
+        '--pagesize',
+        help='How many logs each page has. Default is 100.',
+        type=int,
+        default=100,
+    )
+    args = parser.parse_args()
+    main(args.pages, args.pagesize)
@@ -0,0 +1,150 @@
+import os
+import json
+import math
+import time
+import asyncio
+import argparse
+import tempfile
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+import settings
+from benchmarks.server import serve
+from IA import IA_consume_logs, IA_upload
+from IA.IA_bag_and_tag import bag_and_tag
+from IA.log_export import LOG_EXPORT_FORMATS, iter_logs, zstandard
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'IA', 'tests', 'fixtures')
+
+
+def logs_handler(count):
+    '''
+    Builds a handler that pages through `count` logs shaped like the njs82 fixture's for any
+    registration, and accepts any PUT, standing in for both OSF and Internet Archive.
+    '''
+    with open(os.path.join(FIXTURES, 'njs82.json'), 'r') as fp:
+        template = json.load(fp)['data'][0]
+
+    class LogsHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            size = int(query['page[size]'][0])
+            page = int(query.get('page', ['1'])[0])
+            last = math.ceil(count / size)
+
+            logs = []
+            for number in range((page - 1) * size, min(page * size, count)):
+                log = dict(template, id=f'{number:024x}')
+                log['attributes'] = dict(template['attributes'], date=f'2019-11-01T15:36:{number}')
+                logs.append(log)
+
+            base = f'http://{self.headers["Host"]}{url.path}?page[size]={size}'
+            body = json.dumps({
+                'data': logs,
+                'links': {
+                    'next': f'{base}&page={page + 1}' if page < last else None,
+                    'meta': {'total': count, 'per_page': size},
+                },
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_PUT(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    return LogsHandler
+
+
+def tree_stats(path):
+    files = [
+        os.path.join(root, file)
+        for root, dirs, files in os.walk(path)
+        for file in files
+    ]
+    return len(files), sum(os.path.getsize(file) for file in files)
+
+
+def main(count, pagesize, workers):
+    server, base_url = serve(logs_handler(count))
+    settings.OSF_API_URL = base_url
+    IA_upload.IA_URL = base_url.rstrip('/')
+
+    formats = [
+        export_format for export_format in LOG_EXPORT_FORMATS
+        if zstandard or not export_format.endswith('.zst')
+    ]
+    for export_format in formats:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench')
+            timings = []
+
+            start = time.monotonic()
+            IA_consume_logs.main(
+                'bench',
+                tmp,
+                pagesize,
+                'token',
+                workers,
+                export_format=export_format,
+            )
+            timings.append(time.monotonic() - start)
+            logs = os.path.join(path, 'logs')
+            if export_format != 'pages':
+                logs = os.path.join(logs, f'bench.{export_format}')
+            assert sum(1 for log in iter_logs(logs)) == count
+            files, size = tree_stats(os.path.join(path, 'logs'))
+
+            start = time.monotonic()
+            bag_and_tag('<resource/>', path)
+            timings.append(time.monotonic() - start)
+
+            start = time.monotonic()
+            asyncio.run(IA_upload.gather_and_upload('bench', path, journal=False, relative_to=path))
+            timings.append(time.monotonic() - start)
+
+            fetch, bag, upload = timings
+            print(
+                f'{export_format}: {files} files, {size} bytes, fetched in {fetch:.2f}s, '
+                f'bagged in {bag:.2f}s, uploaded in {upload:.2f}s, {sum(timings):.2f}s in all',
+            )
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-n',
+        '--count',
+        help='How many logs the registration has. Default is 100000.',
+        type=int,
+        default=100000,
+    )
+    parser.add_argument(
+        '-p',
+        '--pagesize',
+        help='How many logs come in each page. Default is 100.',
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='How many pages to fetch at once. Default is 4.',
+        type=int,
+        default=4,
+    )
+    args = parser.parse_args()
+    main(args.count, args.pagesize, args.workers)
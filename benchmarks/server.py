@@ -0,0 +1,93 @@
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BLOCK = bytes(range(256)) * 4096  # 1 MiB of non-zero, repeating data
+
+
+class SizedBodyHandler(BaseHTTPRequestHandler):
+    '''
+    Serves `GET /<size>` with a `size` byte body that is generated on the fly, so the stand-in
+    itself never holds more than one block in memory, even for multi-GB bodies. Single byte ranges
+    are honored unless the path ends with `?ranges=0`.
+    '''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse_path(self):
+        path, _, query = self.path.strip('/').partition('?')
+        return int(path), query != 'ranges=0'
+
+    def do_HEAD(self):
+        size, ranges = self.parse_path()
+        self.send_response(200)
+        self.send_common_headers(size, ranges)
+        self.end_headers()
+
+    def do_GET(self):
+        size, ranges = self.parse_path()
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+
+        if ranges and match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_common_headers(end - start + 1, ranges)
+        self.end_headers()
+        self.write_body(start, end + 1)
+
+    def send_common_headers(self, length, ranges):
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(length))
+        if ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+
+    def write_body(self, start, end):
+        position = start
+        while position < end:
+            offset = position % len(BLOCK)
+            block = BLOCK[offset:offset + min(len(BLOCK) - offset, end - position)]
+            self.wfile.write(block)
+            position += len(block)
+
+
+def serve(handler=SizedBodyHandler, port=0):
+    '''
+    Starts the stand-in on a daemon thread and returns the server and its base url.
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/'
+
+
+def file_handler(location):
+    '''
+    Builds a handler that serves the file at `location` for any GET, read in blocks.
+    '''
+
+    class FileHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/zip')
+            self.send_header('Content-Length', str(os.path.getsize(location)))
+            self.end_headers()
+            with open(location, 'rb') as fp:
+                for block in iter(lambda: fp.read(len(BLOCK)), b''):
+                    self.wfile.write(block)
+
+    return FileHandler
@@ -1,5 +1,70 @@
-CHUNK_SIZE = 1000
+import os
+
+# Files bigger than this are sent as multipart uploads, in parts of about this size.
+CHUNK_SIZE = 64 * 1024 * 1024
+# S3's limits for multipart uploads: every part but the last must be at least MIN_PART_SIZE,
+# a part can't be over MAX_PART_SIZE and an upload can't have more than MAX_PARTS parts.
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+# The most requests in flight to a single Internet Archive host at once.
+IA_MAX_CONCURRENCY = 8
+# The most parts of a single file uploaded at once.
+IA_MAX_PART_CONCURRENCY = 4
+# Record upload progress next to the uploaded directory so reruns can resume.
+UPLOAD_JOURNAL = True
+# List the bucket before uploading and skip files it already has with the same size and md5.
+UPLOAD_SKIP_UNCHANGED = False
+# Bagging: how many processes compute checksums, which algorithms go in the manifests and how the
+# new bag is validated, 'none', 'fast' (structure and Payload-Oxum) or 'complete' (rehash it all).
+BAG_PROCESSES = 4
+BAG_CHECKSUMS = ['sha256', 'sha512']
+BAG_VALIDATION = 'fast'
+# DataCite metadata is cached here, None turns the cache off, and used without asking DataCite
+# again for this many seconds, after which it's revalidated with a conditional request.
+DATACITE_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'osf-pigeon', 'datacite')
+DATACITE_CACHE_TTL = 24 * 60 * 60
+# Zipping bags: 'store' or 'deflate', the zlib level, how many threads compress and the size of
+# the blocks they compress at a time.
+ZIP_COMPRESSION = 'deflate'
+ZIP_COMPRESSION_LEVEL = 6
+ZIP_WORKERS = 4
+ZIP_BLOCK_SIZE = 1024 * 1024
+# Have the fetchers hash files as they write them, into a sidecar next to the registration's
+# directory, so bagging doesn't have to read the payload back.
+BAG_DIGEST_SIDECAR = True
+# Size of the chunks written to disk while streaming large downloads such as osfstorage zips.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Number of byte ranges fetched in parallel when the server supports them, 1 streams the body.
+DOWNLOAD_WORKERS = 1
+# How many times an interrupted download is resumed before giving up.
+DOWNLOAD_RETRIES = 5
+# Unpack osfstorage zips as they download instead of writing the zip to disk first.
+STREAM_EXTRACT = False
+# Number of threads used to extract members from a zip that has been downloaded to disk.
+EXTRACT_WORKERS = 4
 OSF_API_URI = 'http://localhost:8000/'
+# Connection pooling for the session shared by every script: how many hosts keep a pool and how
+# many keep-alive connections each pool holds.
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 32
+# Seconds to wait to connect and then between bytes of a response.
+HTTP_TIMEOUT = (10, 300)
+# Client side rate limits as {host: (requests per second, burst)}. Hosts that aren't listed are
+# only slowed down once they answer with Retry-After or rate limit headers.
+RATE_LIMITS = {}
+# After a 429 or 503 the rate drops to this fraction of what was being sent, and it recovers by
+# this fraction per successful response. Without a Retry-After, requests pause for RATE_LIMIT_PAUSE
+# seconds.
+RATE_LIMIT_BACKOFF = 0.9
+RATE_LIMIT_RECOVERY = 0.01
+RATE_LIMIT_PAUSE = 1
+# Retries: how many attempts in all, the backoff before the first retry (doubling from there, with
+# jitter) and its cap, in seconds, and the statuses always worth retrying.
+RETRY_MAX_ATTEMPTS = 8
+RETRY_BACKOFF = 0.5
+RETRY_MAX_BACKOFF = 60
+RETRY_ON_STATUSES = (500, 502, 503, 504)
 OSF_COLLECTION_NAME = 'cos-dev-sandbox'
 
 IA_ACCESS_KEY = 'change to valid token'
@@ -7,4 +72,21 @@ IA_SECRET_KEY = 'change to valid token'
 
 OSF_API_URL = 'https://localhost:8000/'
 OSF_LOGS_URL = 'v2/registrations/{}/logs/?page[size]={}'
+# Which library decodes and encodes JSON: 'json', 'ujson', 'orjson' or 'auto' for the fastest one
+# installed.
+JSON_BACKEND = 'auto'
+# Write each page of logs out as the API sent its data instead of encoding it again. It only pays
+# off with the 'json' backend, the others decode and encode faster, so it's ignored with them.
+LOG_RAW_DATA = False
+# How logs are written: 'pages', a JSON file per page, or every log in one 'ndjson', 'ndjson.gz'
+# or 'ndjson.zst' file. zstd needs the zstandard package.
+LOG_EXPORT_FORMAT = 'pages'
+# The most OSF API pages fetched at once.
+OSF_MAX_CONCURRENCY = 8
 IA_URL = 'http://s3.us.archive.org'
+# The Internet Archive bucket each registration is uploaded to by the batch runner.
+IA_BUCKET_FORMAT = 'osf-registration-{guid}'
+# The most registrations the batch runner archives at once.
+BATCH_WORKERS = 4
+# How many fetched files the pipeline lets wait for an uploader before the fetchers hold off.
+PIPELINE_QUEUE_SIZE = 64